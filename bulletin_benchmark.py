@@ -0,0 +1,219 @@
+# 公告板格式化基准测试：用合成的 1000 条消息窗口比较旧的格式化流程与格式化上下文 + Markdown 缓存
+# 用法:
+#   python bulletin_benchmark.py [--messages 1000] [--repeat 5]
+#   python bulletin_benchmark.py --render      同时比较整体 setHtml 与增量渲染（无显示器时使用 offscreen 平台）
+import argparse
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# 无显示器的环境下也能创建 QApplication
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+from markdown import markdown
+from PyQt6.QtCore import QUrl
+
+from bulletin_board_module import (BulletinBoardModule, FormattingContext, IncrementalRenderer, MarkdownCache,
+                                   FILE_ICON_PATH)
+
+# 公告板模块按 DEBUG 级别输出日志，基准测试中两种流程都不输出，只比较格式化本身
+logging.disable(logging.INFO)
+
+
+def build_rows(count, download_dir):
+    """生成按 id 倒序的合成消息，约三成带附件，其中一半附件已下载"""
+    now = datetime.now().replace(microsecond=0)
+    rows = []
+    for i in range(count):
+        content = f"第 {i} 条通知：请各班**班主任**于今天下午放学前提交材料\n\n- 材料一\n- 材料二\n\n详见 [通知](http://example.com/{i})"
+        if i % 3 == 0:
+            filename = f"{i:08x}.{'jpg' if i % 2 else 'pdf'}"
+            content += f" &[http://192.168.1.10:20000/media/{filename}?sign=abc]&"
+            if i % 6 == 0:
+                open(os.path.join(download_dir, filename), 'wb').close()
+        rows.append({
+            "id": 100000 + count - i,
+            "conversationTitle": "管理组" if i % 5 == 0 else f"高三{i % 12 + 1}班",
+            "sender_name": f"老师{i % 30}",
+            "message_content": content,
+            "timestamp": int((now - timedelta(minutes=i * 10)).timestamp())
+        })
+    return rows
+
+
+def create_module(download_dir, cache_file):
+    """不创建界面，只初始化格式化用到的属性"""
+    module = BulletinBoardModule.__new__(BulletinBoardModule)
+    module.failed_urls = {}
+    module.markdown_cache = MarkdownCache(cache_file)
+    module.format_context = FormattingContext(module.get_qss_path, module.parse_qss_colors, download_dir)
+    return module
+
+
+def legacy_rows(rows):
+    """旧版服务端返回的时间戳是 RFC 格式字符串，旧流程在格式化时逐条解析"""
+    return [dict(row, timestamp=datetime.fromtimestamp(row["timestamp"]).strftime("%a, %d %b %Y %H:%M:%S GMT"))
+            for row in rows]
+
+
+def legacy_format_messages(module, rows, download_dir):
+    """旧的格式化流程，照搬优化前 format_messages 的各个步骤（省略异常处理，下载目录换成临时目录）：
+    每轮读取并解析 QSS，每条消息解析时间、生成调试日志，每个附件访问磁盘，每条消息都重新执行 markdown()"""
+    logging.info(f"开始格式化 {len(rows)} 条消息")
+    formatted_text = ""
+    pattern = re.compile(r'&\[(.*?)\]&')
+    try:
+        theme_config = module.parse_qss_colors(module.get_qss_path())
+    except Exception as e:
+        logging.error(f"加载主题配置失败: {e}")
+        theme_config = {'sender': '#4cc2ff', 'admin-sender': '#ff6b6b'}
+
+    for i, row in enumerate(rows):
+        logging.debug(f"处理第 {i + 1} 条消息: {row}")
+        sender_name = str(row.get('sender_name', '未知发送者')) if row.get(
+            'sender_name') is not None else '未知发送者'
+        conversationTitle = str(row.get('conversationTitle', '未知群聊')) if row.get(
+            'conversationTitle') is not None else '未知群聊'
+
+        created_at = "未知时间"
+        timestamp_value = row.get('timestamp')
+        if timestamp_value:
+            if isinstance(timestamp_value, str):
+                if timestamp_value.endswith(' GMT'):
+                    dt = datetime.strptime(timestamp_value, "%a, %d %b %Y %H:%M:%S GMT")
+                else:
+                    dt = datetime.strptime(timestamp_value, "%Y-%m-%d %H:%M:%S")
+            else:
+                dt = timestamp_value
+            created_at = dt.strftime("%m-%d %H:%M")
+
+        message_content = str(row.get('message_content', '')) if row.get(
+            'message_content') is not None else ''
+        css_class = 'admin-sender' if "管理组" in conversationTitle else 'sender'
+        color = theme_config.get(css_class, '#4cc2ff')
+
+        matches = pattern.findall(message_content)
+        processed_message_content = message_content
+        for url in matches:
+            file_path = os.path.join(download_dir, os.path.basename(url.split('?')[0]))
+            file_url = QUrl.fromLocalFile(file_path).toString()
+            if os.path.exists(file_path):
+                ext = os.path.splitext(file_path)[1].lower()
+                new_message = re.sub(r'&\[(.*?)\]&', '', processed_message_content).strip()
+                if ext in ['.png', '.jpg', '.jpeg', '.gif']:
+                    processed_message_content = f"{new_message}<br><a href='{file_url}'><img src='{file_path}' style='max-width: 100%; width: auto; height: auto;'></a>"
+                else:
+                    icon_path = FILE_ICON_PATH
+                    if os.path.exists(icon_path):
+                        processed_message_content = f"{new_message}<br><a href='{file_url}'><img src='{icon_path}' width='128'></a>"
+                    else:
+                        processed_message_content = f"{new_message}<br><a href='{file_url}'>{os.path.basename(file_path)} (图标丢失)</a>"
+            elif url in module.failed_urls:
+                error_msg = module.failed_urls[url]
+                if "403" in error_msg:
+                    processed_message_content = "<span style='color: red;'>文件链接已过期，无法下载</span>"
+                else:
+                    processed_message_content = f"<span style='color: red;'>下载失败: {error_msg}</span>"
+            else:
+                processed_message_content = "下载中..."
+
+        formatted_text += f"<b style='color:{color}; font-size:16px;'>{sender_name} ({created_at})</b>{markdown(processed_message_content)}<hr>"
+
+    logging.info(f"消息格式化完成，总长度: {len(formatted_text)}")
+    return formatted_text
+
+
+def measure(func, repeat):
+    func()  # 预热
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat
+
+
+def bench_format(args, rows, download_dir, cache_file):
+    module = create_module(download_dir, cache_file)
+    old_rows = legacy_rows(rows)
+
+    def cold():
+        module.markdown_cache = MarkdownCache(cache_file)
+        module.format_messages(rows)
+
+    results = [
+        ("旧流程", measure(lambda: legacy_format_messages(module, old_rows, download_dir), args.repeat)),
+        ("格式化上下文，冷缓存", measure(cold, args.repeat)),
+        ("格式化上下文，热缓存", measure(lambda: module.format_messages(rows), args.repeat)),
+    ]
+    print(f"{len(rows)} 条消息，格式化整个窗口:")
+    for name, cost in results:
+        print(f"  {name}: {cost * 1000:.1f}ms")
+    print(f"  热缓存相对旧流程提升: {results[0][1] / results[2][1]:.1f}x")
+    print(f"  Markdown 缓存: {module.markdown_cache.stats()}")
+    return module
+
+
+def bench_render(args, rows, module):
+    """比较新增一条消息时整体 setHtml 与增量渲染的耗时（含排版）"""
+    from PyQt6.QtWidgets import QApplication, QTextBrowser
+
+    app = QApplication.instance() or QApplication([])
+    browser = QTextBrowser()
+    browser.resize(800, 600)
+    context = module.format_context
+    context.refresh()
+
+    def format_row(row):
+        return module.format_message(row, context)
+
+    older = rows[1:]
+
+    def full():
+        browser.setHtml(module.format_messages(older))
+        browser.setHtml(module.format_messages(rows))
+        browser.document().size()  # 强制完成排版
+
+    renderer = IncrementalRenderer(browser)
+    state = {"rows": older}
+
+    def incremental():
+        # 交替新增和移除最新一条消息，模拟轮询收到新消息
+        state["rows"] = rows if state["rows"] is older else older
+        renderer.render(state["rows"], format_row)
+        browser.document().size()
+
+    full_cost = measure(full, args.repeat) / 2
+    renderer.rebuild(older, format_row)
+    incremental_cost = measure(incremental, args.repeat)
+    print("新增一条消息后刷新公告板:")
+    print(f"  整体 setHtml: {full_cost * 1000:.1f}ms")
+    print(f"  增量渲染: {incremental_cost * 1000:.1f}ms")
+    print(f"  提升: {full_cost / incremental_cost:.1f}x")
+    app.processEvents()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="公告板格式化与渲染基准测试")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--render", action="store_true", help="同时比较整体 setHtml 与增量渲染")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp(prefix="bulletin_benchmark_")
+    try:
+        download_dir = os.path.join(temp_dir, "download")
+        os.makedirs(download_dir)
+        rows = build_rows(args.messages, download_dir)
+        module = bench_format(args, rows, download_dir, os.path.join(temp_dir, "markdown_cache.json"))
+        if args.render:
+            bench_render(args, rows, module)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
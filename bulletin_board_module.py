@@ -2,22 +2,32 @@ import json
 import logging
 import os
 import base64
+import hashlib
 import re
 import sys
+import threading
+from collections import OrderedDict
 from queue import Queue
+from urllib.parse import urlsplit
 import requests
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
-from PyQt6.QtCore import QThread, pyqtSignal, QTimer, QUrl, QEasingCurve, QAbstractAnimation, QParallelAnimationGroup
+from PyQt6.QtCore import QObject, QThread, pyqtSignal, QTimer, QUrl, QEasingCurve, QAbstractAnimation, QParallelAnimationGroup
 from PyQt6.QtMultimedia import QSoundEffect
 from datetime import datetime, timedelta
 from markdown import markdown
 from PyQt6.QtWidgets import QLabel, QWidget, QVBoxLayout, QApplication, QTextBrowser
 from PyQt6.QtCore import QTimer, Qt, QPropertyAnimation, QRect
-from PyQt6.QtGui import QFont, QFontMetrics, QDesktopServices
+from PyQt6.QtGui import QFont, QFontMetrics, QDesktopServices, QTextCursor, QTextFrameFormat
 import time
+import uuid
 import urllib3
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # 未安装时紧凑格式使用 JSON 编码
+
 # 禁用不安全请求警告（仅用于测试）
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -25,10 +35,289 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+# 服务端只保留近7天的消息，本地消息列表使用相同的窗口
+MESSAGE_WINDOW_DAYS = 7
+
+# 消息中的附件标记 &[url]&
+ATTACHMENT_PATTERN = re.compile(r'&\[(.*?)\]&')
+# QSS 中形如 .sender { color: #4cc2ff; } 的颜色定义
+QSS_COLOR_PATTERN = re.compile(r'\.(\w+)\s*\{\s*color:\s*#([0-9a-fA-F]{6})\s*;\s*\}')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+SHA256_NAME_PATTERN = re.compile(r'[0-9a-f]{64}')
+CONTENT_RANGE_PATTERN = re.compile(r'bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)')
+DOWNLOAD_DIR = "./data/download/"
+FILE_ICON_PATH = "icon/file.png"
+QSS_TXT_PATH = './data/qss.txt'
+DEFAULT_THEME = {'sender': '#4cc2ff', 'admin-sender': '#ff6b6b'}
+
+
+def get_mtime(path):
+    """返回文件修改时间，文件不存在时返回 None"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def parse_message_time(timestamp_value):
+    """将服务器返回的时间戳解析为 datetime，无法解析时返回 None"""
+    if not timestamp_value:
+        return None
+    if isinstance(timestamp_value, datetime):
+        return timestamp_value
+    try:
+        # 紧凑格式的时间戳为整数秒级时间戳
+        if isinstance(timestamp_value, (int, float)):
+            return datetime.fromtimestamp(timestamp_value)
+        if timestamp_value.endswith(' GMT'):
+            return datetime.strptime(timestamp_value, "%a, %d %b %Y %H:%M:%S GMT")
+        return datetime.strptime(timestamp_value, "%Y-%m-%d %H:%M:%S")
+    except (AttributeError, TypeError, ValueError, OverflowError, OSError):
+        return None
+
+
+def parse_content_range(value):
+    """解析 Content-Range 响应头，返回 (起始位置, 结束位置, 总长度)，无法解析的部分为 None"""
+    match = CONTENT_RANGE_PATTERN.match(value or '')
+    if not match:
+        return None, None, None
+    start, end, total = match.groups()
+    return (int(start) if start else None, int(end) if end else None,
+            int(total) if total and total != '*' else None)
+
+
+def decode_compact_rows(data):
+    """将紧凑格式的数组行还原为字典；旧版服务端返回的字典行原样返回"""
+    rows = data.get("data") or []
+    fields = data.get("fields")
+    if not fields:
+        return rows
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def load_client_id():
+    """读取本机的客户端标识，不存在时生成并保存；服务端按该标识区分同一出口地址后的多台电脑"""
+    client_id_file = 'data/client_id.txt'
+    try:
+        if os.path.exists(client_id_file):
+            with open(client_id_file, 'r', encoding='utf-8') as f:
+                client_id = f.read().strip()
+                if client_id:
+                    return client_id
+        client_id = uuid.uuid4().hex
+        os.makedirs(os.path.dirname(client_id_file), exist_ok=True)
+        with open(client_id_file, 'w', encoding='utf-8') as f:
+            f.write(client_id)
+        return client_id
+    except Exception as e:
+        logging.error(f"读取客户端标识时出错: {e}")
+        return uuid.uuid4().hex
+
+
+def parse_retry_after(response, default):
+    """解析 Retry-After 响应头（秒数或 HTTP 日期），无法解析时返回 default"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    dt = parse_message_time(value)
+    if dt is None:
+        return default
+    return max(0, int((dt - datetime.utcnow()).total_seconds()))
+
+
+class DownloadIndex:
+    """下载目录中已有文件的内存索引
+
+    格式化消息时用集合查询代替逐个附件调用 os.path.exists；下载完成时由下载流程更新索引，
+    目录被外部修改（手动删除文件等）时根据目录修改时间重新扫描
+    """
+
+    def __init__(self, download_dir=DOWNLOAD_DIR):
+        self.download_dir = download_dir
+        self.files = set()
+        self.dir_mtime = None
+        self.scanned = False
+
+    @staticmethod
+    def filename_for(url):
+        return os.path.basename(url.split('?')[0])
+
+    def path_for(self, url):
+        return os.path.join(self.download_dir, self.filename_for(url))
+
+    def refresh_if_changed(self):
+        """目录修改时间变化时重新扫描，每轮渲染前调用一次"""
+        dir_mtime = get_mtime(self.download_dir)
+        if self.scanned and dir_mtime == self.dir_mtime:
+            return
+        files = set()
+        try:
+            with os.scandir(self.download_dir) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        files.add(entry.name)
+        except OSError:
+            pass
+        self.files = files
+        self.dir_mtime = dir_mtime
+        self.scanned = True
+
+    def contains(self, filename):
+        if not self.scanned:
+            self.refresh_if_changed()
+        return filename in self.files
+
+    def add(self, filename):
+        self.files.add(filename)
+
+    def discard(self, filename):
+        self.files.discard(filename)
+
+
+class FormattingContext:
+    """公告板格式化上下文
+
+    持有解析好的主题颜色、下载目录索引和文件图标是否存在等状态，每轮渲染前 refresh() 一次，
+    只在主题文件修改时间变化时重新解析 QSS，格式化每条消息时不再访问磁盘
+    """
+
+    def __init__(self, get_qss_path, parse_qss_colors, download_dir=DOWNLOAD_DIR):
+        self.get_qss_path = get_qss_path
+        self.parse_qss_colors = parse_qss_colors
+        self.downloads = DownloadIndex(download_dir)
+        self.theme_config = dict(DEFAULT_THEME)
+        self.file_icon_exists = False
+        self.qss_txt_mtime = None
+        self.qss_path = None
+        self.qss_signature = None  # (QSS 路径, 修改时间)，变化时重新解析
+
+    def refresh(self):
+        """检查主题文件、文件图标和下载目录是否有变化"""
+        try:
+            qss_txt_mtime = get_mtime(QSS_TXT_PATH)
+            if self.qss_path is None or qss_txt_mtime != self.qss_txt_mtime:
+                self.qss_txt_mtime = qss_txt_mtime
+                self.qss_path = self.get_qss_path()
+            qss_signature = (self.qss_path, get_mtime(self.qss_path))
+            if qss_signature != self.qss_signature:
+                self.qss_signature = qss_signature
+                self.theme_config = self.parse_qss_colors(self.qss_path)
+                logging.info(f"已加载主题颜色: {self.qss_path}")
+        except Exception as e:
+            logging.error(f"加载主题配置时出错: {e}")
+            self.theme_config = dict(DEFAULT_THEME)
+
+        self.file_icon_exists = os.path.exists(FILE_ICON_PATH)
+        self.downloads.refresh_if_changed()
+
+
+class MarkdownCache:
+    """Markdown 渲染结果的 LRU 缓存
+
+    消息入库后内容不再变化，按 (消息 id, 内容哈希) 缓存 markdown() 的输出；附件下载完成等导致待渲染文本
+    变化时哈希随之变化，自动重新渲染。缓存保存到 data/ 下，重启后无需重新渲染全部消息
+    """
+
+    VERSION = 1
+
+    def __init__(self, cache_file='data/markdown_cache.json', max_entries=2000):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # 缓存键 -> HTML 片段，最近使用的在末尾
+        self.dirty = False
+
+        # 统计信息，用于调整缓存容量
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(message_id, text):
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        return f"{message_id}:{digest}"
+
+    def render(self, message_id, text):
+        """返回 markdown(text)，命中缓存时不重新渲染"""
+        key = self.make_key(message_id, text)
+        html = self.entries.get(key)
+        if html is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+        self.misses += 1
+        html = markdown(text)
+        self.entries[key] = html
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.dirty = True
+        return html
+
+    def load(self):
+        """从磁盘加载缓存，文件不存在、损坏或版本不符时从空缓存开始"""
+        try:
+            if not os.path.exists(self.cache_file):
+                return
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != self.VERSION:
+                return
+            for key, html in data.get('entries', [])[-self.max_entries:]:
+                self.entries[key] = html
+            logging.info(f"已加载 {len(self.entries)} 条 Markdown 渲染缓存")
+        except Exception as e:
+            logging.error(f"加载 Markdown 渲染缓存时出错: {e}")
+
+    def save(self):
+        """有新的渲染结果时写回磁盘，先写临时文件再替换，避免中途退出留下损坏的缓存"""
+        if not self.dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            temp_file = f"{self.cache_file}.tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump({'version': self.VERSION, 'entries': list(self.entries.items())}, f, ensure_ascii=False)
+            os.replace(temp_file, self.cache_file)
+            self.dirty = False
+        except Exception as e:
+            logging.error(f"保存 Markdown 渲染缓存时出错: {e}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+
 class MessagePollWorker(QThread):
     """消息轮询工作线程"""
     message_received = pyqtSignal(dict)
     error_occurred = pyqtSignal(str)
+    poll_succeeded = pyqtSignal()  # 每次成功收到服务端响应（200/304 或推送连接建立）
+
+    # 每隔多少次增量轮询做一次全量同步，用于纠正服务端删除等增量无法感知的变化
+    FULL_SYNC_INTERVAL = 30
+    POLL_INTERVAL = 10  # 轮询间隔（秒）
+
+    # 推送连接配置
+    STREAM_ENABLED = True
+    STREAM_READ_TIMEOUT = 45  # 服务端每15秒发送一次心跳，超过该时间无数据视为连接断开
+    STREAM_MAX_SECONDS = 300  # 单条推送连接的最长保持时间，到期后做一次全量同步再重连
+    STREAM_RETRY_SECONDS = 60  # 推送连接断开后先回退为轮询，间隔该时间再尝试重连
+    STREAM_UNSUPPORTED_RETRY_SECONDS = 600  # 服务端不支持推送时的重试间隔
+
+    # 被服务端限流（429）时按 Retry-After 延长轮询间隔，连续被限流时间隔加倍，直到该上限
+    RATE_LIMIT_MAX_BACKOFF = 300
+
+    # 请求紧凑响应格式：只返回用到的字段、整数时间戳，安装了 msgpack 时优先使用 MessagePack 编码
+    COMPACT_FORMAT = True
 
     def __init__(self, server_url, agent_id, filter_conditions):
         super().__init__()
@@ -38,15 +327,36 @@ class MessagePollWorker(QThread):
         self.running = True
         self.session = None
 
+        # 增量同步状态：本地持有的消息列表（按 id 倒序）与已见过的最大 id
+        self.messages = []
+        self.last_id = 0
+        self.polls_since_full_sync = 0
+        self.synced = False
+
+        # 条件请求状态：分别记录全量请求与增量请求最近一次响应的 ETag
+        self.full_etag = None
+        self.delta_etag = None
+        self.delta_etag_since = None
+
+        # 推送连接状态
+        self.stream_response = None
+        self.stream_retry_at = 0.0
+
+        # 限流退避：大于 0 时代替 POLL_INTERVAL 作为下一次轮询的等待时间
+        self.backoff = 0
+
+        # 出错后界面会显示错误提示，恢复后即使消息没有变化也要重新发送完整列表
+        self.needs_full_emit = False
+
     def setup_session(self):
         """设置请求会话"""
         self.session = requests.Session()
 
-        # 配置重试策略
+        # 配置重试策略；429 不在此重试，由 poll_once 按 Retry-After 退避
         retry_strategy = Retry(
             total=3,
             backoff_factor=1,
-            status_forcelist=[429, 500, 502, 503, 504],
+            status_forcelist=[500, 502, 503, 504],
         )
         adapter = HTTPAdapter(max_retries=retry_strategy)
         self.session.mount("http://", adapter)
@@ -54,63 +364,258 @@ class MessagePollWorker(QThread):
 
         # 设置请求头
         self.session.headers.update({
-            'User-Agent': 'Education-Clock-Client/1.0'
+            'User-Agent': 'Education-Clock-Client/1.0',
+            'X-Client-Id': load_client_id()
         })
+        if self.COMPACT_FORMAT and msgpack is not None:
+            self.session.headers['Accept'] = 'application/x-msgpack, application/json;q=0.9'
+
+
+    def build_params(self):
+        """构建请求参数，已完成首次同步后只请求新增消息"""
+        params = {
+            'agent_id': self.agent_id
+        }
+
+        if 'sender_names' in self.filter_conditions and self.filter_conditions['sender_names']:
+            params['sender_names'] = ','.join(self.filter_conditions['sender_names'])
+
+        if 'conversation_titles' in self.filter_conditions and self.filter_conditions[
+            'conversation_titles']:
+            params['conversation_titles'] = ','.join(self.filter_conditions['conversation_titles'])
+
+        if self.COMPACT_FORMAT:
+            params['format'] = 'compact'
+
+        if self.synced and self.polls_since_full_sync < self.FULL_SYNC_INTERVAL:
+            params['since_id'] = self.last_id
+        return params
+
+    @staticmethod
+    def decode_response(response):
+        """按 Content-Type 解码响应体，旧版服务端忽略 format 参数时返回普通 JSON"""
+        if msgpack is not None and response.headers.get('Content-Type', '').startswith('application/x-msgpack'):
+            return msgpack.unpackb(response.content, raw=False)
+        return response.json()
+
+    def merge_messages(self, rows, full_sync):
+        """将服务器返回的消息合并到本地列表，返回本地列表是否发生变化"""
+        if full_sync:
+            changed = not self.synced or [row.get('id') for row in rows] != [row.get('id') for row in self.messages]
+            merged = list(rows)
+            self.polls_since_full_sync = 0
+        else:
+            known_ids = {row.get('id') for row in self.messages}
+            new_rows = [row for row in rows if row.get('id') not in known_ids]
+            changed = bool(new_rows)
+            merged = new_rows + self.messages
+            self.polls_since_full_sync += 1
+
+        # 淘汰超出时间窗口的消息
+        cutoff = datetime.now() - timedelta(days=MESSAGE_WINDOW_DAYS)
+        kept = []
+        for row in merged:
+            dt = parse_message_time(row.get('timestamp'))
+            if dt is not None and dt < cutoff:
+                changed = True
+                continue
+            kept.append(row)
+
+        kept.sort(key=lambda row: row.get('id', 0), reverse=True)
+        self.messages = kept
+        if kept:
+            self.last_id = max(self.last_id, kept[0].get('id', 0))
+        self.synced = True
+        return changed
+
+    def publish(self, changed):
+        """消息列表有变化，或界面在出错后需要恢复显示时，发送完整消息列表"""
+        if changed or self.needs_full_emit:
+            self.needs_full_emit = False
+            self.message_received.emit({"type": "messages", "data": list(self.messages)})
+
+    def report_error(self, error_msg):
+        self.needs_full_emit = True
+        self.error_occurred.emit(error_msg)
+
+    def poll_once(self):
+        """发起一次轮询请求"""
+        try:
+            # 构建URL参数
+            params = self.build_params()
+            full_sync = 'since_id' not in params
+
+            url = f"{self.server_url}/api/messages"
+            logging.info(f"发送轮询请求到: {url}")
+            logging.debug(f"请求参数: {params}")
+
+            # 带上同一请求上次响应的 ETag，内容未变化时服务端返回 304
+            headers = {}
+            if full_sync and self.full_etag:
+                headers['If-None-Match'] = self.full_etag
+            elif not full_sync and self.delta_etag and self.delta_etag_since == params['since_id']:
+                headers['If-None-Match'] = self.delta_etag
+
+            # 发起请求
+            response = self.session.get(
+                url,
+                params=params,
+                headers=headers,
+                timeout=(10, 30),  # 连接超时10秒，读取超时30秒
+            )
+
+            logging.info(f"收到响应，状态码: {response.status_code}")
+            if response.status_code == 429:
+                self.backoff = min(max(parse_retry_after(response, self.POLL_INTERVAL), self.backoff * 2,
+                                       self.POLL_INTERVAL), self.RATE_LIMIT_MAX_BACKOFF)
+                logging.warning(f"请求过于频繁，被服务端限流，{self.backoff}秒后重试")
+                return
+            self.backoff = 0
+
+            if response.status_code in (200, 304):
+                self.poll_succeeded.emit()
+
+            if response.status_code == 304:
+                # 内容未变化，跳过解析、格式化与重新渲染，仅淘汰本地超出时间窗口的消息
+                self.publish(self.merge_messages([], False))
+                if full_sync:
+                    self.polls_since_full_sync = 0
+            elif response.status_code == 200:
+                data = self.decode_response(response)
+                logging.debug(f"响应数据: {data}")
+                rows = decode_compact_rows(data)
+                # 旧版服务端不识别 since_id，总是返回全量数据
+                if data.get("mode", "full") == "full":
+                    full_sync = True
+
+                etag = response.headers.get('ETag')
+                if full_sync:
+                    self.full_etag = etag
+                else:
+                    self.delta_etag = etag
+                    self.delta_etag_since = params['since_id']
+
+                self.publish(self.merge_messages(rows, full_sync))
+            else:
+                logging.error(f"请求失败，状态码: {response.status_code}, 响应内容: {response.text}")
+                self.report_error(f"请求失败，状态码: {response.status_code}")
+
+        except Exception as e:
+            logging.error(f"轮询错误: {str(e)}", exc_info=True)
+            self.report_error(f"轮询错误: {str(e)}")
+
+    def can_stream(self):
+        """是否可以尝试建立推送连接（需先完成一次全量同步）"""
+        return self.STREAM_ENABLED and self.synced and time.time() >= self.stream_retry_at
+
+    def stream_messages(self):
+        """保持推送连接并合并收到的消息，连接正常到期返回 True，断开或出错返回 False"""
+        params = self.build_params()
+        params['since_id'] = self.last_id
+        url = f"{self.server_url}/api/messages/stream"
+        started = time.time()
+        response = None
+        logging.info(f"建立推送连接: {url}")
+
+        try:
+            response = self.session.get(
+                url,
+                params=params,
+                stream=True,
+                timeout=(10, self.STREAM_READ_TIMEOUT),
+            )
+            if response.status_code in (429, 503):
+                # 被限流或服务端推送连接数已满
+                retry_after = parse_retry_after(response, self.STREAM_RETRY_SECONDS)
+                logging.warning(f"推送连接被服务端拒绝（{response.status_code}），{retry_after}秒后重试，期间回退为轮询")
+                self.stream_retry_at = time.time() + max(retry_after, self.STREAM_RETRY_SECONDS)
+                return False
+            if response.status_code != 200:
+                logging.warning(f"服务端不支持推送连接，状态码: {response.status_code}，回退为轮询")
+                self.stream_retry_at = time.time() + self.STREAM_UNSUPPORTED_RETRY_SECONDS
+                return False
+
+            self.stream_response = response
+            self.poll_succeeded.emit()
+            self.publish(False)
+            response.encoding = 'utf-8'
+            event_type, data_lines = None, []
+            # 服务端以 chunked 方式发送，每个事件到达即可读出
+            for line in response.iter_lines(chunk_size=1024, decode_unicode=True):
+                if not self.running:
+                    return True
+                if line == '':
+                    # 空行表示一个事件结束
+                    if event_type == 'messages' and data_lines:
+                        rows = json.loads('\n'.join(data_lines))
+                        if isinstance(rows, dict):
+                            rows = decode_compact_rows(rows)
+                        logging.info(f"推送连接收到 {len(rows)} 条消息")
+                        self.publish(self.merge_messages(rows, False))
+                    elif event_type == 'error':
+                        logging.warning(f"推送连接返回错误: {data_lines}")
+                        return False
+                    event_type, data_lines = None, []
+                    if time.time() - started >= self.STREAM_MAX_SECONDS:
+                        return True
+                    continue
+                if line.startswith(':'):
+                    continue  # 心跳
+
+                field, _, value = line.partition(':')
+                if value.startswith(' '):
+                    value = value[1:]
+                if field == 'event':
+                    event_type = value
+                elif field == 'data':
+                    data_lines.append(value)
+
+            logging.warning("推送连接被服务端关闭")
+            return False
+        except Exception as e:
+            if self.running:
+                logging.warning(f"推送连接断开: {str(e)}")
+            return not self.running
+        finally:
+            self.stream_response = None
+            if response is not None:
+                response.close()
+
+    def wait_interval(self):
+        """等待下一次轮询，期间可被 stop() 打断；被限流时等待退避时间"""
+        interval = max(self.POLL_INTERVAL, self.backoff)
+        logging.info(f"等待{interval}秒后进行下一次轮询")
+        for _ in range(int(interval * 10)):
+            if not self.running:
+                break
+            time.sleep(0.1)
 
     def run(self):
-        """运行消息轮询"""
+        """运行消息轮询，首次全量同步后优先使用推送连接，断开时自动回退为轮询"""
         try:
             # 设置会话
             self.setup_session()
 
             while self.running:
-                try:
-                    # 构建URL参数
-                    params = {
-                        'agent_id': self.agent_id
-                    }
-
-                    if 'sender_names' in self.filter_conditions and self.filter_conditions['sender_names']:
-                        params['sender_names'] = ','.join(self.filter_conditions['sender_names'])
-
-                    if 'conversation_titles' in self.filter_conditions and self.filter_conditions[
-                        'conversation_titles']:
-                        params['conversation_titles'] = ','.join(self.filter_conditions['conversation_titles'])
-
-                    url = f"{self.server_url}/api/messages"
-                    logging.info(f"发送轮询请求到: {url}")
-                    logging.debug(f"请求参数: {params}")
-
-                    # 发起请求
-                    response = self.session.get(
-                        url,
-                        params=params,
-                        timeout=(10, 30),  # 连接超时10秒，读取超时30秒
-                    )
-
-                    logging.info(f"收到响应，状态码: {response.status_code}")
-                    if response.status_code == 200:
-                        data = response.json()
-                        logging.info(f"响应数据: {data}")
-                        self.message_received.emit(data)
-                    else:
-                        logging.error(f"请求失败，状态码: {response.status_code}, 响应内容: {response.text}")
-                        self.error_occurred.emit(f"请求失败，状态码: {response.status_code}")
-
-                except Exception as e:
-                    logging.error(f"轮询错误: {str(e)}", exc_info=True)
-                    self.error_occurred.emit(f"轮询错误: {str(e)}")
-
-                # 等待10秒后再次轮询
-                logging.info("等待10秒后进行下一次轮询")
-                for _ in range(200):  # 10秒 = 100 * 0.1秒
+                if self.can_stream():
+                    if self.stream_messages():
+                        if not self.running:
+                            break
+                        # 连接到期，全量同步一次后重新建立连接
+                        self.polls_since_full_sync = self.FULL_SYNC_INTERVAL
+                        self.poll_once()
+                        continue
+                    if self.stream_retry_at <= time.time():
+                        self.stream_retry_at = time.time() + self.STREAM_RETRY_SECONDS
                     if not self.running:
                         break
-                    time.sleep(0.1)
+
+                self.poll_once()
+                self.wait_interval()
 
         except Exception as e:
             logging.error(f"连接错误: {str(e)}", exc_info=True)
-            self.error_occurred.emit(f"连接错误: {str(e)}")
+            self.report_error(f"连接错误: {str(e)}")
         finally:
             if self.session:
                 self.session.close()
@@ -118,64 +623,281 @@ class MessagePollWorker(QThread):
     def stop(self):
         """停止工作线程"""
         self.running = False
+        # 关闭推送连接以打断阻塞中的读取
+        response = self.stream_response
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
 
 
-class DownloadWorker(QThread):
-    """文件下载工作线程"""
-    download_finished = pyqtSignal(str, str, str, str, str, bool,
-                                   str)  # 文件路径, 文件名, 原始消息, sender_name, created_at, 是否成功, 错误信息
+class DownloadTask:
+    """一个待下载的附件，priority 越大越先下载（使用消息 id，最新的消息优先）"""
 
-    def __init__(self, url, message, sender_name, created_at, download_dir="./data/download/"):
-        super().__init__()
+    __slots__ = ('url', 'filename', 'host', 'priority', 'seq', 'attempts')
+
+    def __init__(self, url, filename, priority, seq):
         self.url = url
-        self.message = message
-        self.sender_name = sender_name
-        self.created_at = created_at
-        self.filename = os.path.basename(url.split('?')[0])
+        self.filename = filename
+        self.host = urlsplit(url).netloc
+        self.priority = priority
+        self.seq = seq
+        self.attempts = 0
+
+    def sort_key(self):
+        return -self.priority, self.seq
+
+
+class DownloadThread(QThread):
+    """下载管理器的工作线程，循环领取任务直到管理器停止"""
+
+    def __init__(self, manager):
+        super().__init__()
+        self.manager = manager
+
+    def run(self):
+        self.manager.run_worker()
+
+
+class DownloadManager(QObject):
+    """附件下载管理器
+
+    所有下载共用一个带连接池和重试策略的会话，最多同时下载 MAX_CONCURRENT 个文件，同一主机最多
+    MAX_PER_HOST 个；等待中的任务按消息 id 从新到旧领取。每个文件下载完成即发出 download_finished，
+    不必等待整个队列
+    """
+    download_progress = pyqtSignal(str, int, int)  # URL, 已下载字节数, 总字节数（未知时为 0）
+    download_finished = pyqtSignal(str, str, bool, str)  # URL, 文件路径, 是否成功, 错误信息
+
+    MAX_CONCURRENT = 4
+    MAX_PER_HOST = 2
+    PROGRESS_INTERVAL = 0.5  # 进度信号的最小间隔（秒）
+    MAX_ATTEMPTS = 5  # 超时、5xx 等可恢复的失败最多尝试次数，期间条目仍显示“下载中...”
+    RETRY_BASE_DELAY = 5  # 第一次重试前等待的秒数，之后每次加倍
+    RETRY_MAX_DELAY = 300
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, download_dir=DOWNLOAD_DIR, max_concurrent=MAX_CONCURRENT, max_per_host=MAX_PER_HOST):
+        super().__init__()
         self.download_dir = download_dir
+        self.max_concurrent = max_concurrent
+        self.max_per_host = max_per_host
         os.makedirs(self.download_dir, exist_ok=True)
 
-    def run(self):
-        """执行文件下载任务"""
-        file_path = os.path.join(self.download_dir, self.filename)
+        self.session = self.create_session()
+        self.condition = threading.Condition()
+        self.pending = []  # 等待中的 DownloadTask
+        self.active = {}  # 文件名 -> 正在下载的 DownloadTask
+        self.retrying = {}  # 文件名 -> 等待重试的 DownloadTask
+        self.host_active = {}  # 主机 -> 正在下载的任务数
+        self.threads = []
+        self.seq = 0
+        self.running = True
+
+    def create_session(self):
+        """创建共享会话，连接池大小与并发数一致"""
+        session = requests.Session()
+        retry_strategy = Retry(
+            total=3,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+        )
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=self.max_concurrent,
+                              pool_maxsize=self.max_concurrent)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        # 不接受压缩编码，保证 Content-Length 和 Range 按文件字节计算
+        session.headers.update({
+            'User-Agent': 'Education-Clock-Client/1.0',
+            'Accept-Encoding': 'identity'
+        })
+        return session
+
+    def submit(self, url, priority=0):
+        """加入下载队列，同名文件已在队列中或正在下载时只更新优先级"""
+        filename = DownloadIndex.filename_for(url)
+        with self.condition:
+            if not self.running or filename in self.active or filename in self.retrying:
+                return False
+            for task in self.pending:
+                if task.filename == filename:
+                    task.priority = max(task.priority, priority)
+                    return False
+            self.seq += 1
+            self.pending.append(DownloadTask(url, filename, priority, self.seq))
+            self.condition.notify()
+            # 按需启动工作线程
+            if len(self.threads) < self.max_concurrent and len(self.threads) < len(self.pending) + len(self.active):
+                thread = DownloadThread(self)
+                self.threads.append(thread)
+                thread.start()
+        return True
+
+    def next_task(self):
+        """领取优先级最高、且所在主机未达到并发上限的任务；管理器停止时返回 None"""
+        with self.condition:
+            while self.running:
+                ready = [task for task in self.pending if self.host_active.get(task.host, 0) < self.max_per_host]
+                if ready:
+                    task = min(ready, key=DownloadTask.sort_key)
+                    self.pending.remove(task)
+                    task.attempts += 1
+                    self.active[task.filename] = task
+                    self.host_active[task.host] = self.host_active.get(task.host, 0) + 1
+                    return task
+                self.condition.wait()
+            return None
+
+    def task_done(self, task):
+        with self.condition:
+            self.active.pop(task.filename, None)
+            self.host_active[task.host] -= 1
+            if not self.host_active[task.host]:
+                del self.host_active[task.host]
+            self.condition.notify_all()
+
+    def run_worker(self):
+        while True:
+            task = self.next_task()
+            if task is None:
+                return
+            try:
+                self.download(task)
+            finally:
+                self.task_done(task)
+
+    def download(self, task):
+        """下载一个文件并发出完成信号
+
+        数据先写入 <文件名>.part，中断后下次从已下载的位置用 Range 续传；长度（以及服务端镜像文件名中的
+        sha256）校验通过后才重命名为正式文件，格式化时看到的文件总是完整的
+        """
+        file_path = os.path.join(self.download_dir, task.filename)
         if os.path.exists(file_path):
             logging.info(f"文件已存在，跳过下载: {file_path}")
-            self.download_finished.emit(file_path, self.filename, self.message, self.sender_name, self.created_at, True,
-                                        "")
+            self.download_finished.emit(task.url, file_path, True, "")
             return
 
+        part_path = f"{file_path}.part"
         try:
-            # 配置请求会话，增加重试机制
-            session = requests.Session()
-            retry_strategy = Retry(
-                total=3,
-                backoff_factor=1,
-                status_forcelist=[429, 500, 502, 503, 504],
-            )
-            adapter = HTTPAdapter(max_retries=retry_strategy)
-            session.mount("http://", adapter)
-            session.mount("https://", adapter)
-
-            response = session.get(self.url, stream=True, timeout=30)
-            response.raise_for_status()
-            with open(file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            self.fetch(task, part_path)
+            self.verify(task, part_path)
+            os.replace(part_path, file_path)
             logging.info(f"文件下载成功: {file_path}")
-            self.download_finished.emit(file_path, self.filename, self.message, self.sender_name, self.created_at, True,
-                                        "")
+            self.download_finished.emit(task.url, file_path, True, "")
         except requests.exceptions.HTTPError as e:
             error_msg = str(e)
-            if e.response.status_code == 403:
+            status_code = e.response.status_code
+            if status_code == 403:
                 error_msg = "403 请求已达上限"
-            logging.error(f"下载文件失败 {self.url}: {error_msg}")
-            self.download_finished.emit(file_path, self.filename, self.message, self.sender_name, self.created_at,
-                                        False, error_msg)
+            # 除超时和限流外的 4xx 重试也不会成功
+            self.fail(task, file_path, error_msg, retryable=status_code >= 500 or status_code in (408, 429))
         except Exception as e:
-            error_msg = str(e)
-            logging.error(f"下载文件失败 {self.url}: {error_msg}")
-            self.download_finished.emit(file_path, self.filename, self.message, self.sender_name, self.created_at,
-                                        False, error_msg)
+            self.fail(task, file_path, str(e), retryable=True)
+
+    def fail(self, task, file_path, error_msg, retryable):
+        """可恢复的失败按指数退避稍后重试，临时文件中已下载的数据会续传；其余失败发出完成信号"""
+        if retryable and self.running and task.attempts < self.MAX_ATTEMPTS:
+            delay = min(self.RETRY_BASE_DELAY * 2 ** (task.attempts - 1), self.RETRY_MAX_DELAY)
+            logging.warning(f"下载文件失败 {task.url}: {error_msg}，{delay}秒后第 {task.attempts + 1} 次尝试")
+            with self.condition:
+                self.retrying[task.filename] = task
+            timer = threading.Timer(delay, self.requeue, args=(task,))
+            timer.daemon = True
+            timer.start()
+            return
+        logging.error(f"下载文件失败 {task.url}: {error_msg}")
+        self.download_finished.emit(task.url, file_path, False, error_msg)
+
+    def requeue(self, task):
+        with self.condition:
+            self.retrying.pop(task.filename, None)
+            if not self.running:
+                return
+            self.pending.append(task)
+            self.condition.notify()
+
+    def fetch(self, task, part_path):
+        """下载到临时文件，已有部分数据时请求剩余部分；长度不足时保留临时文件以便续传"""
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f"bytes={offset}-"} if offset else {}
+
+        with self.session.get(task.url, stream=True, timeout=30, headers=headers) as response:
+            if response.status_code == 416:
+                # 临时文件已完整或与服务端文件不一致，按 Content-Range 中的总长度判断
+                total = parse_content_range(response.headers.get('Content-Range'))[2]
+                if total is not None and total == offset:
+                    return
+                os.remove(part_path)
+                raise RuntimeError("续传位置无效，已删除临时文件，将重新下载")
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                start, _, total = parse_content_range(response.headers.get('Content-Range'))
+                if start != offset:
+                    os.remove(part_path)
+                    raise RuntimeError(f"续传位置不一致: 请求 {offset}，返回 {start}，已删除临时文件")
+                mode = 'ab'
+                logging.info(f"从 {offset} 字节处续传: {task.url}")
+            else:
+                # 服务端不支持 Range 时返回完整内容，从头写入
+                offset, mode = 0, 'wb'
+                total = int(response.headers['Content-Length']) if response.headers.get('Content-Length') else None
+
+            received = offset
+            last_progress = time.monotonic()
+            self.download_progress.emit(task.url, received, total or 0)
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                    if not self.running:
+                        raise RuntimeError("下载已取消")
+                    f.write(chunk)
+                    received += len(chunk)
+                    if time.monotonic() - last_progress >= self.PROGRESS_INTERVAL:
+                        last_progress = time.monotonic()
+                        self.download_progress.emit(task.url, received, total or 0)
+            self.download_progress.emit(task.url, received, total or 0)
+
+        if total is not None and received != total:
+            if received > total:
+                os.remove(part_path)
+            raise RuntimeError(f"下载不完整: {received}/{total} 字节")
+
+    @staticmethod
+    def verify(task, part_path):
+        """服务端镜像的附件以内容 sha256 命名（/media/<sha256><扩展名>），据此校验文件内容"""
+        expected = os.path.splitext(task.filename)[0].lower()
+        if not SHA256_NAME_PATTERN.fullmatch(expected):
+            return
+        digest = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        if digest.hexdigest() != expected:
+            os.remove(part_path)
+            raise RuntimeError("文件校验失败，已删除，将重新下载")
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "active": len(self.active),
+                "retrying": len(self.retrying),
+                "threads": len(self.threads)
+            }
+
+    def stop(self, timeout_ms=3000):
+        """停止领取新任务，等待工作线程结束并关闭会话"""
+        with self.condition:
+            self.running = False
+            self.pending.clear()
+            self.retrying.clear()
+            self.condition.notify_all()
+        for thread in self.threads:
+            if thread.isRunning() and not thread.wait(timeout_ms):
+                logging.warning("下载线程未能及时结束")
+        self.session.close()
 
 
 class DanmakuWindow(QWidget):
@@ -256,7 +978,155 @@ class DanmakuWindow(QWidget):
         self.close()
 
 
+class IncrementalRenderer:
+    """公告板增量渲染器
+
+    每条消息作为文档中的一个 QTextFrame 插入，并记住它的 HTML 片段。收到新的消息列表时只插入新消息、
+    移除已淘汰的消息、替换内容有变化的消息，不再每次 setHtml 重新排版整个文档和重置滚动位置
+    """
+
+    def __init__(self, text_browser):
+        self.text_browser = text_browser
+        self.order = []  # 文档中的消息 id，与显示顺序一致
+        self.frames = {}  # 消息 id -> QTextFrame
+        self.fragments = {}  # 消息 id -> 已插入的 HTML 片段
+        self.active = False  # 文档内容是否由渲染器维护，显示提示文本后需要重建
+
+    def reset(self):
+        """文档被 setHtml 整体替换后调用，下次渲染时重建"""
+        self.order = []
+        self.frames.clear()
+        self.fragments.clear()
+        self.active = False
+
+    def render(self, rows, format_row):
+        """按消息列表（id 倒序）更新文档，format_row(row) 返回单条消息的 HTML 片段"""
+        ids = [row.get('id') for row in rows]
+        if not self.active or None in ids or len(set(ids)) != len(ids):
+            self.rebuild(rows, format_row)
+            return
+
+        # 已显示消息的相对顺序发生变化时无法增量更新，直接重建
+        wanted = set(ids)
+        kept = [message_id for message_id in self.order if message_id in wanted]
+        if kept != [message_id for message_id in ids if message_id in self.frames]:
+            self.rebuild(rows, format_row)
+            return
+
+        # 用户向下滚动查看时，记住当前可见区域上方第一条保留消息的位置，插入新消息后保持视野不跳动
+        scrollbar = self.text_browser.verticalScrollBar()
+        scroll_value = scrollbar.value()
+        anchor = self.frames[kept[0]] if kept and scroll_value > 0 else None
+        anchor_top = self.frame_top(anchor) if anchor is not None else 0
+
+        cursor = QTextCursor(self.text_browser.document())
+        cursor.beginEditBlock()
+        try:
+            for message_id in self.order:
+                if message_id not in wanted:
+                    self.remove_frame(cursor, self.frames.pop(message_id))
+                    self.fragments.pop(message_id, None)
+
+            # 从最旧的消息向上处理，新消息插入到下一条已显示消息之前
+            next_frame = None
+            for row, message_id in zip(reversed(rows), reversed(ids)):
+                html = format_row(row)
+                frame = self.frames.get(message_id)
+                if frame is None:
+                    frame = self.insert_frame(cursor, next_frame, html)
+                    self.frames[message_id] = frame
+                    self.fragments[message_id] = html
+                elif html != self.fragments[message_id]:
+                    self.replace_frame(cursor, frame, html)
+                    self.fragments[message_id] = html
+                next_frame = frame
+        finally:
+            cursor.endEditBlock()
+        self.order = ids
+
+        if anchor is not None:
+            scrollbar.setValue(scroll_value + int(self.frame_top(anchor) - anchor_top))
+
+    def refresh(self, rows, format_row):
+        """重新格式化指定的消息，只替换内容有变化且仍在文档中的条目"""
+        if not self.active:
+            return
+        cursor = QTextCursor(self.text_browser.document())
+        cursor.beginEditBlock()
+        try:
+            for row in rows:
+                message_id = row.get('id')
+                frame = self.frames.get(message_id)
+                if frame is None:
+                    continue
+                html = format_row(row)
+                if html != self.fragments[message_id]:
+                    self.replace_frame(cursor, frame, html)
+                    self.fragments[message_id] = html
+        finally:
+            cursor.endEditBlock()
+
+    def rebuild(self, rows, format_row):
+        """清空文档并按顺序插入全部消息"""
+        document = self.text_browser.document()
+        document.setUndoRedoEnabled(False)
+        document.clear()
+        self.reset()
+
+        cursor = QTextCursor(document)
+        cursor.beginEditBlock()
+        try:
+            for row in rows:
+                html = format_row(row)
+                frame = self.insert_frame(cursor, None, html)
+                self.frames[row.get('id')] = frame
+                self.fragments[row.get('id')] = html
+        finally:
+            cursor.endEditBlock()
+
+        ids = [row.get('id') for row in rows]
+        self.order = ids
+        # 缺少 id 或 id 重复时无法按 id 定位消息，下次仍然重建
+        self.active = None not in ids and len(set(ids)) == len(ids)
+
+    @staticmethod
+    def frame_format():
+        frame_format = QTextFrameFormat()
+        frame_format.setBorder(0)
+        frame_format.setMargin(0)
+        frame_format.setPadding(0)
+        return frame_format
+
+    def insert_frame(self, cursor, before, html):
+        """在 before 之前插入一条消息，before 为 None 时追加到文档末尾"""
+        if before is None:
+            cursor.movePosition(QTextCursor.MoveOperation.End)
+        else:
+            cursor.setPosition(before.firstPosition() - 1)
+        frame = cursor.insertFrame(self.frame_format())
+        cursor.insertHtml(html)
+        return frame
+
+    @staticmethod
+    def replace_frame(cursor, frame, html):
+        cursor.setPosition(frame.firstPosition())
+        cursor.setPosition(frame.lastPosition(), QTextCursor.MoveMode.KeepAnchor)
+        cursor.insertHtml(html)
+
+    @staticmethod
+    def remove_frame(cursor, frame):
+        cursor.setPosition(frame.firstPosition() - 1)
+        cursor.setPosition(frame.lastPosition() + 1, QTextCursor.MoveMode.KeepAnchor)
+        cursor.removeSelectedText()
+
+    def frame_top(self, frame):
+        return self.text_browser.document().documentLayout().frameBoundingRect(frame).top()
+
+
 class BulletinBoardModule:
+    DOWNLOAD_RETRY_INTERVAL = 600  # 定期重新提交失败下载的间隔（秒），403 链接过期的不再重试
+    MARKDOWN_CACHE_SAVE_DELAY = 60  # Markdown 渲染缓存有变化后延迟写盘的时间（秒），期间的多次变化只写一次
+
     def __init__(self, main_window, text_browser):
         try:
             logging.info("开始初始化 BulletinBoardModule")
@@ -277,6 +1147,10 @@ class BulletinBoardModule:
                 raise ValueError("text_browser 不是有效的 QTextBrowser 对象")
 
             self.text_browser.setOpenLinks(False)  # 禁止自动打开链接
+            self.renderer = IncrementalRenderer(self.text_browser)
+            self.markdown_cache = MarkdownCache()
+            self.markdown_cache.load()
+            self.format_context = FormattingContext(self.get_qss_path, self.parse_qss_colors)
             self.text_browser.anchorClicked.connect(self.handle_anchor_clicked)  # 连接点击信号
 
             self.last_message_text = ""
@@ -287,9 +1161,20 @@ class BulletinBoardModule:
                 logging.warning(f"无法加载提示音: {e}")
 
             # 添加下载相关属性
-            self.download_queue = Queue()
-            self.current_download = None
             self.failed_urls = self.load_failed_urls()  # 加载失败的URL记录
+            self.current_messages = []  # 当前显示的消息，附件下载完成后用于刷新对应条目
+            self.download_manager = DownloadManager()
+            self.download_manager.download_progress.connect(self.on_download_progress)
+            self.download_manager.download_finished.connect(self.on_download_finished)
+            # 下载管理器放弃重试后（如服务器长时间不可用），定期重新提交未完成的附件
+            self.download_retry_timer = QTimer()
+            self.download_retry_timer.timeout.connect(self.retry_failed_downloads)
+            self.download_retry_timer.start(self.DOWNLOAD_RETRY_INTERVAL * 1000)
+
+            # 渲染缓存写盘会重写整个文件，合并到单次定时器中执行，不在每次渲染后占用界面线程
+            self.markdown_cache_save_timer = QTimer()
+            self.markdown_cache_save_timer.setSingleShot(True)
+            self.markdown_cache_save_timer.timeout.connect(self.markdown_cache.save)
 
             # 消息轮询相关变量
             self.poll_thread = None
@@ -336,7 +1221,7 @@ class BulletinBoardModule:
     def get_qss_path(self):
         """获取 QSS 文件路径"""
         default_qss = './ui/qss/dark.qss'
-        qss_txt_path = './data/qss.txt'
+        qss_txt_path = QSS_TXT_PATH
         if not os.path.exists(qss_txt_path):
             return default_qss
         try:
@@ -376,62 +1261,58 @@ class BulletinBoardModule:
             logging.error(f"保存失败URL记录时出错: {e}")
 
     def process_downloads(self, rows):
-        """处理新消息中的下载任务"""
-        pattern = re.compile(r'&\[(.*?)\]&')
+        """处理新消息中的下载任务，最新的消息优先下载"""
+        downloads = self.format_context.downloads
+        downloads.refresh_if_changed()
         for row in rows:
-            message_content = row.get('message_content', '')
-            sender_name = row.get('sender_name', '未知发送者')
-
-            # 处理时间格式
-            created_at = "未知时间"
-            timestamp_value = row.get('timestamp')
-            if timestamp_value:
-                try:
-                    if isinstance(timestamp_value, str):
-                        if timestamp_value.endswith(' GMT'):
-                            dt = datetime.strptime(timestamp_value, "%a, %d %b %Y %H:%M:%S GMT")
-                        else:
-                            dt = datetime.strptime(timestamp_value, "%Y-%m-%d %H:%M:%S")
-                    else:
-                        dt = timestamp_value
-                    created_at = dt.strftime("%m-%d %H:%M")
-                except ValueError as e:
-                    logging.warning(f"时间格式解析错误: {e}")
-                    created_at = str(timestamp_value)
-
-            matches = pattern.findall(message_content)
-            for url in matches:
-                file_path = os.path.join("./data/download/", os.path.basename(url.split('?')[0]))
+            message_content = row.get('message_content') or ''
+            for url in ATTACHMENT_PATTERN.findall(message_content):
                 # 如果文件不存在且 URL 未标记为 403，则加入下载队列
-                if not os.path.exists(file_path) and (
+                if not downloads.contains(downloads.filename_for(url)) and (
                         url not in self.failed_urls or "403" not in self.failed_urls.get(url, "")):
-                    self.download_queue.put((url, message_content, sender_name, created_at))
-        self.start_next_download()
-
-    def start_next_download(self):
-        """启动下一个下载任务"""
-        if self.current_download is None and not self.download_queue.empty():
-            url, message, sender_name, created_at = self.download_queue.get()
-            self.current_download = DownloadWorker(url, message, sender_name, created_at)
-            self.current_download.download_finished.connect(self.on_download_finished)
-            self.current_download.start()
-
-    def on_download_finished(self, file_path, filename, original_message, sender_name, created_at, success, error_msg):
-        """下载完成后的处理"""
-        self.current_download = None
-        try:
-            url_match = re.search(r'&\[(.*?)\]&', original_message)
-            if url_match:
-                url = url_match.group(1)
-                if not success:
-                    self.failed_urls[url] = error_msg  # 记录失败原因
-                    self.save_failed_urls()  # 保存到文件
-                    logging.debug(f"记录失败 URL: {url} - {error_msg}")
+                    self.download_manager.submit(url, priority=row.get('id') or 0)
+
+    def retry_failed_downloads(self):
+        """重新提交当前消息中尚未下载完成的附件，已在队列中或正在重试的会被下载管理器忽略"""
+        try:
+            if self.current_messages:
+                self.process_downloads(self.current_messages)
         except Exception as e:
-            logging.error(f"处理下载完成状态时出错: {e}")
+            logging.error(f"重新提交下载任务时出错: {e}")
+
+    def on_download_progress(self, url, received, total):
+        """下载进度"""
+        if total:
+            logging.debug(f"下载进度 {url}: {received}/{total} ({received * 100 // total}%)")
+        else:
+            logging.debug(f"下载进度 {url}: {received} 字节")
 
-        # 启动下一个下载任务
-        self.start_next_download()
+    def on_download_finished(self, url, file_path, success, error_msg):
+        """单个文件下载完成后，立即刷新引用该文件的消息"""
+        try:
+            if success:
+                self.format_context.downloads.add(os.path.basename(file_path))
+                if self.failed_urls.pop(url, None) is not None:
+                    self.save_failed_urls()
+            else:
+                self.failed_urls[url] = error_msg  # 记录失败原因
+                self.save_failed_urls()  # 保存到文件
+                logging.debug(f"记录失败 URL: {url} - {error_msg}")
+                if "403" in error_msg:
+                    # 403 的链接不会再下载，删除续传用的临时文件
+                    try:
+                        os.remove(f"{file_path}.part")
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        logging.warning(f"删除临时文件失败: {file_path}.part - {e}")
+
+            rows = [row for row in self.current_messages if url in (row.get('message_content') or '')]
+            if rows:
+                self.renderer.refresh(rows, lambda row: self.format_message(row, self.format_context))
+                self.schedule_markdown_cache_save()
+        except Exception as e:
+            logging.error(f"处理下载完成状态时出错: {e}")
 
     def parse_qss_colors(self, qss_file):
         """解析 QSS 文件中的颜色"""
@@ -443,8 +1324,7 @@ class BulletinBoardModule:
 
             with open(qss_file, 'r', encoding='utf-8') as f:
                 qss_content = f.read()
-            pattern = re.compile(r'\.(\w+)\s*\{\s*color:\s*#([0-9a-fA-F]{6})\s*;\s*\}')
-            matches = pattern.findall(qss_content)
+            matches = QSS_COLOR_PATTERN.findall(qss_content)
             for match in matches:
                 css_class, hex_color = match
                 colors[css_class] = f"#{hex_color}"
@@ -452,117 +1332,16 @@ class BulletinBoardModule:
             logging.error(f"Error parsing QSS file: {e}")
         return colors
 
-    def load_theme(self):
-        """加载主题配置"""
-        try:
-            qss_path = self.get_qss_path()
-            return self.parse_qss_colors(qss_path)
-        except Exception as e:
-            logging.error(f"加载主题配置时出错: {e}")
-            # 返回默认颜色配置
-            return {
-                'sender': '#4cc2ff',
-                'admin-sender': '#ff6b6b'
-            }
-
     def format_messages(self, rows):
         """格式化消息"""
         try:
             logging.info(f"开始格式化 {len(rows)} 条消息")
-            formatted_text = ""
-            pattern = re.compile(r'&\[(.*?)\]&')
-
-            # 加载主题配置
-            try:
-                theme_config = self.load_theme()
-            except Exception as e:
-                logging.error(f"加载主题配置失败: {e}")
-                theme_config = {'sender': '#4cc2ff', 'admin-sender': '#ff6b6b'}
 
             if not rows:
                 return "<p style='text-align: center; color: gray;'>暂无符合条件的消息</p>"
 
-            for i, row in enumerate(rows):
-                try:
-                    logging.debug(f"处理第 {i + 1} 条消息: {row}")
-
-                    # 安全地获取字段值
-                    sender_name = str(row.get('sender_name', '未知发送者')) if row.get(
-                        'sender_name') is not None else '未知发送者'
-                    conversationTitle = str(row.get('conversationTitle', '未知群聊')) if row.get(
-                        'conversationTitle') is not None else '未知群聊'
-
-                    # 处理时间格式
-                    created_at = "未知时间"
-                    timestamp_value = row.get('timestamp')
-                    if timestamp_value:
-                        try:
-                            # 处理不同格式的时间戳
-                            if isinstance(timestamp_value, str):
-                                # 尝试解析 RFC 格式的时间戳
-                                if timestamp_value.endswith(' GMT'):
-                                    dt = datetime.strptime(timestamp_value, "%a, %d %b %Y %H:%M:%S GMT")
-                                else:
-                                    # 尝试解析常见的日期时间格式
-                                    dt = datetime.strptime(timestamp_value, "%Y-%m-%d %H:%M:%S")
-                            else:
-                                dt = timestamp_value
-                            created_at = dt.strftime("%m-%d %H:%M")
-                        except ValueError as e:
-                            logging.warning(f"时间格式解析错误: {e}")
-                            created_at = str(timestamp_value)
-
-                    # 安全地获取消息内容
-                    message_content = str(row.get('message_content', '')) if row.get(
-                        'message_content') is not None else ''
-
-                    css_class = 'admin-sender' if "管理组" in conversationTitle else 'sender'
-                    color = theme_config.get(css_class, '#4cc2ff')
-
-                    # 处理文件链接
-                    matches = pattern.findall(message_content)
-                    processed_message_content = message_content
-                    if matches:
-                        for url in matches:
-                            try:
-                                file_path = os.path.join("./data/download/", os.path.basename(url.split('?')[0]))
-                                file_url = QUrl.fromLocalFile(file_path).toString()
-                                if os.path.exists(file_path):
-                                    ext = os.path.splitext(file_path)[1].lower()
-                                    new_message = re.sub(r'&\[(.*?)\]&', '', processed_message_content).strip()
-                                    if ext in ['.png', '.jpg', '.jpeg', '.gif']:
-                                        processed_message_content = f"{new_message}<br><a href='{file_url}'><img src='{file_path}' style='max-width: 100%; width: auto; height: auto;'></a>"
-                                    else:
-                                        icon_path = "icon/file.png"
-                                        if os.path.exists(icon_path):
-                                            processed_message_content = f"{new_message}<br><a href='{file_url}'><img src='{icon_path}' width='128'></a>"
-                                        else:
-                                            processed_message_content = f"{new_message}<br><a href='{file_url}'>{os.path.basename(file_path)} (图标丢失)</a>"
-                                else:
-                                    # 检查是否是已知的失败URL
-                                    if url in self.failed_urls:
-                                        error_msg = self.failed_urls[url]
-                                        if "403" in error_msg:
-                                            processed_message_content = f"<span style='color: red;'>文件链接已过期，无法下载</span>"
-                                        else:
-                                            processed_message_content = f"<span style='color: red;'>下载失败: {error_msg}</span>"
-                                    else:
-                                        processed_message_content = "下载中..."
-                            except Exception as e:
-                                logging.error(f"处理文件链接时出错: {e}")
-                                processed_message_content = "[文件链接处理错误]"
-
-                    # 构建格式化的消息
-                    try:
-                        formatted_message = f"<b style='color:{color}; font-size:16px;'>{sender_name} ({created_at})</b>{markdown(processed_message_content)}<hr>"
-                        formatted_text += formatted_message
-                    except Exception as e:
-                        logging.error(f"构建格式化消息时出错: {e}")
-                        formatted_text += f"<p style='color: red;'>消息格式化错误: {str(e)}</p><hr>"
-
-                except Exception as e:
-                    logging.error(f"处理第 {i + 1} 条消息时出错: {e}", exc_info=True)
-                    formatted_text += f"<p style='color: red;'>消息处理错误: {str(e)}</p><hr>"
+            self.format_context.refresh()
+            formatted_text = "".join(self.format_message(row, self.format_context) for row in rows)
 
             logging.info(f"消息格式化完成，总长度: {len(formatted_text)}")
             return formatted_text
@@ -571,6 +1350,94 @@ class BulletinBoardModule:
             logging.error(f"格式化消息时发生严重错误: {e}", exc_info=True)
             return "<p style='color: red; text-align: center;'>消息格式化错误</p>"
 
+    def format_message(self, row, context):
+        """格式化单条消息，返回该消息的 HTML 片段；context 为本轮渲染前已 refresh() 的 FormattingContext"""
+        try:
+            # 安全地获取字段值
+            sender_name = str(row.get('sender_name', '未知发送者')) if row.get(
+                'sender_name') is not None else '未知发送者'
+            conversationTitle = str(row.get('conversationTitle', '未知群聊')) if row.get(
+                'conversationTitle') is not None else '未知群聊'
+
+            # 处理时间格式
+            created_at = "未知时间"
+            timestamp_value = row.get('timestamp')
+            if timestamp_value:
+                # 兼容紧凑格式的整数时间戳与 RFC/常见格式的字符串
+                dt = parse_message_time(timestamp_value)
+                if dt is not None:
+                    created_at = dt.strftime("%m-%d %H:%M")
+                else:
+                    logging.warning(f"时间格式解析错误: {timestamp_value}")
+                    created_at = str(timestamp_value)
+
+            # 安全地获取消息内容
+            message_content = str(row.get('message_content', '')) if row.get(
+                'message_content') is not None else ''
+
+            css_class = 'admin-sender' if "管理组" in conversationTitle else 'sender'
+            color = context.theme_config.get(css_class, '#4cc2ff')
+
+            # 处理文件链接
+            matches = ATTACHMENT_PATTERN.findall(message_content)
+            processed_message_content = message_content
+            if matches:
+                for url in matches:
+                    try:
+                        file_path = context.downloads.path_for(url)
+                        if context.downloads.contains(context.downloads.filename_for(url)):
+                            file_url = QUrl.fromLocalFile(file_path).toString()
+                            ext = os.path.splitext(file_path)[1].lower()
+                            new_message = ATTACHMENT_PATTERN.sub('', processed_message_content).strip()
+                            if ext in IMAGE_EXTENSIONS:
+                                processed_message_content = f"{new_message}<br><a href='{file_url}'><img src='{file_path}' style='max-width: 100%; width: auto; height: auto;'></a>"
+                            else:
+                                if context.file_icon_exists:
+                                    processed_message_content = f"{new_message}<br><a href='{file_url}'><img src='{FILE_ICON_PATH}' width='128'></a>"
+                                else:
+                                    processed_message_content = f"{new_message}<br><a href='{file_url}'>{os.path.basename(file_path)} (图标丢失)</a>"
+                        else:
+                            # 检查是否是已知的失败URL
+                            if url in self.failed_urls:
+                                error_msg = self.failed_urls[url]
+                                if "403" in error_msg:
+                                    processed_message_content = f"<span style='color: red;'>文件链接已过期，无法下载</span>"
+                                else:
+                                    processed_message_content = f"<span style='color: red;'>下载失败: {error_msg}</span>"
+                            else:
+                                processed_message_content = "下载中..."
+                    except Exception as e:
+                        logging.error(f"处理文件链接时出错: {e}")
+                        processed_message_content = "[文件链接处理错误]"
+
+            # 构建格式化的消息
+            try:
+                html = self.markdown_cache.render(row.get('id'), processed_message_content)
+                return f"<b style='color:{color}; font-size:16px;'>{sender_name} ({created_at})</b>{html}<hr>"
+            except Exception as e:
+                logging.error(f"构建格式化消息时出错: {e}")
+                return f"<p style='color: red;'>消息格式化错误: {str(e)}</p><hr>"
+
+        except Exception as e:
+            logging.error(f"处理消息 {row.get('id')} 时出错: {e}", exc_info=True)
+            return f"<p style='color: red;'>消息处理错误: {str(e)}</p><hr>"
+
+    def render_messages(self, rows):
+        """增量更新公告板，只插入新消息、移除已淘汰的消息，失败时回退为整体 setHtml"""
+        try:
+            self.format_context.refresh()
+            self.renderer.render(rows, lambda row: self.format_message(row, self.format_context))
+        except Exception as e:
+            logging.error(f"增量渲染消息时出错，改为整体刷新: {e}", exc_info=True)
+            self.update_text_browser(self.format_messages(rows), False)
+        logging.debug(f"Markdown 渲染缓存: {self.markdown_cache.stats()}")
+        self.schedule_markdown_cache_save()
+
+    def schedule_markdown_cache_save(self):
+        """渲染缓存有新内容时启动延迟写盘，定时器已在计时时不重新计时"""
+        if self.markdown_cache.dirty and not self.markdown_cache_save_timer.isActive():
+            self.markdown_cache_save_timer.start(self.MARKDOWN_CACHE_SAVE_DELAY * 1000)
+
     def handle_anchor_clicked(self, url):
         """处理链接点击事件"""
         try:
@@ -655,6 +1522,7 @@ class BulletinBoardModule:
             self.poll_thread.started.connect(self.poll_worker.run)
             self.poll_worker.message_received.connect(self.handle_message)
             self.poll_worker.error_occurred.connect(self.on_poll_error)
+            self.poll_worker.poll_succeeded.connect(self.on_poll_succeeded)
 
             # 启动线程
             self.poll_thread.start()
@@ -665,6 +1533,10 @@ class BulletinBoardModule:
             self.update_text_browser(error_text, False)
             return False
 
+    def on_poll_succeeded(self):
+        """服务端正常响应，重置连接重试计数器"""
+        self.connection_retry_count = 0
+
     def on_poll_error(self, error_msg):
         """轮询错误处理"""
         self.connection_retry_count += 1
@@ -692,14 +1564,13 @@ class BulletinBoardModule:
                     self.connection_retry_count = 0
 
                     # 检查是否有新消息
-                    has_new_message = self.check_for_new_messages(messages)
+                    self.check_for_new_messages(messages)
 
                     # 处理下载任务
+                    self.current_messages = messages
                     self.process_downloads(messages)
 
-                    formatted_text = self.format_messages(messages)
-                    logging.debug(f"格式化后的文本长度: {len(formatted_text) if formatted_text else 0}")
-                    self.update_text_browser(formatted_text, has_new_message)
+                    self.render_messages(messages)
                 else:
                     # 显示"暂无消息"提示
                     self.update_text_browser("<p style='text-align: center; color: gray;'>暂无符合条件的消息</p>",
@@ -781,7 +1652,7 @@ class BulletinBoardModule:
                     sender_name = message.get('sender_name', '未知发送者')
                     message_content = message.get('message_content', '')
                     # 清理消息内容，移除文件链接标记
-                    cleaned_content = re.sub(r'&\[(.*?)\]&', '[文件]', message_content).strip()
+                    cleaned_content = ATTACHMENT_PATTERN.sub('[文件]', message_content).strip()
                     formatted_message = f"{sender_name}：{cleaned_content}"
 
                     # 添加到弹幕队列
@@ -841,6 +1712,7 @@ class BulletinBoardModule:
             if hasattr(self, 'text_browser') and self.text_browser is not None:
                 # 正常情况下更新内容
                 self.text_browser.setHtml(text)
+                self.renderer.reset()
                 self.last_message_text = text
                 if has_new_message:
                     # 新消息已经在 check_for_new_messages 中处理了
@@ -855,6 +1727,7 @@ class BulletinBoardModule:
             try:
                 if hasattr(self, 'text_browser') and self.text_browser is not None:
                     self.text_browser.setHtml(fallback_text)
+                    self.renderer.reset()
             except:
                 logging.error("无法设置回退文本")
 
@@ -881,14 +1754,15 @@ class BulletinBoardModule:
                     logging.error(f"等待轮询线程结束时出错: {e}")
 
             # 停止下载任务
-            if self.current_download and self.current_download.isRunning():
-                try:
-                    logging.info("停止当前下载任务")
-                    self.current_download.quit()
-                    if not self.current_download.wait(3000):  # 等待最多3秒
-                        logging.warning("下载线程未能及时结束")
-                except Exception as e:
-                    logging.error(f"停止下载任务时出错: {e}")
+            try:
+                logging.info("停止下载任务")
+                self.download_retry_timer.stop()
+                self.download_manager.stop(3000)  # 每个线程等待最多3秒
+            except Exception as e:
+                logging.error(f"停止下载任务时出错: {e}")
+
+            self.markdown_cache_save_timer.stop()
+            self.markdown_cache.save()
 
             logging.info("公告板模块资源清理完成")
         except Exception as e:
@@ -0,0 +1,258 @@
+# 服务端性能基准测试
+# 用法:
+#   python benchmark.py insert [--rows 2000] [--producers 8] [--mysql --host ... --user ... --password ... --database ...]
+#   python benchmark.py client [--messages 2000] [--pictures 9]
+#   python benchmark.py payload [--rows 500]
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from ingest import BatchWriter
+
+INSERT_COLUMNS = "(robot_name, conversationTitle, sender_name, message_content)"
+INGEST_WORKERS = 4  # 与 serve.py 中 ingest_config["workers"] 一致
+
+
+# ==================== 写入基准 ====================
+
+class SQLiteTarget:
+    """SQLite 替身数据库，使用临时文件以便每次提交都真实落盘"""
+
+    placeholder = "?"
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, robot_name TEXT, "
+            "conversationTitle TEXT, sender_name TEXT, message_content TEXT, "
+            "timestamp TEXT DEFAULT CURRENT_TIMESTAMP)"
+        )
+        self.connection.commit()
+
+    def executemany(self, sql, rows):
+        self.connection.executemany(sql, rows)
+        self.connection.commit()
+
+    def reset(self):
+        self.connection.execute("DELETE FROM messages")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+        os.remove(self.path)
+
+
+class MySQLTarget:
+    """本地 MySQL，使用临时表 messages_benchmark"""
+
+    placeholder = "%s"
+
+    def __init__(self, args):
+        import pymysql
+
+        self.connection = pymysql.connect(host=args.host, user=args.user, password=args.password,
+                                          database=args.database, autocommit=True)
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS messages_benchmark (id INT AUTO_INCREMENT PRIMARY KEY, "
+                "robot_name VARCHAR(255), conversationTitle VARCHAR(255), sender_name VARCHAR(255), "
+                "message_content TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)"
+            )
+
+    def executemany(self, sql, rows):
+        sql = sql.replace("INTO messages ", "INTO messages_benchmark ")
+        with self.connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+        self.connection.commit()
+
+    def reset(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute("TRUNCATE TABLE messages_benchmark")
+
+    def close(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS messages_benchmark")
+        self.connection.close()
+
+
+def run_producers(rows, producers, write_one, finish=None):
+    """多个生产者线程并发写入，模拟处理队列的工作线程，返回全部写入完成的耗时（秒）"""
+    chunks = [rows[i::producers] for i in range(producers)]
+    threads = [threading.Thread(target=lambda chunk=chunk: [write_one(row) for row in chunk]) for chunk in chunks]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if finish is not None:
+        finish()
+    return time.perf_counter() - started
+
+
+def bench_insert(args):
+    target = MySQLTarget(args) if args.mysql else SQLiteTarget()
+    placeholders = ", ".join([target.placeholder] * 4)
+    sql = f"INSERT INTO messages {INSERT_COLUMNS} VALUES ({placeholders})"
+    rows = [("robot", "群聊", f"发送者{i % 10}", f"消息内容 {i}") for i in range(args.rows)]
+
+    try:
+        # 逐条写入：每条消息一次 INSERT 和一次提交
+        lock = threading.Lock()
+
+        def write_single(row):
+            with lock:
+                target.executemany(sql, [row])
+
+        target.reset()
+        single = run_producers(rows, args.producers, write_single)
+
+        def write_batch(batch):
+            with lock:
+                target.executemany(sql, batch)
+
+        # 合并写入，同步等待：每个生产者等自己的记录所在批次提交后才继续，批次大小不超过生产者数
+        writer = BatchWriter(write_batch, max_batch=args.batch_rows, max_delay=args.batch_delay)
+        target.reset()
+        waiting = run_producers(rows, args.producers, writer.write)
+        waiting_stats = writer.stats()
+
+        # 合并写入，提交后继续：与 serve.py 处理队列相同，提交后处理下一条，写入结果在完成回调中确认
+        writer = BatchWriter(write_batch, max_batch=args.batch_rows, max_delay=args.batch_delay)
+        pendings = []
+        target.reset()
+        batched = run_producers(rows, args.producers, lambda row: pendings.append(writer.submit(row)),
+                                finish=lambda: [pending.wait(30) for pending in pendings])
+        stats = writer.stats()
+    finally:
+        target.close()
+
+    print(f"目标数据库: {'MySQL' if args.mysql else 'SQLite'}，{args.rows} 条消息，{args.producers} 个并发生产者")
+    print(f"逐条写入: {single:.3f}s，{args.rows / single:.0f} 条/秒")
+    print(f"合并写入（同步等待）: {waiting:.3f}s，{args.rows / waiting:.0f} 条/秒，"
+          f"共 {waiting_stats['batches_total']} 批，平均每批 {waiting_stats['avg_batch']} 条，提升 {single / waiting:.2f}x")
+    print(f"合并写入（提交后继续）: {batched:.3f}s，{args.rows / batched:.0f} 条/秒，"
+          f"共 {stats['batches_total']} 批，平均每批 {stats['avg_batch']} 条，提升 {single / batched:.2f}x")
+
+
+# ==================== SDK 客户端基准 ====================
+
+def bench_client(args):
+    """比较每次调用新建 SDK 客户端与复用注册表客户端时，处理一条多图消息的本地开销（不含网络请求）"""
+    import serve
+    from alibabacloud_dingtalk.robot_1_0 import models as robot_models
+    from alibabacloud_tea_util import models as util_models
+
+    def build_request(client, runtime, download_code):
+        headers = robot_models.RobotMessageFileDownloadHeaders()
+        headers.x_acs_dingtalk_access_token = "token"
+        request = robot_models.RobotMessageFileDownloadRequest(download_code=download_code, robot_code="robot")
+        return client, request, headers, runtime
+
+    def per_call_clients():
+        for i in range(args.pictures):
+            build_request(serve.create_dingtalk_client(), util_models.RuntimeOptions(), f"code{i}")
+
+    registry = serve.DingTalkClientRegistry()
+
+    def shared_clients():
+        for i in range(args.pictures):
+            build_request(registry.robot(), registry.runtime, f"code{i}")
+
+    results = {}
+    for name, process in (("每次新建客户端", per_call_clients), ("复用客户端", shared_clients)):
+        process()  # 预热
+        started = time.perf_counter()
+        for _ in range(args.messages):
+            process()
+        results[name] = (time.perf_counter() - started) / args.messages
+
+    print(f"{args.messages} 条消息，每条 {args.pictures} 张图片（不含网络请求）")
+    for name, cost in results.items():
+        print(f"{name}: 每条消息 {cost * 1e6:.1f}us")
+    before, after = results["每次新建客户端"], results["复用客户端"]
+    print(f"提升: {before / after:.2f}x")
+
+
+# ==================== 响应格式基准 ====================
+
+def bench_payload(args):
+    """比较 /api/messages 完整格式与紧凑格式的响应大小和客户端解析耗时"""
+    import serve
+
+    now = datetime.now().replace(microsecond=0)
+    rows = [{
+        "id": 100000 + i,
+        "robot_name": "dingxxxxxxxxxxxxxxxx",
+        "conversationTitle": "管理组" if i % 5 == 0 else f"高三{i % 12 + 1}班",
+        "sender_name": f"老师{i % 30}",
+        "message_content": f"第 {i} 条通知：请各班班主任于今天下午放学前提交材料 &[http://192.168.1.10:20000/media/{i:064x}.jpg]&",
+        "timestamp": now - timedelta(minutes=i * 20)
+    } for i in range(args.rows)]
+
+    def parse_full(body):
+        data = json.loads(body)
+        for row in data["data"]:
+            datetime.strptime(row["timestamp"], "%a, %d %b %Y %H:%M:%S GMT")
+
+    def parse_compact(data):
+        fields = data["fields"]
+        for row in data["data"]:
+            datetime.fromtimestamp(dict(zip(fields, row))["timestamp"])
+
+    formats = [("完整 JSON", "full", parse_full),
+               ("紧凑 JSON", "compact", lambda body: parse_compact(json.loads(body)))]
+    if serve.msgpack is not None:
+        formats.append(("紧凑 MessagePack", "compact-msgpack",
+                        lambda body: parse_compact(serve.msgpack.unpackb(body, raw=False))))
+
+    print(f"{args.rows} 条消息")
+    for name, response_format, parse in formats:
+        body = serve.encode_messages(rows, "full", response_format)
+        compressed = gzip.compress(body, compresslevel=serve.gzip_config["level"])
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            parse(body)
+        cost = (time.perf_counter() - started) / args.repeat
+        print(f"{name}: {len(body)} 字节，gzip 后 {len(compressed)} 字节，客户端解析 {cost * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dingtalk-service 性能基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    insert_parser = subparsers.add_parser("insert", help="比较逐条写入与合并写入的吞吐量")
+    insert_parser.add_argument("--rows", type=int, default=2000)
+    insert_parser.add_argument("--producers", type=int, default=INGEST_WORKERS, help="并发生产者数，默认与处理线程数一致")
+    insert_parser.add_argument("--batch-rows", type=int, default=50)
+    insert_parser.add_argument("--batch-delay", type=float, default=0.005)
+    insert_parser.add_argument("--mysql", action="store_true", help="使用本地 MySQL 代替 SQLite")
+    insert_parser.add_argument("--host", default="localhost")
+    insert_parser.add_argument("--user", default="root")
+    insert_parser.add_argument("--password", default="")
+    insert_parser.add_argument("--database", default="test")
+    insert_parser.set_defaults(func=bench_insert)
+
+    client_parser = subparsers.add_parser("client", help="比较新建与复用钉钉 SDK 客户端的单条消息处理开销")
+    client_parser.add_argument("--messages", type=int, default=2000)
+    client_parser.add_argument("--pictures", type=int, default=9)
+    client_parser.set_defaults(func=bench_client)
+
+    payload_parser = subparsers.add_parser("payload", help="比较完整格式与紧凑格式的响应大小和解析耗时")
+    payload_parser.add_argument("--rows", type=int, default=500)
+    payload_parser.add_argument("--repeat", type=int, default=50)
+    payload_parser.set_defaults(func=bench_payload)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
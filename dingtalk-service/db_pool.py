@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable
+
+
+class PoolTimeout(Exception):
+    """在等待时间内没有可用连接"""
+
+
+class ConnectionPool:
+    """有上限、线程安全的数据库连接池
+
+    - 连接总数不超过 max_size，超出时等待 acquire_timeout 秒
+    - 空闲超过 ping_interval 的连接在借出前先 ping 检测
+    - 存活超过 max_lifetime 的连接在归还时关闭重建
+    - 使用过程中出现异常的连接直接丢弃，不再放回池中
+    """
+
+    def __init__(self, connect: Callable, max_size: int = 10, acquire_timeout: float = 5,
+                 ping_interval: float = 30, max_lifetime: float = 3600):
+        self._connect = connect
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.ping_interval = ping_interval
+        self.max_lifetime = max_lifetime
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = deque()  # 元素为 (connection, created_at, last_used)
+        self._created_at = {}  # id(connection) -> 创建时间
+
+        # 统计信息
+        self._in_use = 0
+        self._waiting = 0
+        self._created_total = 0
+        self._recycled_total = 0
+        self._timeouts_total = 0
+
+    def _new_connection(self):
+        connection = self._connect()
+        with self._lock:
+            self._created_total += 1
+            self._created_at[id(connection)] = time.monotonic()
+        logging.info("数据库连接池新建连接")
+        return connection
+
+    def _discard(self, connection):
+        """关闭并丢弃连接"""
+        with self._lock:
+            self._created_at.pop(id(connection), None)
+            self._recycled_total += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _is_alive(self, connection) -> bool:
+        try:
+            connection.ping(reconnect=False)
+            return True
+        except Exception as e:
+            logging.warning(f"数据库连接已失效，重新建立: {e}")
+            return False
+
+    def acquire(self, timeout: float = None):
+        """借出一个连接，超时抛出 PoolTimeout"""
+        timeout = self.acquire_timeout if timeout is None else timeout
+        with self._lock:
+            self._waiting += 1
+        try:
+            acquired = self._slots.acquire(timeout=timeout)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        if not acquired:
+            with self._lock:
+                self._timeouts_total += 1
+            raise PoolTimeout(f"等待数据库连接超时 ({timeout}s)")
+
+        try:
+            now = time.monotonic()
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    connection = self._new_connection()
+                    break
+                connection, created_at, last_used = item
+                if now - created_at > self.max_lifetime:
+                    self._discard(connection)
+                    continue
+                if now - last_used > self.ping_interval and not self._is_alive(connection):
+                    self._discard(connection)
+                    continue
+                break
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+        return connection
+
+    def release(self, connection, broken: bool = False):
+        """归还连接，broken 为 True 时关闭连接"""
+        with self._lock:
+            self._in_use -= 1
+            created_at = self._created_at.get(id(connection), 0)
+        try:
+            if broken or time.monotonic() - created_at > self.max_lifetime:
+                self._discard(connection)
+            else:
+                with self._lock:
+                    self._idle.append((connection, created_at, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        """以上下文管理器形式借用连接，代码块内抛出异常时回滚并丢弃该连接"""
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        except Exception:
+            try:
+                connection.rollback()
+            except Exception:
+                pass
+            self.release(connection, broken=True)
+            raise
+        else:
+            self.release(connection)
+
+    def stats(self) -> dict:
+        """返回连接池状态"""
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "open": len(self._created_at),
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "created_total": self._created_total,
+                "recycled_total": self._recycled_total,
+                "timeouts_total": self._timeouts_total
+            }
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for connection, _, _ in idle:
+            self._discard(connection)
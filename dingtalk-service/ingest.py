@@ -0,0 +1,352 @@
+# webhook 异步处理队列
+# 路由只负责校验与入队并立即返回，由工作线程完成 access_token 获取、下载链接转换与数据库写入
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Optional
+
+
+class IngestJob:
+    """一条待处理的 webhook 消息"""
+
+    __slots__ = ("data", "robot_code", "replay_key", "enqueued_at", "attempts")
+
+    def __init__(self, data: dict, robot_code: str, replay_key=None):
+        self.data = data
+        self.robot_code = robot_code
+        self.replay_key = replay_key  # 请求的去重记录，处理失败时据此撤销
+        self.enqueued_at = time.time()
+        self.attempts = 0
+
+
+class IngestQueue:
+    """有界工作队列，队列满或处理持续失败时拒绝入队以便钉钉稍后重试"""
+
+    def __init__(self, handler: Callable[[IngestJob], Optional["PendingWrite"]], workers: int = 4,
+                 max_size: int = 1000, max_attempts: int = 12, retry_delay: float = 2,
+                 max_retry_delay: float = 300, degraded_window: float = 60,
+                 on_failure: Callable[[IngestJob], None] = None):
+        """handler 可返回 PendingWrite，此时工作线程不等待写入完成，写入结果在完成回调中统计和重试；
+        失败的消息按 retry_delay 指数退避重试（单次间隔不超过 max_retry_delay）；
+        最近 degraded_window 秒内的处理结果以失败为主时拒绝新消息；
+        on_failure(job) 在消息最终处理失败、被放弃时调用"""
+        self.handler = handler
+        self.on_failure = on_failure
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.degraded_window = degraded_window
+        self._queue = queue.Queue(maxsize=max_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started = False
+        self._last_failure = 0.0  # 最近一次处理失败与成功的时间（time.monotonic()）
+        self._last_success = 0.0
+
+        # 统计信息
+        self.enqueued_total = 0
+        self.processed_total = 0
+        self.failed_total = 0
+        self.retried_total = 0
+        self.rejected_total = 0
+        self.degraded_rejected_total = 0
+        self.last_latency = 0.0  # 最近一条消息从入队到处理完成的耗时（秒）
+        self.max_latency = 0.0
+
+    def start(self):
+        """启动工作线程（可重复调用）"""
+        with self._lock:
+            if self._started:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"IngestWorker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._started = True
+        logging.info(f"消息处理队列已启动，工作线程数: {self.workers}")
+
+    def stop(self, timeout: float = 5):
+        """处理完已入队的消息后停止工作线程"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+            self._started = False
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+    def degraded(self) -> bool:
+        """最近一次处理失败晚于最近一次成功且发生在 degraded_window 秒内，说明数据库等依赖正在出错"""
+        with self._lock:
+            return self._degraded_locked()
+
+    def _degraded_locked(self) -> bool:
+        return (self._last_failure > self._last_success
+                and time.monotonic() - self._last_failure < self.degraded_window)
+
+    def submit(self, data: dict, robot_code: str, replay_key=None) -> bool:
+        """将消息加入队列，队列已满或处理持续失败时返回 False
+
+        webhook 在入队后即向钉钉返回成功，此后消息只能靠本地重试；处理持续失败时不再接收，
+        由钉钉自行重试，避免已确认的消息在本地重试耗尽后丢失。
+        """
+        self.start()
+        if self.degraded():
+            with self._lock:
+                self.degraded_rejected_total += 1
+            logging.error("消息处理持续失败，暂时拒绝新消息")
+            return False
+        try:
+            self._queue.put_nowait(IngestJob(data, robot_code, replay_key))
+        except queue.Full:
+            with self._lock:
+                self.rejected_total += 1
+            logging.error("消息处理队列已满，拒绝新消息")
+            return False
+        with self._lock:
+            self.enqueued_total += 1
+        return True
+
+    def _requeue(self, job: IngestJob):
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.failed_total += 1
+            logging.error("消息处理队列已满，放弃重试")
+            self._give_up(job)
+
+    def _give_up(self, job: IngestJob):
+        if self.on_failure is None:
+            return
+        try:
+            self.on_failure(job)
+        except Exception as e:
+            logging.error(f"处理失败回调出错: {e}", exc_info=True)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            job.attempts += 1
+            try:
+                deferred = self.handler(job)
+            except Exception as e:
+                self._finish(job, e)
+                continue
+            finally:
+                self._queue.task_done()
+
+            # handler 返回 PendingWrite 时不等待写入完成，继续处理下一条，写入结果在回调中处理
+            if deferred is not None:
+                deferred.add_done_callback(lambda error, job=job: self._finish(job, error))
+            else:
+                self._finish(job, None)
+
+    def _finish(self, job: IngestJob, error: Exception = None):
+        """记录一条消息的处理结果，失败时延迟重试或放弃"""
+        failed = error is not None
+        if failed:
+            logging.error(f"处理 webhook 消息失败 (第 {job.attempts} 次): {error}",
+                          exc_info=(type(error), error, error.__traceback__))
+
+        with self._lock:
+            if failed:
+                self._last_failure = time.monotonic()
+            else:
+                self._last_success = time.monotonic()
+
+        # 已向钉钉确认接收，失败时由本地按指数退避重试，默认约半小时后才放弃，避免数据库短暂故障时丢消息
+        if failed and job.attempts < self.max_attempts:
+            with self._lock:
+                self.retried_total += 1
+            delay = min(self.max_retry_delay, self.retry_delay * 2 ** (job.attempts - 1))
+            timer = threading.Timer(delay, self._requeue, args=(job,))
+            timer.daemon = True
+            timer.start()
+            return
+
+        latency = time.time() - job.enqueued_at
+        with self._lock:
+            if failed:
+                self.failed_total += 1
+            else:
+                self.processed_total += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+        if failed:
+            self._give_up(job)
+
+    def oldest_age(self) -> float:
+        """队首（最早入队且尚未处理）消息已等待的时间（秒）"""
+        with self._queue.mutex:
+            head = self._queue.queue[0] if self._queue.queue else None
+        if head is None:
+            return 0.0
+        return time.time() - head.enqueued_at
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "depth": self._queue.qsize(),
+                "max_size": self._queue.maxsize,
+                "workers": len(self._threads),
+                "lag_seconds": round(self.oldest_age(), 3),
+                "last_latency": round(self.last_latency, 3),
+                "max_latency": round(self.max_latency, 3),
+                "enqueued_total": self.enqueued_total,
+                "processed_total": self.processed_total,
+                "failed_total": self.failed_total,
+                "retried_total": self.retried_total,
+                "rejected_total": self.rejected_total,
+                "degraded": self._degraded_locked(),
+                "degraded_rejected_total": self.degraded_rejected_total
+            }
+
+
+# 保护 PendingWrite 回调列表，所有记录共用，持有时间极短
+_callback_lock = threading.Lock()
+
+
+class PendingWrite:
+    """一条等待合并写入的记录，写入提交后 done 被置位并依次调用完成回调"""
+
+    __slots__ = ("values", "done", "error", "callbacks")
+
+    def __init__(self, values: tuple):
+        self.values = values
+        self.done = threading.Event()
+        self.error = None
+        self.callbacks = []
+
+    def add_done_callback(self, callback: Callable[[Exception], None]):
+        """写入完成后调用 callback(error)，成功时 error 为 None；已完成时立即调用"""
+        with _callback_lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self.error)
+
+    def set_done(self):
+        with _callback_lock:
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self.error)
+            except Exception as e:
+                logging.error(f"写入完成回调出错: {e}", exc_info=True)
+
+    def wait(self, timeout: float = None):
+        """等待写入完成，写入失败或超时时抛出异常"""
+        if not self.done.wait(timeout):
+            raise TimeoutError("等待消息写入超时")
+        if self.error is not None:
+            raise self.error
+
+
+class BatchWriter:
+    """写入合并：缓冲 max_delay 秒或 max_batch 行后通过 write_batch 一次写入
+
+    write() 等待所在批次提交后返回；submit() 立即返回 PendingWrite，调用方可注册完成回调后继续处理，
+    批次大小因此不受调用方线程数限制。批量写入失败时逐条重写一次，只让真正有问题的记录失败。
+    """
+
+    def __init__(self, write_batch: Callable[[list], None], max_batch: int = 50, max_delay: float = 0.005):
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._outstanding = 0  # 已提交但尚未确认的记录数
+
+        # 统计信息
+        self.batches_total = 0
+        self.rows_total = 0
+        self.max_batch_seen = 0
+        self.fallback_total = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="BatchWriter", daemon=True)
+            self._thread.start()
+
+    def submit(self, values: tuple) -> PendingWrite:
+        """提交一条记录，返回可等待的 PendingWrite"""
+        self.start()
+        pending = PendingWrite(values)
+        with self._lock:
+            self._outstanding += 1
+        self._queue.put(pending)
+        return pending
+
+    def write(self, values: tuple, timeout: float = 30):
+        """提交一条记录并等待其所在批次提交"""
+        self.submit(values).wait(timeout)
+
+    def _collect(self) -> list:
+        """取出一批记录：先取走队列中已有的记录，再在 max_delay 内等待后续到达的记录
+
+        上一批写入期间到达的记录会直接组成下一批。所有已提交的记录都已在本批中时，
+        同步调用方都在等待确认、不会再有新记录，此时立即写入而不空等。
+        """
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            with self._lock:
+                if len(batch) >= self._outstanding:
+                    break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self.write_batch([pending.values for pending in batch])
+            except Exception as e:
+                logging.warning(f"批量写入 {len(batch)} 条失败，改为逐条写入: {e}")
+                with self._lock:
+                    self.fallback_total += 1
+                for pending in batch:
+                    try:
+                        self.write_batch([pending.values])
+                    except Exception as row_error:
+                        pending.error = row_error
+            for pending in batch:
+                pending.set_done()
+
+            with self._lock:
+                self._outstanding -= len(batch)
+                self.batches_total += 1
+                self.rows_total += len(batch)
+                self.max_batch_seen = max(self.max_batch_seen, len(batch))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": self._queue.qsize(),
+                "batches_total": self.batches_total,
+                "rows_total": self.rows_total,
+                "avg_batch": round(self.rows_total / self.batches_total, 2) if self.batches_total else 0,
+                "max_batch": self.max_batch_seen,
+                "fallback_total": self.fallback_total
+            }
@@ -0,0 +1,247 @@
+# 压力测试：模拟 N 个教室客户端按 MessagePollWorker 的方式轮询 /api/messages，用于评估服务端容量
+# 用法:
+#   python load_test.py --url http://127.0.0.1:20000 --clients 300 --interval 10 --duration 120 --agent-id 123456
+#   python load_test.py --clients 300 --stream    与客户端默认行为一致：优先保持推送连接，被拒绝时回退为轮询；
+#                                                 另有一个探测线程每秒轮询一次，观察推送连接占满线程时其他请求的延迟
+import argparse
+import random
+import threading
+import time
+from collections import Counter
+
+import requests
+
+FULL_SYNC_INTERVAL = 30  # 与客户端一致：每 30 次增量轮询做一次全量同步
+
+
+class Stats:
+    """各客户端线程共享的统计信息"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.open_streams = 0
+        self.max_open_streams = 0
+        self.stream_events = 0
+
+    def record(self, latency: float, status: int, wire_bytes: int, body_bytes: int):
+        with self._lock:
+            self.latencies.append(latency)
+            self.statuses[status] += 1
+            self.wire_bytes += wire_bytes
+            self.body_bytes += body_bytes
+
+    def record_error(self, error: Exception):
+        with self._lock:
+            self.errors[type(error).__name__] += 1
+
+    def stream_opened(self):
+        with self._lock:
+            self.open_streams += 1
+            self.max_open_streams = max(self.max_open_streams, self.open_streams)
+
+    def stream_closed(self):
+        with self._lock:
+            self.open_streams -= 1
+
+    def stream_event(self):
+        with self._lock:
+            self.stream_events += 1
+
+    def stream_snapshot(self):
+        with self._lock:
+            return self.open_streams, self.max_open_streams, self.stream_events
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.latencies), Counter(self.statuses), Counter(self.errors), self.wire_bytes, self.body_bytes
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(len(values) * p / 100), len(values) - 1)
+    return values[index]
+
+
+class PollingClient(threading.Thread):
+    """一个教室客户端：首次全量同步，之后带 since_id 和 If-None-Match 增量轮询"""
+
+    def __init__(self, index, args, stats: Stats, stop_event: threading.Event, stream: bool = False):
+        super().__init__(name=f"Client-{index}", daemon=True)
+        self.args = args
+        self.stats = stats
+        self.stream = stream
+        self.stream_retry_at = 0.0
+        self.stop_event = stop_event
+        self.session = requests.Session()
+        # 所有模拟客户端来自同一地址，用不同的客户端标识区分，与服务端限流规则一致
+        self.session.headers['X-Client-Id'] = f"load-test-{index}"
+        if not args.gzip:
+            self.session.headers['Accept-Encoding'] = 'identity'
+        self.last_id = 0
+        self.synced = False
+        self.polls_since_full_sync = 0
+        self.etags = {}  # 全量/增量请求各自的 ETag
+        self.retry_after = 0  # 被限流时服务端要求的等待时间
+
+    def build_params(self):
+        params = {'agent_id': self.args.agent_id}
+        if self.args.sender_names:
+            params['sender_names'] = self.args.sender_names
+        if self.args.conversation_titles:
+            params['conversation_titles'] = self.args.conversation_titles
+        if self.args.compact:
+            params['format'] = 'compact'
+        if self.synced and self.polls_since_full_sync < FULL_SYNC_INTERVAL:
+            params['since_id'] = self.last_id
+        return params
+
+    def poll_once(self):
+        params = self.build_params()
+        etag_key = params.get('since_id', 'full')
+        headers = {'If-None-Match': self.etags[etag_key]} if etag_key in self.etags else {}
+
+        started = time.perf_counter()
+        response = self.session.get(f"{self.args.url}/api/messages", params=params, headers=headers,
+                                    timeout=(10, 30))
+        body = response.content
+        latency = time.perf_counter() - started
+        wire_bytes = int(response.headers.get('Content-Length') or len(body))
+        self.stats.record(latency, response.status_code, wire_bytes, len(body))
+        self.retry_after = int(response.headers.get('Retry-After') or 0) if response.status_code == 429 else 0
+
+        if response.status_code == 200:
+            data = response.json()
+            rows = data.get("data") or []
+            self.etags = {etag_key: response.headers['ETag']} if response.headers.get('ETag') else {}
+            if rows:
+                # 紧凑格式每条消息为数组，按 fields 取 id
+                if data.get("fields"):
+                    index = data["fields"].index("id")
+                    ids = [row[index] for row in rows]
+                else:
+                    ids = [row.get('id', 0) for row in rows]
+                self.last_id = max(self.last_id, max(ids))
+        if 'since_id' in params:
+            self.polls_since_full_sync += 1
+        elif response.status_code in (200, 304):
+            self.synced = True
+            self.polls_since_full_sync = 0
+
+    def stream_once(self) -> bool:
+        """保持一条推送连接直到到期或断开，连接被拒绝时返回 False"""
+        params = self.build_params()
+        params['since_id'] = self.last_id
+        started = time.perf_counter()
+        with self.session.get(f"{self.args.url}/api/messages/stream", params=params, stream=True,
+                              timeout=(10, 45)) as response:
+            self.stats.record(time.perf_counter() - started, response.status_code, 0, 0)
+            if response.status_code != 200:
+                # 与客户端一致：被拒绝后按 Retry-After 回退为轮询
+                self.stream_retry_at = time.monotonic() + int(response.headers.get('Retry-After') or 60)
+                return False
+            self.stats.stream_opened()
+            try:
+                deadline = time.monotonic() + self.args.stream_seconds
+                for line in response.iter_lines(chunk_size=1024, decode_unicode=True):
+                    if line == 'event: messages':
+                        self.stats.stream_event()
+                    if self.stop_event.is_set() or time.monotonic() >= deadline:
+                        break
+            finally:
+                self.stats.stream_closed()
+        return True
+
+    def run(self):
+        # 各客户端错开启动，避免所有请求集中在同一时刻
+        if self.stop_event.wait(random.uniform(0, self.args.ramp_up)):
+            return
+        while not self.stop_event.is_set():
+            try:
+                if self.stream and self.synced and time.monotonic() >= self.stream_retry_at:
+                    if self.stream_once():
+                        continue
+                self.poll_once()
+            except Exception as e:
+                self.stats.record_error(e)
+            self.stop_event.wait(max(self.args.interval, self.retry_after))
+
+
+def report(stats: Stats, elapsed: float, final: bool = False, probe: Stats = None):
+    latencies, statuses, errors, wire_bytes, body_bytes = stats.snapshot()
+    total = len(latencies)
+    if probe is not None:
+        open_streams, max_open_streams, stream_events = stats.stream_snapshot()
+        probe_latencies, _, probe_errors, _, _ = probe.snapshot()
+        print(f"[{elapsed:6.1f}s] 推送连接 {open_streams}（最多 {max_open_streams}），收到推送 {stream_events} 次；"
+              f"探测轮询 p50 {percentile(probe_latencies, 50) * 1000:.1f}ms，"
+              f"p99 {percentile(probe_latencies, 99) * 1000:.1f}ms，失败 {sum(probe_errors.values())}")
+    print(f"[{elapsed:6.1f}s] 请求 {total}，{total / elapsed if elapsed else 0:.1f} 次/秒，"
+          f"p50 {percentile(latencies, 50) * 1000:.1f}ms，p90 {percentile(latencies, 90) * 1000:.1f}ms，"
+          f"p99 {percentile(latencies, 99) * 1000:.1f}ms，最大 {max(latencies, default=0) * 1000:.1f}ms，"
+          f"错误 {sum(errors.values())}")
+    if final:
+        print(f"状态码: {dict(statuses)}")
+        if errors:
+            print(f"错误类型: {dict(errors)}")
+        if total:
+            print(f"平均每次传输 {wire_bytes / total:.0f} 字节（解压后 {body_bytes / total:.0f} 字节），"
+                  f"304 占比 {statuses[304] / total:.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟多个教室客户端轮询 /api/messages")
+    parser.add_argument("--url", default="http://127.0.0.1:20000")
+    parser.add_argument("--clients", type=int, default=100, help="模拟的客户端数量")
+    parser.add_argument("--interval", type=float, default=10, help="轮询间隔（秒），与客户端一致")
+    parser.add_argument("--duration", type=float, default=60, help="测试时长（秒）")
+    parser.add_argument("--ramp-up", type=float, default=10, help="所有客户端在该时间内陆续启动（秒）")
+    parser.add_argument("--agent-id", default="")
+    parser.add_argument("--sender-names", default="", help="逗号分隔的发送者过滤条件")
+    parser.add_argument("--conversation-titles", default="", help="逗号分隔的群聊过滤条件")
+    parser.add_argument("--compact", action="store_true", help="请求紧凑响应格式（format=compact）")
+    parser.add_argument("--no-gzip", dest="gzip", action="store_false", help="不接受 gzip 压缩响应")
+    parser.add_argument("--stream", action="store_true", help="客户端优先保持推送连接，被拒绝时回退为轮询")
+    parser.add_argument("--stream-seconds", type=float, default=300, help="单条推送连接的保持时间，与客户端一致")
+    parser.add_argument("--report-interval", type=float, default=10)
+    args = parser.parse_args()
+    args.url = args.url.rstrip('/')
+
+    stats = Stats()
+    stop_event = threading.Event()
+    clients = [PollingClient(i, args, stats, stop_event, stream=args.stream) for i in range(args.clients)]
+    probe = None
+    if args.stream:
+        # 探测线程每秒轮询一次，推送连接占满服务端线程时其延迟会明显上升或超时
+        probe = Stats()
+        probe_args = argparse.Namespace(**{**vars(args), "interval": 1, "ramp_up": 0})
+        clients.append(PollingClient("probe", probe_args, probe, stop_event))
+    print(f"启动 {args.clients} 个客户端{'（推送连接）' if args.stream else ''}，轮询间隔 {args.interval}s，"
+          f"持续 {args.duration}s，目标 {args.url}")
+
+    started = time.monotonic()
+    for client in clients:
+        client.start()
+    try:
+        while True:
+            elapsed = time.monotonic() - started
+            if elapsed >= args.duration:
+                break
+            time.sleep(min(args.report_interval, args.duration - elapsed))
+            report(stats, time.monotonic() - started, probe=probe)
+    except KeyboardInterrupt:
+        pass
+    stop_event.set()
+    for client in clients:
+        client.join(timeout=5)
+    report(stats, time.monotonic() - started, final=True, probe=probe)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# 附件镜像
+# 消息入库时从钉钉下载一次附件，按内容 sha256 存放在本地磁盘，客户端通过 /media/<hash><ext> 从局域网下载
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+MEDIA_NAME_PATTERN = re.compile(r'^[0-9a-f]{64}(\.[0-9a-z]{1,10})?$')
+
+
+class MediaCache:
+    """内容寻址的附件缓存"""
+
+    def __init__(self, root: str, public_base_url: str, max_bytes: int = 100 * 1024 * 1024,
+                 timeout: float = 60, max_source_entries: int = 4096):
+        self.root = root
+        self.public_base_url = public_base_url.rstrip('/')
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.max_source_entries = max_source_entries
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+
+        self.session = requests.Session()
+        retry_strategy = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=16)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._sources = OrderedDict()  # 源地址 -> 本地文件名，避免同一链接重复下载
+
+        # 统计信息
+        self.mirrored_total = 0
+        self.deduplicated_total = 0
+        self.failed_total = 0
+        self.bytes_total = 0
+
+    @staticmethod
+    def guess_extension(url: str, content_type: str, file_name: str = "") -> str:
+        """依次根据文件名、链接路径和 Content-Type 推断扩展名"""
+        for candidate in (file_name, urlparse(url).path):
+            ext = os.path.splitext(candidate or "")[1].lower()
+            if ext and len(ext) <= 11 and ext[1:].isalnum():
+                return ext
+        if content_type:
+            ext = mimetypes.guess_extension(content_type.split(';')[0].strip())
+            if ext:
+                return ".jpg" if ext == ".jpe" else ext
+        return ""
+
+    def path_for(self, name: str):
+        """返回本地文件路径，文件名不合法或文件不存在时返回 None"""
+        if not MEDIA_NAME_PATTERN.match(name):
+            return None
+        path = os.path.join(self.root, name[:2], name)
+        return path if os.path.isfile(path) else None
+
+    def public_url(self, name: str) -> str:
+        return f"{self.public_base_url}/media/{name}"
+
+    def mirror(self, url: str, file_name: str = "") -> str:
+        """下载附件并存入缓存，返回局域网地址；失败时返回原地址"""
+        with self._lock:
+            name = self._sources.get(url)
+        if name and self.path_for(name):
+            return self.public_url(name)
+
+        tmp_path = None
+        try:
+            response = self.session.get(url, stream=True, timeout=self.timeout)
+            response.raise_for_status()
+            content_length = int(response.headers.get("Content-Length") or 0)
+            if content_length > self.max_bytes:
+                raise ValueError(f"附件过大: {content_length} 字节")
+
+            digest = hashlib.sha256()
+            size = 0
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=65536):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError(f"附件超过 {self.max_bytes} 字节")
+                    digest.update(chunk)
+                    f.write(chunk)
+            if content_length and size != content_length:
+                raise ValueError(f"附件下载不完整: {size}/{content_length} 字节")
+
+            name = digest.hexdigest() + self.guess_extension(url, response.headers.get("Content-Type", ""), file_name)
+            final_path = os.path.join(self.root, name[:2], name)
+            if os.path.exists(final_path):
+                os.remove(tmp_path)
+                os.utime(final_path)  # 重新被引用，推迟清理
+                with self._lock:
+                    self.deduplicated_total += 1
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(tmp_path, final_path)
+            tmp_path = None
+
+            with self._lock:
+                self._sources[url] = name
+                while len(self._sources) > self.max_source_entries:
+                    self._sources.popitem(last=False)
+                self.mirrored_total += 1
+                self.bytes_total += size
+            logging.info(f"附件已镜像: {name} ({size} 字节)")
+            return self.public_url(name)
+        except Exception as e:
+            with self._lock:
+                self.failed_total += 1
+            logging.error(f"镜像附件失败，使用原始链接: {e}")
+            return url
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def purge_older_than(self, days: int) -> int:
+        """删除超过保留期的附件，返回删除的文件数"""
+        cutoff = time.time() - days * 86400
+        removed = 0
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                path = os.path.join(directory, file)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        if removed:
+            logging.info(f"删除了 {removed} 个过期附件")
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "mirrored_total": self.mirrored_total,
+                "deduplicated_total": self.deduplicated_total,
+                "failed_total": self.failed_total,
+                "bytes_total": self.bytes_total
+            }
@@ -0,0 +1,249 @@
+# 运行指标
+# 轻量实现 Prometheus 文本格式的计数器、仪表和直方图，/metrics 端点输出；不依赖 prometheus_client
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """指标基类，按标签值分别计数"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+    def render(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """单调递增计数器"""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self) -> list:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{format_labels(self.label_names, labels)} {format_value(value)}" for labels, value in items]
+
+
+class Gauge(Metric):
+    """可增可减的仪表"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[tuple, float] = {}
+
+    def set(self, value: float, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self) -> list:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{format_labels(self.label_names, labels)} {format_value(value)}" for labels, value in items]
+
+
+class Histogram(Metric):
+    """累积分桶直方图，observe 只做一次二分查找和一次加锁"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, list] = {}  # 标签值 -> [各桶计数..., 超出最大桶的计数, 总和]
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, *label_values):
+        """计时上下文：with histogram.time("label"): ..."""
+        return _Timer(self, label_values)
+
+    def render(self) -> list:
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        lines = []
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = 'le="' + format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {format_value(series[-1])}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+        return False
+
+
+class CallbackMetric(Metric):
+    """抓取时才读取数值的指标，适合从已有的 stats() 中导出，不给热路径增加开销
+
+    callback 返回数值，或返回 {标签值元组: 数值} 字典
+    """
+
+    def __init__(self, name: str, documentation: str, callback: Callable, label_names: Tuple[str, ...] = (),
+                 type_name: str = "gauge"):
+        super().__init__(name, documentation, label_names)
+        self.callback = callback
+        self.type_name = type_name
+
+    def render(self) -> list:
+        values = self.callback()
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{format_labels(self.label_names, labels)} {format_value(value)}"
+                for labels, value in values.items()]
+
+
+class ActiveClientTracker:
+    """按 agent_id 统计最近一段时间内发起过请求的客户端数"""
+
+    def __init__(self, window: float = 60, max_entries: int = 10000):
+        self.window = window
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._last_seen: Dict[tuple, float] = {}  # (agent_id, 客户端标识) -> 最近请求时间
+
+    def touch(self, agent_id: str, client: str):
+        key = (agent_id or "", client or "")
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._last_seen and len(self._last_seen) >= self.max_entries:
+                self._prune(now)
+                if len(self._last_seen) >= self.max_entries:
+                    return  # agent_id 由客户端传入，限制条目数防止内存被无限占用
+            self._last_seen[key] = now
+
+    def _prune(self, now: float):
+        cutoff = now - self.window
+        for key in [key for key, seen in self._last_seen.items() if seen < cutoff]:
+            del self._last_seen[key]
+
+    def counts(self) -> dict:
+        """返回 {(agent_id,): 活跃客户端数}"""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            keys = list(self._last_seen)
+        counts = {}
+        for agent_id, _ in keys:
+            counts[(agent_id,)] = counts.get((agent_id,), 0) + 1
+        return counts
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def callback(self, name: str, documentation: str, callback: Callable, label_names: Tuple[str, ...] = (),
+                 type_name: str = "gauge") -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, callback, label_names, type_name))
+
+    def render(self) -> str:
+        """输出 Prometheus 文本格式（0.0.4）"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.render()
+            except Exception as e:
+                lines.append(f"# 导出 {metric.name} 失败: {escape_label(e)}")
+                continue
+            lines.extend(metric.header())
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,53 @@
+# 请求限流
+# 每个客户端一个令牌桶：令牌按固定速率补充，突发请求最多消耗 burst 个令牌，令牌耗尽时返回需要等待的秒数
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, Tuple
+
+
+class TokenBucketLimiter:
+    """按键限流的令牌桶，桶数量有上限，最久未使用的桶先被淘汰"""
+
+    def __init__(self, rate: float, burst: float, max_entries: int = 10000):
+        self.rate = rate  # 每秒补充的令牌数
+        self.burst = burst  # 桶容量
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> [剩余令牌数, 上次补充时间]
+
+        # 统计信息
+        self.allowed_total = 0
+        self.limited_total = 0
+
+    def acquire(self, key: Hashable, cost: float = 1) -> Tuple[bool, int]:
+        """尝试消耗令牌，返回 (是否放行, 需要等待的秒数)"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                while len(self._buckets) > self.max_entries:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed_total += 1
+                return True, 0
+            self.limited_total += 1
+            return False, max(1, math.ceil((cost - bucket[0]) / self.rate))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "clients": len(self._buckets),
+                "rate": self.rate,
+                "burst": self.burst,
+                "allowed_total": self.allowed_total,
+                "limited_total": self.limited_total
+            }
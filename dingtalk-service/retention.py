@@ -0,0 +1,206 @@
+# 消息保留与分区维护
+# 后台线程定期分批归档/删除超出保留期的消息，开启分区后改为按天分区并直接删除过期分区
+import logging
+import threading
+import time
+from datetime import date, timedelta
+
+from schema import ARCHIVE_TABLE, ARCHIVE_COLUMNS, MSG_ID_UNIQUE_INDEX, MSG_ID_INDEX, get_existing_indexes
+
+PARTITION_PREFIX = "p"
+FUTURE_PARTITION = "p_future"
+
+
+def partition_name(day: date) -> str:
+    """分区 pYYYYMMDD 存放 timestamp 落在该天的消息"""
+    return f"{PARTITION_PREFIX}{day.strftime('%Y%m%d')}"
+
+
+def partition_bound(day: date) -> str:
+    return f"TO_DAYS('{(day + timedelta(days=1)).isoformat()}')"
+
+
+class RetentionWorker(threading.Thread):
+    """后台维护线程：按保留期清理 messages 表，数据库繁忙时自动让路"""
+
+    def __init__(self, store, retention_days: int = 30, archive: bool = False, batch_size: int = 1000,
+                 batch_pause: float = 0.5, interval: float = 3600, max_threads_running: int = 20,
+                 partitioning: bool = False, partition_days_ahead: int = 3, media_cache=None):
+        super().__init__(name="RetentionWorker", daemon=True)
+        self.store = store
+        self.retention_days = retention_days
+        self.archive = archive
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.interval = interval
+        self.max_threads_running = max_threads_running
+        self.partitioning = partitioning
+        self.partition_days_ahead = partition_days_ahead
+        self.media_cache = media_cache
+        self._stop_event = threading.Event()
+
+        # 统计信息
+        self.last_run = None
+        self.last_duration = 0.0
+        self.deleted_total = 0
+        self.archived_total = 0
+        self.partitions_dropped_total = 0
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        logging.info(f"消息保留任务已启动，保留 {self.retention_days} 天")
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error(f"消息保留任务执行失败: {e}", exc_info=True)
+            self.last_run = time.time()
+            self.last_duration = time.monotonic() - started
+            self._stop_event.wait(self.interval)
+
+    def run_once(self):
+        """执行一轮维护"""
+        if self.archive:
+            self.ensure_archive_table()
+        if self.partitioning and not self.store.supports_partitioning:
+            logging.warning(f"{self.store.name} 存储后端不支持分区，改为分批删除")
+            self.partitioning = False
+        if self.partitioning:
+            if not self.is_partitioned():
+                self.convert_to_partitioned()
+            self.maintain_partitions()
+        else:
+            self.purge_expired()
+        if self.media_cache is not None:
+            self.media_cache.purge_older_than(self.retention_days)
+
+    # ==================== 负载控制 ====================
+
+    def database_busy(self) -> bool:
+        """数据库正在执行的线程数过多或连接池有请求在排队时视为繁忙"""
+        return self.store.is_busy(self.max_threads_running)
+
+    def wait_for_idle(self) -> bool:
+        """数据库繁忙时等待，收到停止信号返回 False"""
+        pause = self.batch_pause
+        while self.database_busy():
+            logging.info(f"数据库繁忙，消息保留任务暂停 {pause:.1f} 秒")
+            if self._stop_event.wait(pause):
+                return False
+            pause = min(pause * 2, 60)
+        return not self._stop_event.is_set()
+
+    # ==================== 分批删除 ====================
+
+    def ensure_archive_table(self):
+        self.store.ensure_archive_table()
+
+    def purge_expired(self) -> int:
+        """按主键分批归档并删除超出保留期的消息，返回删除条数"""
+        deleted = 0
+        while self.wait_for_idle():
+            batch_deleted, batch_archived = self.store.delete_expired(self.retention_days, self.batch_size, self.archive)
+            deleted += batch_deleted
+            self.archived_total += batch_archived
+            if batch_deleted < self.batch_size:
+                break
+            self._stop_event.wait(self.batch_pause)
+
+        if deleted:
+            self.deleted_total += deleted
+            logging.info(f"消息保留任务删除了 {deleted} 条超过 {self.retention_days} 天的消息")
+        return deleted
+
+    # ==================== 按天分区（仅 MySQL） ====================
+
+    def get_partitions(self) -> list:
+        """返回 messages 表的分区名列表"""
+        with self.store.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'messages' AND PARTITION_NAME IS NOT NULL "
+                    "ORDER BY PARTITION_ORDINAL_POSITION"
+                )
+                return [row["PARTITION_NAME"] for row in cursor.fetchall()]
+
+    def is_partitioned(self) -> bool:
+        return bool(self.get_partitions())
+
+    def convert_to_partitioned(self):
+        """将 messages 表改为按天的 RANGE 分区
+
+        MySQL 要求分区列包含在每个唯一键中，因此主键会改为 (id, timestamp)，msg_id 唯一索引改为普通索引。该操作会重建整张表，
+        先清理过期数据以缩短耗时。
+        """
+        logging.warning("开始将 messages 表转换为按天分区，期间表会被重建")
+        self.purge_expired()
+        today = date.today()
+        days = [today - timedelta(days=offset) for offset in range(self.retention_days, -self.partition_days_ahead - 1, -1)]
+        partitions = [f"PARTITION {partition_name(day)} VALUES LESS THAN ({partition_bound(day)})" for day in days]
+        partitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+
+        with self.store.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                # msg_id 唯一索引同样不含分区列，改为普通索引，重复消息改由写入前检查过滤
+                if MSG_ID_UNIQUE_INDEX in get_existing_indexes(cursor, "messages"):
+                    logging.warning("分区后 msg_id 唯一索引将改为普通索引")
+                    cursor.execute(f"ALTER TABLE messages DROP INDEX `{MSG_ID_UNIQUE_INDEX}`, "
+                                   f"ADD INDEX `{MSG_ID_INDEX}` (`msg_id`)")
+                cursor.execute("ALTER TABLE messages DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `timestamp`)")
+                cursor.execute(
+                    f"ALTER TABLE messages PARTITION BY RANGE (TO_DAYS(`timestamp`)) ({', '.join(partitions)})"
+                )
+        logging.info(f"messages 表已转换为按天分区，共 {len(partitions)} 个分区")
+
+    def maintain_partitions(self):
+        """预先创建未来几天的分区，并删除超出保留期的分区"""
+        existing = self.get_partitions()
+        today = date.today()
+
+        # 从 p_future 中拆出缺失的未来分区
+        missing = [today + timedelta(days=offset) for offset in range(self.partition_days_ahead + 1)]
+        missing = [day for day in missing if partition_name(day) not in existing]
+        if missing and FUTURE_PARTITION in existing:
+            definitions = [f"PARTITION {partition_name(day)} VALUES LESS THAN ({partition_bound(day)})"
+                           for day in missing]
+            definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+            with self.store.pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"ALTER TABLE messages REORGANIZE PARTITION {FUTURE_PARTITION} INTO ({', '.join(definitions)})"
+                    )
+            logging.info(f"新建消息分区: {[partition_name(day) for day in missing]}")
+
+        # 删除早于保留期的分区，整块删除不会产生大量行锁和 undo 日志
+        cutoff = partition_name(today - timedelta(days=self.retention_days))
+        expired = [name for name in existing
+                   if name != FUTURE_PARTITION and name.startswith(PARTITION_PREFIX) and name < cutoff]
+        for name in expired:
+            if not self.wait_for_idle():
+                return
+            with self.store.pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    if self.archive:
+                        cursor.execute(
+                            f"INSERT IGNORE INTO `{ARCHIVE_TABLE}` ({ARCHIVE_COLUMNS}) "
+                            f"SELECT {ARCHIVE_COLUMNS} FROM messages PARTITION ({name})"
+                        )
+                        self.archived_total += cursor.rowcount
+                    cursor.execute(f"ALTER TABLE messages DROP PARTITION {name}")
+            self.partitions_dropped_total += 1
+            logging.info(f"已删除过期消息分区 {name}")
+
+    def stats(self) -> dict:
+        return {
+            "retention_days": self.retention_days,
+            "partitioning": self.partitioning,
+            "last_run": self.last_run,
+            "last_duration": round(self.last_duration, 3),
+            "deleted_total": self.deleted_total,
+            "archived_total": self.archived_total,
+            "partitions_dropped_total": self.partitions_dropped_total
+        }
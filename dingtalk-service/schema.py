@@ -0,0 +1,250 @@
+# messages 表结构管理与迁移
+# 启动时由存储后端调用 migrate() 创建或升级表结构，再调用 check_query_plans() 用 EXPLAIN 检查消息查询是否走索引
+# 也可以单独执行 `python schema.py` 完成迁移
+import logging
+
+SCHEMA_VERSION_TABLE = "schema_version"
+
+ARCHIVE_TABLE = "messages_archive"
+
+# 归档时显式列出字段，避免 messages 表结构变化后 INSERT ... SELECT * 出错
+ARCHIVE_COLUMNS = "`id`, `robot_name`, `sender_name`, `message_content`, `timestamp`, `conversationTitle`, `msg_id`"
+
+CREATE_SCHEMA_VERSION_TABLE = f"""
+    CREATE TABLE IF NOT EXISTS `{SCHEMA_VERSION_TABLE}` (
+        `version` INT NOT NULL PRIMARY KEY,
+        `description` VARCHAR(255) NOT NULL,
+        `applied_at` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+"""
+
+CREATE_MESSAGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS `messages` (
+        `id` INT AUTO_INCREMENT PRIMARY KEY, -- 自增主键
+        `robot_name` VARCHAR(255) NOT NULL, -- 机器人名称
+        `sender_name` VARCHAR(255) NOT NULL, -- 发送者名称
+        `message_content` TEXT NOT NULL, -- 消息内容
+        `timestamp` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, -- 时间戳
+        `conversationTitle` VARCHAR(255) NOT NULL -- 群聊标题
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+"""
+
+# 钉钉消息 id（msgId），钉钉超时重试时会重复投递同一条消息，唯一索引保证只写入一次
+MSG_ID_COLUMN = "`msg_id` VARCHAR(64) NULL"
+MSG_ID_UNIQUE_INDEX = "uk_msg_id"
+MSG_ID_INDEX = "idx_msg_id"  # 分区表无法建立不含分区列的唯一索引，改用普通索引
+
+# 与 get_messages 的访问路径对应的复合索引：
+# 先按 robot_name 等值过滤，再按发送者/群聊标题 IN 过滤，最后按 timestamp 范围过滤并排序
+MESSAGE_INDEXES = {
+    "idx_robot_timestamp": "(`robot_name`, `timestamp`)",
+    "idx_robot_sender_timestamp": "(`robot_name`, `sender_name`, `timestamp`)",
+    "idx_robot_title_timestamp": "(`robot_name`, `conversationTitle`, `timestamp`)",
+    "idx_timestamp": "(`timestamp`)"  # 未指定 agent_id 的查询
+}
+
+
+def get_existing_indexes(cursor, table: str) -> set:
+    """返回表上已有的索引名"""
+    cursor.execute(
+        "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,)
+    )
+    return {row["INDEX_NAME"] for row in cursor.fetchall()}
+
+
+def _create_messages_table(cursor):
+    cursor.execute(CREATE_MESSAGES_TABLE)
+
+
+def _add_message_indexes(cursor):
+    existing = get_existing_indexes(cursor, "messages")
+    for name, columns in MESSAGE_INDEXES.items():
+        if name in existing:
+            continue
+        logging.info(f"为 messages 表添加索引 {name} {columns}")
+        cursor.execute(f"ALTER TABLE `messages` ADD INDEX `{name}` {columns}")
+
+
+def get_existing_columns(cursor, table: str) -> set:
+    """返回表上已有的列名，表不存在时返回空集合"""
+    cursor.execute(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,)
+    )
+    return {row["COLUMN_NAME"] for row in cursor.fetchall()}
+
+
+def is_partitioned(cursor, table: str) -> bool:
+    cursor.execute(
+        "SELECT COUNT(*) AS count FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL",
+        (table,)
+    )
+    return bool(cursor.fetchone()["count"])
+
+
+def _add_msg_id(cursor):
+    if "msg_id" not in get_existing_columns(cursor, "messages"):
+        logging.info("为 messages 表添加 msg_id 列")
+        cursor.execute(f"ALTER TABLE `messages` ADD COLUMN {MSG_ID_COLUMN}")
+    existing = get_existing_indexes(cursor, "messages")
+    if MSG_ID_UNIQUE_INDEX not in existing and MSG_ID_INDEX not in existing:
+        if is_partitioned(cursor, "messages"):
+            logging.warning("messages 表已分区，msg_id 只能建立普通索引，重复消息由内存去重和写入前检查过滤")
+            cursor.execute(f"ALTER TABLE `messages` ADD INDEX `{MSG_ID_INDEX}` (`msg_id`)")
+        else:
+            cursor.execute(f"ALTER TABLE `messages` ADD UNIQUE INDEX `{MSG_ID_UNIQUE_INDEX}` (`msg_id`)")
+    # 已存在的归档表同步添加该列，ARCHIVE_COLUMNS 包含 msg_id
+    archive_columns = get_existing_columns(cursor, ARCHIVE_TABLE)
+    if archive_columns and "msg_id" not in archive_columns:
+        cursor.execute(f"ALTER TABLE `{ARCHIVE_TABLE}` ADD COLUMN {MSG_ID_COLUMN}")
+
+
+# 迁移列表：(版本号, 说明, 执行函数)，每一步都需可重复执行
+MIGRATIONS = [
+    (1, "创建 messages 表", _create_messages_table),
+    (2, "添加消息查询复合索引", _add_message_indexes),
+    (3, "添加钉钉消息 id 列及唯一索引", _add_msg_id),
+]
+
+
+def get_schema_version(cursor) -> int:
+    """返回当前已应用的最高迁移版本"""
+    cursor.execute(CREATE_SCHEMA_VERSION_TABLE)
+    cursor.execute(f"SELECT MAX(`version`) AS version FROM `{SCHEMA_VERSION_TABLE}`")
+    row = cursor.fetchone()
+    return (row or {}).get("version") or 0
+
+
+def migrate(connection) -> int:
+    """执行尚未应用的迁移，返回迁移后的版本号"""
+    with connection.cursor() as cursor:
+        version = get_schema_version(cursor)
+        for target, description, apply in MIGRATIONS:
+            if target <= version:
+                continue
+            logging.info(f"执行数据库迁移 {target}: {description}")
+            apply(cursor)
+            cursor.execute(
+                f"INSERT INTO `{SCHEMA_VERSION_TABLE}` (`version`, `description`) VALUES (%s, %s)",
+                (target, description)
+            )
+            connection.commit()
+            version = target
+    logging.info(f"数据库表结构版本: {version}")
+    return version
+
+
+def check_query_plans(connection, queries) -> bool:
+    """对典型查询执行 EXPLAIN，查询无法使用索引时输出警告
+
+    queries 为 (名称, sql, 参数) 列表，全部查询都能使用索引时返回 True
+    """
+    all_indexed = True
+    with connection.cursor() as cursor:
+        for name, sql, params in queries:
+            try:
+                cursor.execute(f"EXPLAIN {sql}", params)
+                plan = cursor.fetchall()
+            except Exception as e:
+                logging.warning(f"EXPLAIN 执行失败 ({name}): {e}")
+                continue
+
+            for row in plan:
+                if row.get("table") != "messages":
+                    continue
+                if row.get("key"):
+                    logging.info(f"查询 {name} 使用索引 {row['key']}")
+                elif row.get("possible_keys"):
+                    # 表数据很少时优化器可能选择全表扫描，不视为问题
+                    logging.info(f"查询 {name} 有可用索引 {row['possible_keys']}，但优化器选择了全表扫描")
+                else:
+                    all_indexed = False
+                    logging.warning(f"查询 {name} 无可用索引，将进行全表扫描 (type={row.get('type')})，"
+                                    f"请检查 messages 表索引或执行 python schema.py")
+    return all_indexed
+
+
+# ==================== SQLite ====================
+
+SQLITE_CREATE_MESSAGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        robot_name TEXT NOT NULL,
+        sender_name TEXT NOT NULL,
+        message_content TEXT NOT NULL,
+        timestamp TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+        conversationTitle TEXT NOT NULL
+    )
+"""
+
+
+def _sqlite_create_messages_table(connection):
+    connection.execute(SQLITE_CREATE_MESSAGES_TABLE)
+
+
+def _sqlite_add_message_indexes(connection):
+    for name, columns in MESSAGE_INDEXES.items():
+        connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON messages {columns.replace('`', '')}")
+
+
+def _sqlite_columns(connection, table: str) -> set:
+    return {row[1] for row in connection.execute(f"PRAGMA table_info({table})").fetchall()}
+
+
+def _sqlite_add_msg_id(connection):
+    if "msg_id" not in _sqlite_columns(connection, "messages"):
+        connection.execute("ALTER TABLE messages ADD COLUMN msg_id TEXT")
+    connection.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {MSG_ID_UNIQUE_INDEX} ON messages (msg_id)")
+    archive_columns = _sqlite_columns(connection, ARCHIVE_TABLE)
+    if archive_columns and "msg_id" not in archive_columns:
+        connection.execute(f"ALTER TABLE {ARCHIVE_TABLE} ADD COLUMN msg_id TEXT")
+
+
+# SQLite 迁移列表，版本号记录在 PRAGMA user_version 中
+SQLITE_MIGRATIONS = [
+    (1, "创建 messages 表", _sqlite_create_messages_table),
+    (2, "添加消息查询复合索引", _sqlite_add_message_indexes),
+    (3, "添加钉钉消息 id 列及唯一索引", _sqlite_add_msg_id),
+]
+
+
+def migrate_sqlite(connection) -> int:
+    """执行尚未应用的 SQLite 迁移，返回迁移后的版本号"""
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    for target, description, apply in SQLITE_MIGRATIONS:
+        if target <= version:
+            continue
+        logging.info(f"执行数据库迁移 {target}: {description}")
+        apply(connection)
+        connection.execute(f"PRAGMA user_version = {target}")
+        connection.commit()
+        version = target
+    logging.info(f"数据库表结构版本: {version}")
+    return version
+
+
+def check_sqlite_query_plans(connection, queries) -> bool:
+    """对典型查询执行 EXPLAIN QUERY PLAN，对 messages 表全表扫描时输出警告"""
+    all_indexed = True
+    for name, sql, params in queries:
+        try:
+            plan = connection.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        except Exception as e:
+            logging.warning(f"EXPLAIN 执行失败 ({name}): {e}")
+            continue
+        details = [row[-1] for row in plan]
+        if any(detail.startswith("SCAN messages") for detail in details):
+            all_indexed = False
+            logging.warning(f"查询 {name} 将进行全表扫描: {details}，请检查 messages 表索引")
+        else:
+            logging.info(f"查询 {name} 执行计划: {details}")
+    return all_indexed
+
+
+if __name__ == '__main__':
+    from serve import init_database
+
+    init_database()
@@ -1,9 +1,10 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, send_file, abort, g
 import hashlib
 import hmac
 import base64
-import pymysql
+import gzip
 import logging
+import re
 import time
 from typing import List, Dict
 from alibabacloud_dingtalk.robot_1_0.client import Client as dingtalkrobot_1_0Client
@@ -18,6 +19,20 @@ import threading
 import uuid
 from datetime import datetime, timedelta
 import secrets
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from storage import create_store
+from token_manager import TokenManager
+from media_cache import MediaCache
+from retention import RetentionWorker
+from ingest import IngestQueue, IngestJob, BatchWriter, PendingWrite
+from metrics import Registry, ActiveClientTracker
+from ratelimit import TokenBucketLimiter
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # 未安装时紧凑格式只使用 JSON
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -27,6 +42,45 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = secrets.token_hex(16)
 
 
+# 运行指标，由 /metrics 端点以 Prometheus 文本格式输出
+# 指标保存在进程内，gunicorn 多进程部署时每次抓取只反映处理该请求的工作进程
+metrics_registry = Registry()
+http_requests_total = metrics_registry.counter(
+    "http_requests_total", "HTTP 请求数", ("route", "method", "status"))
+http_request_duration = metrics_registry.histogram(
+    "http_request_duration_seconds", "HTTP 请求处理耗时（推送连接只统计到开始推送）", ("route",))
+db_query_duration = metrics_registry.histogram(
+    "db_query_duration_seconds", "数据库操作耗时", ("operation",))
+db_errors_total = metrics_registry.counter("db_errors_total", "数据库操作失败次数", ("operation",))
+dingtalk_api_duration = metrics_registry.histogram(
+    "dingtalk_api_duration_seconds", "钉钉 API 调用耗时", ("api",))
+dingtalk_api_errors_total = metrics_registry.counter("dingtalk_api_errors_total", "钉钉 API 调用失败次数", ("api",))
+query_cache_requests_total = metrics_registry.counter(
+    "query_cache_requests_total", "消息查询缓存命中/未命中次数", ("result",))
+webhook_rejected_total = metrics_registry.counter(
+    "webhook_rejected_total", "时间戳或签名校验失败的 webhook 请求数", ("reason",))
+duplicate_messages_total = metrics_registry.counter(
+    "duplicate_messages_total", "按 msgId 丢弃的重复消息数（内存/写入前查库/写入时唯一索引）", ("stage",))
+stream_connections = metrics_registry.gauge("stream_connections", "当前推送连接数")  # 不按 agent_id 区分，避免任意请求参数产生新的指标序列
+ACTIVE_CLIENT_WINDOW = 60  # 该时间内请求过消息的客户端视为活跃（秒），应大于客户端轮询间隔
+active_clients = ActiveClientTracker(ACTIVE_CLIENT_WINDOW)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        http_request_duration.observe(time.perf_counter() - started, route)
+        http_requests_total.inc(route, request.method, str(response.status_code))
+    return response
+
+
 # 解决跨域问题
 @app.after_request
 def after_request(response):
@@ -36,7 +90,63 @@ def after_request(response):
     return response
 
 
-# 数据库配置
+# 压缩 JSON 响应
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-msgpack'}
+
+
+@app.after_request
+def compress_response(response):
+    """客户端支持 gzip 时压缩较大的 JSON 响应，推送流和附件不压缩"""
+    if (not gzip_config["enabled"] or response.status_code != 200 or response.is_streamed
+            or response.direct_passthrough or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+    body = response.get_data()
+    if len(body) < gzip_config["min_size"]:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=gzip_config["level"]))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    # 压缩后字节不同，强 ETag 改为弱 ETag；If-None-Match 按弱比较，304 判断不受影响
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# 生产环境服务配置，由 wsgi.py 读取；python serve.py 启动的开发服务器只使用 host 和 port
+server_config = {
+    "host": "0.0.0.0",
+    "port": 20000,
+    "workers": 1,  # 工作进程数（仅 gunicorn）；多进程时每个进程每秒查一次最大消息 id 来感知其他进程写入的消息
+    "threads": 256,  # 每个进程的线程数，每条推送长连接占用一个线程，应大于 max_streams
+    "max_streams": 200,  # 每个进程最多保持的推送连接数，超出时返回 503，客户端回退为轮询
+    "stream_reserved_threads": 32,  # 至少留给 webhook 和轮询请求的线程数，推送连接不会占用
+    "change_watch_interval": 1.0,  # 多进程部署时检查其他进程新写入消息的间隔（秒）
+    "keepalive": 75,  # HTTP keep-alive 空闲连接保持时间（秒），应大于客户端轮询间隔
+    "timeout": 60,  # 请求处理超时（秒），超时的 gunicorn 工作进程会被重启
+    "graceful_timeout": 30,  # 重启/停止时等待进行中请求的时间（秒）
+    "max_requests": 0,  # 每个进程处理多少请求后重启，0 表示不重启
+    "backlog": 2048,  # 等待 accept 的连接队列长度
+    "connection_limit": 1000  # 同时保持的最大连接数（仅 waitress）
+}
+
+# 响应压缩配置
+gzip_config = {
+    "enabled": True,
+    "min_size": 1024,  # 小于该字节数的响应不压缩
+    "level": 6  # 压缩级别 1-9
+}
+
+# 存储后端配置
+storage_config = {
+    "backend": "mysql",  # mysql 或 sqlite，sqlite 无需单独部署数据库服务
+    "sqlite_path": "./data/messages.db",  # SQLite 数据库文件路径
+    "sqlite_busy_timeout": 5  # SQLite 等待写锁的超时（秒）
+}
+
+# 数据库配置（MySQL）
 db_config = {
     "host": "localhost",
     "user": "",
@@ -44,6 +154,74 @@ db_config = {
     "database": ""
 }
 
+# 数据库连接池配置（MySQL）
+db_pool_config = {
+    "max_size": 10,  # 最大连接数
+    "acquire_timeout": 5,  # 获取连接的最长等待时间（秒）
+    "ping_interval": 30,  # 空闲超过该时间的连接在使用前先检测是否可用（秒）
+    "max_lifetime": 3600,  # 连接最长存活时间，到期后重建（秒）
+    "connect_timeout": 5,  # 建立连接超时（秒）
+    "read_timeout": 30  # 查询读取超时（秒）
+}
+
+# 表结构配置
+schema_config = {
+    "auto_migrate": True,  # 启动时自动创建/升级 messages 表及索引
+    "explain_check": True  # 启动时用 EXPLAIN 检查消息查询是否使用索引
+}
+
+# webhook 异步处理配置
+ingest_config = {
+    "workers": 4,  # 处理线程数
+    "max_size": 1000,  # 队列容量，队列满时返回 503 由钉钉重试
+    "max_attempts": 12,  # 单条消息的最多尝试次数，按指数退避重试约半小时
+    "retry_delay": 2,  # 首次重试前的等待时间（秒），之后每次加倍
+    "max_retry_delay": 300,  # 两次重试之间的最长等待时间（秒）
+    "degraded_window": 60,  # 该时间（秒）内最近一次处理失败时，webhook 返回 503 由钉钉重试
+    "batch_max_rows": 50,  # 合并写入的最大行数
+    "batch_max_delay": 0.005  # 合并写入的最长等待时间（秒）
+}
+
+# 消息接口限流配置，按 AgentId + 客户端（地址与客户端标识）分别限流，同一地址的所有客户端再共用一个总量限制
+rate_limit_config = {
+    "enabled": True,
+    "rate": 0.5,  # 每个客户端每秒补充的请求数，正常客户端每10秒轮询一次
+    "burst": 10,  # 允许的突发请求数（启动时全量同步、推送重连等）
+    "max_clients": 10000,  # 最多跟踪的客户端数
+    "address_rate": 30,  # 每个地址每秒补充的请求数：同一出口地址后约 200 台电脑每10秒轮询一次需 20 次/秒，另留推送重连余量
+    "address_burst": 400,  # 每个地址允许的突发请求数，约为 200 台电脑同时重启后各自全量同步并重连推送，伪造 X-Client-Id 也无法超过该总量
+    "max_addresses": 10000,  # 最多跟踪的地址数
+    "trust_forwarded_for": False  # 部署在 nginx 等反向代理之后时设为 True，使用 X-Forwarded-For 中的客户端地址
+}
+
+# webhook 签名校验配置
+signature_config = {
+    "max_skew": 3600,  # 请求头 timestamp 与本机时间的最大允许偏差（秒），钉钉要求 1 小时内
+    "replay_cache_size": 10000  # 记录最近收到的请求数，用于丢弃重复投递
+}
+
+# 附件镜像配置，开启后附件在入库时下载到本服务，客户端从局域网下载而不是钉钉 CDN
+media_config = {
+    "enabled": False,  # 是否镜像附件
+    "root": "./data/media",  # 附件存放目录
+    "public_base_url": "",  # 客户端访问本服务的地址，如 http://192.168.1.10:20000
+    "max_bytes": 100 * 1024 * 1024,  # 单个附件大小上限（字节）
+    "timeout": 60  # 下载超时（秒）
+}
+
+# 消息保留配置，客户端只展示近7天的消息，保留期应不少于7天
+retention_config = {
+    "enabled": False,  # 是否启动后台清理线程，默认关闭：开启后会删除超过保留天数的历史消息，请确认后再开启
+    "retention_days": 30,  # 消息保留天数
+    "archive": False,  # 删除前是否复制到 messages_archive 表
+    "batch_size": 1000,  # 每批删除的行数
+    "batch_pause": 0.5,  # 批次之间的暂停时间（秒）
+    "interval": 3600,  # 两次清理之间的间隔（秒）
+    "max_threads_running": 20,  # 数据库 Threads_running 超过该值时暂停清理
+    "partitioning": False,  # 是否将 messages 表改为按天分区（会重建表并修改主键）
+    "partition_days_ahead": 3  # 预先创建未来几天的分区
+}
+
 # 钉钉机器人配置（多个机器人）
 robots = {
     "": {  # AppKey
@@ -53,8 +231,189 @@ robots = {
     # 可以继续增加更多的机器人配置
 }
 
-# 缓存 access_token 的字典，格式: {robot_code: {"token": token, "expire_time": expire_time}}
-access_token_cache: Dict[str, dict] = {}
+# access_token 管理配置
+token_config = {
+    "refresh_margin": 300,  # 过期前多少秒由后台线程主动刷新
+    "refresh_interval": 60,  # 后台线程检查间隔（秒）
+    "cache_path": "./data/token_cache.json"  # 磁盘缓存路径，重启后继续使用未过期的 token；为空则不持久化
+}
+
+# 推送连接配置
+STREAM_HEARTBEAT_SECONDS = 15  # 空闲时发送心跳的间隔
+STREAM_RESYNC_SECONDS = 30  # 未收到通知时也定期查库，兼容多进程部署
+STREAM_REJECT_RETRY_SECONDS = 300  # 推送连接数已满时建议客户端重试的间隔
+
+
+class StreamCounter:
+    """统计本进程当前保持的推送连接数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+
+    @property
+    def count(self) -> int:
+        with self._lock:
+            return self._count
+
+    def try_acquire(self, limit: int):
+        """连接数未达 limit 时占用一个名额并返回释放函数，否则返回 None；检查与占用在同一把锁内完成"""
+        with self._lock:
+            if self._count >= limit:
+                return None
+            self._count += 1
+
+        released = []
+
+        def release():
+            # 生成器结束和响应关闭时都会调用，只释放一次
+            with self._lock:
+                if not released:
+                    released.append(True)
+                    self._count -= 1
+
+        return release
+
+
+open_streams = StreamCounter()
+
+
+def max_streams() -> int:
+    """推送连接上限：不超过 max_streams，并为其他请求保留 stream_reserved_threads 个线程"""
+    return max(0, min(server_config["max_streams"],
+                      server_config["threads"] - server_config["stream_reserved_threads"]))
+
+
+class MessageNotifier:
+    """新消息通知器，root_webhook 插入消息后唤醒所有等待中的推送连接"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        with self._condition:
+            return self._version
+
+    def notify(self):
+        """通知有新消息写入"""
+        with self._condition:
+            self._version += 1
+            self._condition.notify_all()
+
+    def wait(self, version: int, timeout: float) -> int:
+        """等待版本号变化或超时，返回当前版本号"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._version != version, timeout)
+            return self._version
+
+
+message_notifier = MessageNotifier()
+
+# 查询结果缓存配置
+QUERY_CACHE_TTL = 30  # 缓存有效期（秒），保证7天滚动窗口能随时间推进
+QUERY_CACHE_MAX_ENTRIES = 256  # 最多缓存的过滤条件组合数
+
+
+class QueryCache:
+    """按规范化后的过滤条件缓存 get_messages 的响应体，写入新消息时整体失效"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expire_at, body, etag)
+        self._generation = 0
+
+    @staticmethod
+    def make_key(agent_id, sender_names, conversation_titles, since_id, response_format: str = "full") -> tuple:
+        """IN 子句与顺序、重复无关，排序去重后作为缓存键；不同响应格式分别缓存"""
+        senders = tuple(sorted(set(sender_names.split(',')))) if sender_names else ()
+        titles = tuple(sorted(set(conversation_titles.split(',')))) if conversation_titles else ()
+        return agent_id or "", senders, titles, since_id, response_format
+
+    @property
+    def generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def get(self, key):
+        """返回 (body, etag)，未命中或已过期返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expire_at, body, etag = entry
+            if expire_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return body, etag
+
+    def put(self, key, body: bytes, etag: str, generation: int):
+        """写入缓存；若查询期间缓存已失效（有新消息写入）则丢弃结果"""
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """清空缓存"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "generation": self._generation}
+
+
+query_cache = QueryCache(QUERY_CACHE_TTL, QUERY_CACHE_MAX_ENTRIES)
+
+# 紧凑响应格式：客户端请求 format=compact 时只返回客户端用到的字段，每条消息为按 fields 顺序排列的数组，
+# 时间戳为整数秒级时间戳；请求头 Accept 优先 application/x-msgpack 且服务端已安装 msgpack 时使用 MessagePack 编码
+COMPACT_FIELDS = ["id", "conversationTitle", "sender_name", "message_content", "timestamp"]
+MSGPACK_MIMETYPE = "application/x-msgpack"
+RESPONSE_MIMETYPES = {"full": "application/json", "compact": "application/json", "compact-msgpack": MSGPACK_MIMETYPE}
+
+
+def to_epoch(value):
+    """数据库中的时间为服务器本地时间，转换为秒级时间戳"""
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    return value
+
+
+def compact_rows(rows: List[Dict]) -> List[list]:
+    return [[row["id"], row["conversationTitle"], row["sender_name"], row["message_content"],
+             to_epoch(row["timestamp"])] for row in rows]
+
+
+def negotiate_response_format() -> str:
+    """根据请求参数和 Accept 请求头选择响应格式：full、compact 或 compact-msgpack"""
+    if request.args.get('format') != 'compact':
+        return "full"
+    if msgpack is not None and request.accept_mimetypes.best_match(
+            ['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+        return "compact-msgpack"
+    return "compact"
+
+
+def encode_messages(rows: List[Dict], mode: str, response_format: str) -> bytes:
+    """按响应格式编码消息列表"""
+    if response_format == "full":
+        response_data = {"type": "messages", "mode": mode, "data": rows}
+        return app.json.dumps(response_data).encode('utf-8')
+
+    response_data = {"type": "messages", "mode": mode, "format": "compact",
+                     "fields": COMPACT_FIELDS, "data": compact_rows(rows)}
+    if response_format == "compact-msgpack":
+        return msgpack.packb(response_data, use_bin_type=True)
+    return json.dumps(response_data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
 
 # ==================== 工具函数 ====================
@@ -76,23 +435,85 @@ def create_oauth_client() -> dingtalkoauth2_1_0Client:
     return dingtalkoauth2_1_0Client(config)
 
 
-# 获取数据库连接
-def get_db_connection():
-    """连接到数据库并返回连接对象"""
+# 钉钉 API 调用的运行时参数
+DINGTALK_CONNECT_TIMEOUT = 5000  # 毫秒
+DINGTALK_READ_TIMEOUT = 10000  # 毫秒
+DINGTALK_MAX_IDLE_CONNS = 20  # 保持的空闲连接数
+
+
+def create_runtime_options() -> util_models.RuntimeOptions:
+    """创建启用长连接的运行时参数"""
+    runtime = util_models.RuntimeOptions()
+    runtime.connect_timeout = DINGTALK_CONNECT_TIMEOUT
+    runtime.read_timeout = DINGTALK_READ_TIMEOUT
+    runtime.max_idle_conns = DINGTALK_MAX_IDLE_CONNS
+    runtime.keep_alive = True
+    return runtime
+
+
+class DingTalkClientRegistry:
+    """长期复用的钉钉 SDK 客户端
+
+    客户端只保存配置，每次调用都在局部构造请求，可以在线程间共享；首次使用时创建，
+    之后所有 webhook 处理线程复用同一个客户端和运行时参数，避免每次调用都重新初始化配置与连接。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._robot_client = None
+        self._oauth_client = None
+        self.runtime = create_runtime_options()
+
+    def robot(self) -> dingtalkrobot_1_0Client:
+        if self._robot_client is None:
+            with self._lock:
+                if self._robot_client is None:
+                    self._robot_client = create_dingtalk_client()
+        return self._robot_client
+
+    def oauth(self) -> dingtalkoauth2_1_0Client:
+        if self._oauth_client is None:
+            with self._lock:
+                if self._oauth_client is None:
+                    self._oauth_client = create_oauth_client()
+        return self._oauth_client
+
+
+dingtalk_clients = DingTalkClientRegistry()
+
+
+# 消息存储后端，webhook 写入与消息查询共用
+store = create_store(storage_config, db_config, db_pool_config)
+
+
+# 向钉钉请求 access_token
+def fetch_access_token(robot_code: str):
+    """请求新的 access_token，返回 (token, 有效期秒数)，失败时抛出异常"""
+    app_key = robot_code  # robotCode 通常即为 AppKey
+    app_secret = robots[robot_code]["app_secret"]
+
+    client = dingtalk_clients.oauth()
+    request = dingtalkoauth2__1__0_models.GetAccessTokenRequest(
+        app_key=app_key,
+        app_secret=app_secret
+    )
+    started = time.perf_counter()
     try:
-        connection = pymysql.connect(
-            host=db_config["host"],
-            user=db_config["user"],
-            password=db_config["password"],
-            database=db_config["database"],
-            cursorclass=pymysql.cursors.DictCursor,
-            autocommit=True
-        )
-        logging.info("数据库连接成功")
-        return connection
-    except Exception as e:
-        logging.error(f"数据库连接错误: {e}")
-        return None
+        response = client.get_access_token_with_options(request, {}, dingtalk_clients.runtime)
+    except Exception:
+        dingtalk_api_errors_total.inc("get_access_token")
+        raise
+    finally:
+        dingtalk_api_duration.observe(time.perf_counter() - started, "get_access_token")
+    return response.body.access_token, response.body.expire_in
+
+
+# access_token 缓存，同一机器人同一时间只会有一个刷新请求
+token_manager = TokenManager(
+    fetch_access_token,
+    refresh_margin=token_config["refresh_margin"],
+    cache_path=token_config["cache_path"] or None
+)
 
 
 # 获取 access_token
@@ -102,68 +523,235 @@ def get_access_token(robot_code: str) -> str:
         logging.error(f"无效的 robotCode: {robot_code}")
         return ""
 
-    app_key = robot_code  # robotCode 通常即为 AppKey
-    app_secret = robots[robot_code]["app_secret"]
+    token_manager.start_background_refresh(robots.keys(), token_config["refresh_interval"])
+    return token_manager.get(robot_code)
 
-    # 检查缓存
-    current_time = int(time.time() * 1000)  # 当前时间（毫秒）
-    cached = access_token_cache.get(robot_code, {})
-    if cached and cached.get("expire_time", 0) > current_time + 60000:  # 提前 1 分钟刷新
-        logging.info(f"使用缓存的 access_token for {robot_code}")
-        return cached["token"]
 
-    # 请求新的 access_token
-    client = create_oauth_client()
-    request = dingtalkoauth2__1__0_models.GetAccessTokenRequest(
-        app_key=app_key,
-        app_secret=app_secret
-    )
+# 验证时间戳
+def verify_timestamp(timestamp) -> bool:
+    """请求头中的 timestamp 为毫秒时间戳，与本机时间偏差超过 max_skew 的请求视为过期"""
     try:
-        response = client.get_access_token(request)
-        access_token = response.body.access_token
-        expires_in = response.body.expire_in * 1000  # 转换为毫秒
-        expire_time = current_time + expires_in
-
-        # 更新缓存
-        access_token_cache[robot_code] = {
-            "token": access_token,
-            "expire_time": expire_time
-        }
-        logging.info(f"成功获取新的 access_token for {robot_code}, 有效期至: {expire_time}")
-        return access_token
-    except Exception as e:
-        logging.error(f"获取 access_token 失败 for {robot_code}: {e}")
-        return ""
+        timestamp_ms = int(timestamp)
+    except (TypeError, ValueError):
+        return False
+    return abs(time.time() * 1000 - timestamp_ms) <= signature_config["max_skew"] * 1000
 
 
 # 验证签名
 def verify_signature(app_secret, timestamp, sign):
     """验证请求的签名是否有效"""
+    if not timestamp or not sign:
+        return False
     string_to_sign = f'{timestamp}\n{app_secret}'
     hmac_code = hmac.new(app_secret.encode('utf-8'), string_to_sign.encode('utf-8'), digestmod=hashlib.sha256).digest()
     expected_sign = base64.b64encode(hmac_code).decode('utf-8')
     logging.debug(f"预期签名: {expected_sign}, 收到签名: {sign}")
-    return expected_sign == sign
+    # 常量时间比较，避免通过响应时间逐字节猜测签名
+    return hmac.compare_digest(expected_sign.encode('utf-8'), sign.encode('utf-8'))
+
+
+class ReplayCache:
+    """记录最近收到的 webhook 请求，丢弃重复投递和重放
+
+    签名只由 timestamp 和 app_secret 计算，不覆盖请求体，因此以 (timestamp, sign, 请求体摘要) 作为键；
+    超出时间窗口的请求已被 verify_timestamp 拒绝，记录只需保留 max_skew 秒。
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> 过期时间
+
+        # 统计信息
+        self.accepted_total = 0
+        self.duplicate_total = 0
+
+    @staticmethod
+    def make_key(timestamp: str, sign: str, body: bytes) -> tuple:
+        return timestamp, sign, hashlib.sha256(body).digest()
+
+    def check_and_add(self, key: tuple) -> bool:
+        """首次出现返回 True 并记录，重复出现返回 False"""
+        now = time.monotonic()
+        with self._lock:
+            expire_at = self._entries.get(key)
+            if expire_at is not None and expire_at > now:
+                self.duplicate_total += 1
+                return False
+            self._entries[key] = now + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.accepted_total += 1
+            return True
+
+    def discard(self, key: tuple):
+        """请求未能入队或最终处理失败时撤销记录，使钉钉的重试不被当作重复投递"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.accepted_total + self.duplicate_total
+            return {
+                "entries": len(self._entries),
+                "accepted_total": self.accepted_total,
+                "duplicate_total": self.duplicate_total,
+                "duplicate_ratio": round(self.duplicate_total / total, 4) if total else 0
+            }
+
+
+replay_cache = ReplayCache(signature_config["max_skew"] * 2, signature_config["replay_cache_size"])
+
+# 钉钉消息 id 去重配置
+RECENT_MSG_ID_MAX_ENTRIES = 10000  # 内存中记录的最近消息 id 数
+
+
+class RecentMessageIds:
+    """最近已接收的钉钉消息 id，重复投递在入队前被丢弃；数据库唯一索引兜底跨进程和重启后的重复"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._ids = OrderedDict()
+
+    def add(self, key) -> bool:
+        """首次出现返回 True 并记录，已存在返回 False"""
+        with self._lock:
+            if key in self._ids:
+                self._ids.move_to_end(key)
+                return False
+            self._ids[key] = None
+            while len(self._ids) > self.max_entries:
+                self._ids.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        """消息最终未能写入时移除，使钉钉的重试能够重新处理"""
+        with self._lock:
+            self._ids.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ids)
+
+
+recent_msg_ids = RecentMessageIds(RECENT_MSG_ID_MAX_ENTRIES)
+
+
+# 下载链接转换配置
+MEDIA_RESOLVE_WORKERS = 4  # 并发转换 downloadCode 的线程数
+DOWNLOAD_URL_CACHE_TTL = 300  # 下载链接缓存有效期（秒），钉钉下载链接本身会过期，不宜过长
+DOWNLOAD_URL_CACHE_MAX_ENTRIES = 1024
+
+
+class DownloadUrlCache:
+    """短期缓存 downloadCode 转换结果，重复的 downloadCode 不再请求钉钉"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (robot_code, download_code) -> (expire_at, url)
+        self.hits_total = 0
+        self.misses_total = 0
+
+    def get(self, robot_code: str, download_code: str):
+        key = (robot_code, download_code)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses_total += 1
+                return None
+            self.hits_total += 1
+            return entry[1]
+
+    def put(self, robot_code: str, download_code: str, url: str):
+        with self._lock:
+            self._entries[(robot_code, download_code)] = (time.monotonic() + self.ttl, url)
+            self._entries.move_to_end((robot_code, download_code))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits_total": self.hits_total, "misses_total": self.misses_total}
+
+
+download_url_cache = DownloadUrlCache(DOWNLOAD_URL_CACHE_TTL, DOWNLOAD_URL_CACHE_MAX_ENTRIES)
+
+# 多图消息的 downloadCode 并发转换线程池
+media_executor = ThreadPoolExecutor(max_workers=MEDIA_RESOLVE_WORKERS, thread_name_prefix="MediaResolver")
 
 
 # 将 downloadCode 转换为下载链接
 def get_download_url(download_code: str, robot_code: str, access_token: str) -> str:
     """通过钉钉 API 将 downloadCode 转换为下载链接"""
-    client = create_dingtalk_client()
+    cached = download_url_cache.get(robot_code, download_code)
+    if cached:
+        return cached
+
+    client = dingtalk_clients.robot()
     headers = dingtalkrobot__1__0_models.RobotMessageFileDownloadHeaders()
     headers.x_acs_dingtalk_access_token = access_token
     request = dingtalkrobot__1__0_models.RobotMessageFileDownloadRequest(
         download_code=download_code,
         robot_code=robot_code
     )
+    started = time.perf_counter()
     try:
-        response = client.robot_message_file_download_with_options(request, headers, util_models.RuntimeOptions())
-        return response.body.download_url if hasattr(response.body, 'download_url') else "转换失败"
+        try:
+            response = client.robot_message_file_download_with_options(request, headers, dingtalk_clients.runtime)
+        finally:
+            dingtalk_api_duration.observe(time.perf_counter() - started, "robot_message_file_download")
+        if not hasattr(response.body, 'download_url'):
+            return "转换失败"
+        download_url = response.body.download_url
+        download_url_cache.put(robot_code, download_code, download_url)
+        return download_url
     except Exception as err:
+        dingtalk_api_errors_total.inc("robot_message_file_download")
         logging.error(f"获取下载链接失败: {err}")
         return f"获取下载链接失败: {err}"
 
 
+# 附件镜像，未开启或未配置访问地址时为 None
+media_cache = None
+if media_config["enabled"]:
+    if media_config["public_base_url"]:
+        media_cache = MediaCache(
+            media_config["root"],
+            media_config["public_base_url"],
+            max_bytes=media_config["max_bytes"],
+            timeout=media_config["timeout"]
+        )
+    else:
+        logging.warning("未配置 media_config['public_base_url']，附件镜像未启用")
+
+
+# 获取附件地址
+def get_media_url(download_code: str, robot_code: str, access_token: str, file_name: str = "") -> str:
+    """转换 downloadCode，开启附件镜像时返回局域网地址，否则返回钉钉下载链接"""
+    download_url = get_download_url(download_code, robot_code, access_token)
+    if media_cache is None or not download_url.startswith(("http://", "https://")):
+        return download_url
+    return media_cache.mirror(download_url, file_name)
+
+
+# 批量转换 downloadCode
+def resolve_download_urls(download_codes: List[str], robot_code: str, access_token: str) -> List[str]:
+    """并发转换多个 downloadCode，返回与输入顺序一致的附件地址列表"""
+    unique_codes = list(dict.fromkeys(download_codes))
+    if len(unique_codes) <= 1:
+        urls = [get_media_url(code, robot_code, access_token) for code in unique_codes]
+    else:
+        urls = list(media_executor.map(lambda code: get_media_url(code, robot_code, access_token), unique_codes))
+    resolved = dict(zip(unique_codes, urls))
+    return [resolved[code] for code in download_codes]
+
+
 # 处理消息内容
 def process_message_content(data: dict, robot_code: str, access_token: str) -> str:
     """根据消息类型处理内容，返回适合存储的 text_content"""
@@ -174,51 +762,277 @@ def process_message_content(data: dict, robot_code: str, access_token: str) -> s
         return data.get("text", {}).get("content", "")
     elif msgtype == "richText":
         rich_text = content.get("richText", [])
+        # 先并发转换全部图片的 downloadCode，再按原顺序拼接
+        download_codes = [item["downloadCode"] for item in rich_text
+                          if "text" not in item and "downloadCode" in item and item.get("type") == "picture"]
+        download_urls = iter(resolve_download_urls(download_codes, robot_code, access_token))
         text_content = ""
         for item in rich_text:
             if "text" in item:
                 text_content += item["text"] + " "
             elif "downloadCode" in item and item.get("type") == "picture":
-                download_url = get_download_url(item["downloadCode"], robot_code, access_token)
+                download_url = next(download_urls)
                 text_content += f"&[{download_url}]&"
         return text_content.strip()
     elif msgtype == "picture":
         download_code = content.get("downloadCode")
         if download_code:
-            return f"&[{get_download_url(download_code, robot_code, access_token)}]&"
+            return f"&[{get_media_url(download_code, robot_code, access_token)}]&"
     elif msgtype == "audio":
         download_code = content.get("downloadCode")
         recognition = content.get("recognition", "")
         duration = content.get("duration", 0)
         if download_code:
-            download_url = get_download_url(download_code, robot_code, access_token)
+            download_url = get_media_url(download_code, robot_code, access_token)
             return f"&[{download_url}]& 时长: {duration}ms, 识别内容: {recognition}"
     elif msgtype == "video":
         download_code = content.get("downloadCode")
         duration = content.get("duration", 0)
         video_type = content.get("videoType", "")
         if download_code:
-            download_url = get_download_url(download_code, robot_code, access_token)
+            download_url = get_media_url(download_code, robot_code, access_token)
             return f"&[{download_url}]& 时长: {duration}ms, 类型: {video_type}"
     elif msgtype == "file":
         download_code = content.get("downloadCode")
         file_name = content.get("fileName", "")
         if download_code:
-            download_url = get_download_url(download_code, robot_code, access_token)
+            download_url = get_media_url(download_code, robot_code, access_token, file_name)
             return f"&[{download_url}]& 文件名: {file_name}"
     return "未知消息类型"
 
 
+# 执行消息查询
+def query_messages(agent_id, sender_names, conversation_titles, since_id=None):
+    """执行消息查询，返回消息列表；数据库不可用时抛出异常"""
+    started = time.perf_counter()
+    try:
+        return store.query_messages(agent_id, sender_names, conversation_titles, since_id)
+    except Exception:
+        db_errors_total.inc("query")
+        raise
+    finally:
+        db_query_duration.observe(time.perf_counter() - started, "query")
+
+
+# 初始化数据库
+def init_database():
+    """启动时执行表结构迁移，并检查典型消息查询的执行计划"""
+    try:
+        store.init(migrate=schema_config["auto_migrate"], explain_check=schema_config["explain_check"])
+    except Exception as e:
+        logging.error(f"数据库初始化失败: {e}", exc_info=True)
+
+
+# 批量写入消息
+def insert_messages(rows: list):
+    """用一条多行 INSERT 写入多条消息，成功后使查询缓存失效并唤醒推送连接，失败时抛出异常"""
+    started = time.perf_counter()
+    try:
+        inserted = store.insert_messages(rows)
+    except Exception:
+        db_errors_total.inc("insert")
+        raise
+    finally:
+        db_query_duration.observe(time.perf_counter() - started, "insert")
+    if inserted < len(rows):
+        duplicate_messages_total.inc("insert", amount=len(rows) - inserted)
+        logging.info(f"跳过 {len(rows) - inserted} 条已存在的消息")
+    if not inserted:
+        return
+    logging.info(f"数据插入成功，共 {inserted} 条")
+    query_cache.invalidate()
+    message_notifier.notify()
+
+
+# 写入合并器，突发消息在几毫秒内合并为一次写入
+batch_writer = BatchWriter(
+    insert_messages,
+    max_batch=ingest_config["batch_max_rows"],
+    max_delay=ingest_config["batch_max_delay"]
+)
+
+
+# 写入消息
+def insert_message(robot_code: str, conversation_title: str, sender_name: str, text_content: str,
+                   msg_id: str = None) -> PendingWrite:
+    """提交一条消息到合并写入，不等待提交；返回的 PendingWrite 在所在批次提交后完成"""
+    return batch_writer.submit((robot_code, conversation_title, sender_name, text_content, msg_id))
+
+
+# 处理队列中的 webhook 消息
+def handle_ingest_job(job: IngestJob):
+    """获取 access_token、转换下载链接并提交写入，返回 PendingWrite；失败时抛出异常或在写入回调中由队列重试"""
+    data = job.data
+    robot_code = job.robot_code
+    msg_id = data.get("msgId") or None
+
+    # 其他进程或重启前已写入的消息，不再获取下载链接
+    if msg_id and store.message_exists(msg_id):
+        duplicate_messages_total.inc("database")
+        logging.info(f"消息 {msg_id} 已存在，跳过")
+        return
+
+    # 获取 access_token
+    access_token = get_access_token(robot_code)
+    if not access_token:
+        raise RuntimeError("无法获取 access_token")
+
+    # 处理消息内容
+    text_content = process_message_content(data, robot_code, access_token)
+    sender_name = data.get("senderNick", "unknown_sender")
+    conversationTitle = data.get("conversationTitle", "unknown_title")
+
+    if not text_content:
+        logging.error("消息内容为空")
+        return
+
+    return insert_message(robot_code, conversationTitle, sender_name, text_content, msg_id)
+
+
+def forget_failed_job(job: IngestJob):
+    """消息最终处理失败时从去重记录中移除"""
+    msg_id = job.data.get("msgId")
+    if msg_id:
+        recent_msg_ids.discard(msg_id)
+    if job.replay_key is not None:
+        replay_cache.discard(job.replay_key)
+
+
+# webhook 处理队列，首次收到消息时启动工作线程
+ingest_queue = IngestQueue(
+    handle_ingest_job,
+    workers=ingest_config["workers"],
+    max_size=ingest_config["max_size"],
+    max_attempts=ingest_config["max_attempts"],
+    retry_delay=ingest_config["retry_delay"],
+    max_retry_delay=ingest_config["max_retry_delay"],
+    degraded_window=ingest_config["degraded_window"],
+    on_failure=forget_failed_job
+)
+
+
+# 后台消息保留线程
+retention_worker = None
+
+
+def start_retention_worker():
+    """启动后台消息保留线程"""
+    global retention_worker
+    if not retention_config["enabled"] or retention_worker is not None:
+        return
+    retention_worker = RetentionWorker(
+        store,
+        retention_days=max(retention_config["retention_days"], 7),
+        archive=retention_config["archive"],
+        batch_size=retention_config["batch_size"],
+        batch_pause=retention_config["batch_pause"],
+        interval=retention_config["interval"],
+        max_threads_running=retention_config["max_threads_running"],
+        partitioning=retention_config["partitioning"],
+        partition_days_ahead=retention_config["partition_days_ahead"],
+        media_cache=media_cache
+    )
+    retention_worker.start()
+
+
+# 请求限流
+rate_limiter = TokenBucketLimiter(rate_limit_config["rate"], rate_limit_config["burst"],
+                                  rate_limit_config["max_clients"])
+address_rate_limiter = TokenBucketLimiter(rate_limit_config["address_rate"], rate_limit_config["address_burst"],
+                                          rate_limit_config["max_addresses"])
+CLIENT_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+rate_limited_total = metrics_registry.counter("rate_limited_total", "被限流的请求数", ("route",))
+
+
+def client_address() -> str:
+    """客户端地址，反向代理之后取 X-Forwarded-For 中的第一个地址"""
+    if rate_limit_config["trust_forwarded_for"]:
+        forwarded = request.headers.get('X-Forwarded-For', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.remote_addr or ""
+
+
+def client_identity() -> str:
+    """区分客户端：地址加上客户端上报的 X-Client-Id，同一出口地址后的多台电脑分别限流；格式不合法的标识忽略"""
+    client_id = request.headers.get('X-Client-Id', '')
+    if not CLIENT_ID_PATTERN.fullmatch(client_id):
+        client_id = ""
+    return f"{client_address()}/{client_id}"
+
+
+def check_rate_limit(agent_id):
+    """超出限流时返回 429 响应，否则返回 None"""
+    if not rate_limit_config["enabled"]:
+        return None
+    # X-Client-Id 由客户端自行上报，每换一个标识就有一个新的令牌桶，因此先按地址限制总量，
+    # 被地址限流的请求不消耗客户端自己的令牌
+    allowed, retry_after = address_rate_limiter.acquire(client_address())
+    if allowed:
+        allowed, retry_after = rate_limiter.acquire((agent_id or "", client_identity()))
+    if allowed:
+        return None
+    rate_limited_total.inc(request.url_rule.rule if request.url_rule else request.path)
+    logging.warning(f"请求过于频繁 - Agent ID: {agent_id}, 客户端: {client_identity()}, {retry_after} 秒后重试")
+    response = jsonify({"error": "请求过于频繁，请稍后重试", "retry_after": retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+# 组件指标：抓取 /metrics 时从各组件的 stats() 读取，不增加请求处理开销
+def pool_connections() -> dict:
+    stats = store.stats()
+    if "open" in stats:
+        return {(state,): stats[state] for state in ("open", "idle", "in_use", "waiting")}
+    return {("open",): stats.get("connections", 0)}
+
+
+metrics_registry.callback("db_pool_connections", "数据库连接数", pool_connections, ("state",))
+metrics_registry.callback("db_pool_max_size", "连接池最大连接数", lambda: store.stats().get("max_size"))
+metrics_registry.callback("db_pool_timeouts_total", "获取连接超时次数",
+                          lambda: store.stats().get("timeouts_total"), type_name="counter")
+metrics_registry.callback("active_clients", f"最近 {ACTIVE_CLIENT_WINDOW} 秒内请求过消息的客户端数",
+                          active_clients.counts, ("agent_id",))
+metrics_registry.callback("access_token_requests_total", "access_token 获取次数（命中缓存/向钉钉刷新/刷新失败/后台刷新）",
+                          lambda: {(key[:-len("_total")],): value for key, value in token_manager.stats().items()
+                                   if key.endswith("_total")},
+                          ("result",), type_name="counter")
+metrics_registry.callback("access_token_expires_in_seconds", "access_token 剩余有效期",
+                          lambda: {(code,): ttl for code, ttl in token_manager.stats()["tokens"].items()},
+                          ("robot_code",))
+metrics_registry.callback("download_url_cache_requests_total", "下载链接缓存命中/未命中次数",
+                          lambda: {("hit",): download_url_cache.hits_total, ("miss",): download_url_cache.misses_total},
+                          ("result",), type_name="counter")
+metrics_registry.callback("ingest_queue_depth", "webhook 处理队列中等待的消息数", lambda: ingest_queue.stats()["depth"])
+metrics_registry.callback("ingest_queue_lag_seconds", "队列中最早一条消息已等待的时间", lambda: ingest_queue.oldest_age())
+metrics_registry.callback("ingest_jobs_total", "webhook 消息处理结果",
+                          lambda: {(key[:-len("_total")],): value for key, value in ingest_queue.stats().items()
+                                   if key.endswith("_total")},
+                          ("result",), type_name="counter")
+metrics_registry.callback("webhook_replay_checks_total", "webhook 重复投递检查结果",
+                          lambda: {("accepted",): replay_cache.accepted_total,
+                                   ("duplicate",): replay_cache.duplicate_total},
+                          ("result",), type_name="counter")
+metrics_registry.callback("batch_writer_batches_total", "合并写入批次数", lambda: batch_writer.batches_total,
+                          type_name="counter")
+metrics_registry.callback("batch_writer_rows_total", "合并写入行数", lambda: batch_writer.rows_total,
+                          type_name="counter")
+
+
 # ==================== 路由处理函数 ====================
 
 @app.route('/', methods=['POST'])
 def root_webhook():
-    """处理钉钉机器人发送的 webhook 请求"""
+    """处理钉钉机器人发送的 webhook 请求，校验后加入处理队列并立即返回"""
     logging.info("收到根路径请求")
 
     # 获取请求数据并打印
-    data = request.json
+    data = request.get_json(silent=True)
     logging.debug(f"收到数据: {data}")
+    if not isinstance(data, dict):
+        logging.error("请求数据无效")
+        return jsonify({"error": "请求数据无效"}), 400
 
     # 获取机器人代码 (robotCode) 对应的 app_key
     robot_code = data.get('robotCode', None)
@@ -237,46 +1051,37 @@ def root_webhook():
     sign = request.headers.get("sign")
     logging.debug(f"收到时间戳: {timestamp}, 签名: {sign}")
 
-    # 验证签名
+    # 验证时间戳与签名
+    if not verify_timestamp(timestamp):
+        webhook_rejected_total.inc("stale_timestamp")
+        logging.error(f"时间戳无效或已过期: {timestamp}")
+        return jsonify({"error": "时间戳无效或已过期"}), 403
     if not verify_signature(app_secret, timestamp, sign):
+        webhook_rejected_total.inc("bad_signature")
         logging.error("签名验证失败")
         return jsonify({"error": "签名验证失败"}), 403
 
-    # 获取 access_token
-    access_token = get_access_token(robot_code)
-    if not access_token:
-        logging.error("无法获取 access_token")
-        return jsonify({"error": "无法获取 access_token"}), 500
-
-    # 处理消息内容
-    text_content = process_message_content(data, robot_code, access_token)
-    sender_name = data.get("senderNick", "unknown_sender")
-    conversationTitle = data.get("conversationTitle", "unknown_title")
-
-    if not text_content:
-        logging.error("消息内容为空")
-        return jsonify({"error": "消息内容为空"}), 400
+    # 丢弃重复投递，返回 200 避免钉钉继续重试
+    replay_key = ReplayCache.make_key(timestamp, sign, request.get_data(cache=True))
+    if not replay_cache.check_and_add(replay_key):
+        logging.info(f"丢弃重复的 webhook 请求，时间戳: {timestamp}")
+        return jsonify({"status": "重复消息已忽略"}), 200
 
-    # 处理数据库操作
-    connection = get_db_connection()
-    if connection is None:
-        logging.error("数据库连接失败")
-        return jsonify({"error": "数据库连接失败"}), 500
+    # 钉钉超时重试会重复投递同一 msgId，入队前丢弃
+    msg_id = data.get("msgId")
+    if msg_id and not recent_msg_ids.add(msg_id):
+        duplicate_messages_total.inc("memory")
+        logging.info(f"丢弃重复投递的消息 {msg_id}")
+        return jsonify({"status": "重复消息已忽略"}), 200
 
-    try:
-        with connection.cursor() as cursor:
-            sql = "INSERT INTO messages (robot_name, conversationTitle, sender_name, message_content) VALUES (%s, %s, %s, %s)"
-            values = (robot_code, conversationTitle, sender_name, text_content)
-            cursor.execute(sql, values)
-            logging.info("数据插入成功")
-        connection.commit()
-    except Exception as e:
-        logging.error(f"数据插入错误: {e}")
-        connection.rollback()
-    finally:
-        connection.close()
+    # 加入处理队列，失败时撤销去重记录，钉钉重试时重新处理
+    if not ingest_queue.submit(data, robot_code, replay_key):
+        if msg_id:
+            recent_msg_ids.discard(msg_id)
+        replay_cache.discard(replay_key)
+        return jsonify({"error": "服务器繁忙，请稍后重试"}), 503
 
-    return jsonify({"status": "消息已接收并存储"}), 200
+    return jsonify({"status": "消息已接收"}), 200
 
 
 # API端点：获取消息
@@ -288,92 +1093,221 @@ def get_messages():
         agent_id = request.args.get('agent_id')
         sender_names = request.args.get('sender_names')
         conversation_titles = request.args.get('conversation_titles')
+        # 增量同步游标：只返回 id 大于客户端已持有最大 id 的消息
+        since_id = request.args.get('since_id', type=int)
 
-        logging.info(f"收到消息请求 - Agent ID: {agent_id}")
-
-        # 构建SQL查询条件
-        conditions = []
-        params = []
-
-        # 基础条件：近7天的消息
-        base_condition = "timestamp >= DATE_SUB(NOW(), INTERVAL 7 DAY)"
-        conditions.append(base_condition)
-
-        # 如果指定了agent_id，则添加robot_name过滤条件
-        if agent_id:
-            conditions.append("robot_name = %s")
-            params.append(agent_id)
-            logging.info(f"添加Agent ID过滤条件: {agent_id}")
-
-        # 处理发送者过滤条件
-        if sender_names:
-            sender_list = sender_names.split(',')
-            # 使用IN子句进行多值匹配
-            placeholders = ','.join(['%s'] * len(sender_list))
-            conditions.append(f"sender_name IN ({placeholders})")
-            params.extend(sender_list)
-            logging.info(f"添加发送者过滤条件: {sender_list}")
-
-        # 处理群聊标题过滤条件
-        if conversation_titles:
-            title_list = conversation_titles.split(',')
-            # 使用IN子句进行多值匹配
-            placeholders = ','.join(['%s'] * len(title_list))
-            conditions.append(f"conversationTitle IN ({placeholders})")
-            params.extend(title_list)
-            logging.info(f"添加群聊标题过滤条件: {title_list}")
-
-        # 构建完整的SQL查询
-        where_clause = " AND ".join(conditions) if conditions else "1=1"
-        sql = f"""
-            SELECT id, robot_name, conversationTitle, sender_name, message_content, timestamp
-            FROM messages 
-            WHERE {where_clause}
-            ORDER BY timestamp DESC
-        """
-
-        logging.debug(f"执行SQL查询: {sql}")
-        logging.debug(f"查询参数: {params}")
-
-        # 执行数据库查询
-        connection = get_db_connection()
-        if connection is None:
-            logging.error("数据库连接失败")
-            return jsonify({"error": "数据库连接失败"}), 500
+        limited = check_rate_limit(agent_id)
+        if limited is not None:
+            return limited
 
-        try:
-            with connection.cursor() as cursor:
-                cursor.execute(sql, params)
-                filtered_messages = cursor.fetchall()
+        response_format = negotiate_response_format()
+        active_clients.touch(agent_id, client_identity())
+
+        logging.info(f"收到消息请求 - Agent ID: {agent_id}, since_id: {since_id}, 格式: {response_format}")
+
+        cache_key = QueryCache.make_key(agent_id, sender_names, conversation_titles, since_id, response_format)
+        cached = query_cache.get(cache_key)
+        if cached is not None:
+            body, etag = cached
+            query_cache_requests_total.inc("hit")
+            logging.info("命中查询缓存")
+        else:
+            query_cache_requests_total.inc("miss")
+            generation = query_cache.generation
+
+            # 执行数据库查询
+            try:
+                filtered_messages = query_messages(agent_id, sender_names, conversation_titles, since_id)
                 logging.info(f"查询完成，找到 {len(filtered_messages)} 条符合条件的消息")
 
                 # 记录前几条消息作为示例
                 for i, row in enumerate(filtered_messages[:3]):
                     logging.debug(f"示例消息 {i + 1}: {row}")
-        except Exception as e:
-            logging.error(f"查询消息错误: {e}", exc_info=True)
-            return jsonify({"error": "查询消息错误", "details": str(e)}), 500
-        finally:
-            connection.close()
+            except ConnectionError:
+                logging.error("数据库连接失败")
+                return jsonify({"error": "数据库连接失败"}), 500
+            except Exception as e:
+                logging.error(f"查询消息错误: {e}", exc_info=True)
+                return jsonify({"error": "查询消息错误", "details": str(e)}), 500
 
-        response_data = {
-            "type": "messages",
-            "data": filtered_messages
-        }
+            body = encode_messages(filtered_messages, "delta" if since_id is not None else "full", response_format)
+            etag = hashlib.sha1(body).hexdigest()
+            query_cache.put(cache_key, body, etag, generation)
+            logging.info(f"返回 {len(filtered_messages)} 条消息给客户端")
 
-        logging.info(f"返回 {len(filtered_messages)} 条消息给客户端")
-        return jsonify(response_data), 200
+        # 内容未变化时返回 304
+        response = app.response_class(body, mimetype=RESPONSE_MIMETYPES[response_format])
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
     except Exception as e:
         logging.error(f"获取消息失败: {e}", exc_info=True)
         return jsonify({"error": "获取消息失败", "details": str(e)}), 500
 
 
+# API端点：推送消息（Server-Sent Events）
+@app.route('/api/messages/stream', methods=['GET'])
+def stream_messages():
+    """保持一条长连接，有新消息写入时立即推送 since_id 之后的消息"""
+    agent_id = request.args.get('agent_id')
+    sender_names = request.args.get('sender_names')
+    conversation_titles = request.args.get('conversation_titles')
+    # 断线重连时浏览器式客户端会通过 Last-Event-ID 带上最后收到的 id
+    since_id = request.args.get('since_id', type=int)
+    if since_id is None:
+        since_id = request.headers.get('Last-Event-ID', 0, type=int)
+    # 推送事件为文本，紧凑格式只使用 JSON 编码
+    compact = request.args.get('format') == 'compact'
+    client = client_identity()
+
+    limited = check_rate_limit(agent_id)
+    if limited is not None:
+        return limited
+
+    # 每条推送连接占用一个工作线程，连接数已满时拒绝，保证 webhook 和轮询请求始终有线程处理；
+    # 名额在返回响应前原子占用，重启后大量客户端同时重连也不会超过上限
+    release_stream = open_streams.try_acquire(max_streams())
+    if release_stream is None:
+        logging.warning(f"推送连接数已达上限 {max_streams()}，拒绝新连接")
+        response = jsonify({"error": "推送连接数已满，请使用轮询"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(STREAM_REJECT_RETRY_SECONDS)
+        return response
+
+    logging.info(f"建立推送连接 - Agent ID: {agent_id}, since_id: {since_id}")
+
+    def generate():
+        stream_connections.inc()
+        try:
+            last_id = since_id
+            version = message_notifier.version
+            last_query = None
+            yield "retry: 3000\n\n"
+
+            while True:
+                active_clients.touch(agent_id, client)
+                sent = False
+                if last_query is None or time.monotonic() - last_query >= STREAM_RESYNC_SECONDS:
+                    try:
+                        rows = query_messages(agent_id, sender_names, conversation_titles, last_id)
+                    except Exception as e:
+                        logging.error(f"推送查询消息错误: {e}")
+                        yield f"event: error\ndata: {json.dumps({'error': '查询消息错误'}, ensure_ascii=False)}\n\n"
+                        return
+                    last_query = time.monotonic()
+                    if rows:
+                        last_id = max(row["id"] for row in rows)
+                        if compact:
+                            data = json.dumps({"fields": COMPACT_FIELDS, "data": compact_rows(rows)},
+                                              ensure_ascii=False, separators=(',', ':'))
+                        else:
+                            data = app.json.dumps(rows)
+                        yield f"id: {last_id}\nevent: messages\ndata: {data}\n\n"
+                        logging.info(f"推送 {len(rows)} 条消息给客户端 (Agent ID: {agent_id})")
+                        sent = True
+
+                if not sent:
+                    yield ": keep-alive\n\n"
+
+                # 版本号变化表示本进程写入了新消息，下一轮立即查库
+                new_version = message_notifier.wait(version, STREAM_HEARTBEAT_SECONDS)
+                if new_version != version:
+                    version = new_version
+                    last_query = None
+        finally:
+            release_stream()
+            stream_connections.dec()
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # 关闭反向代理缓冲
+        }
+    )
+    # 客户端在生成器开始前断开时生成器的 finally 不会执行，由响应关闭时释放名额
+    response.call_on_close(release_stream)
+    return response
+
+
+# 附件下载端点
+@app.route('/media/<name>', methods=['GET'])
+def get_media(name):
+    """提供镜像附件下载，支持 Range 断点续传与条件请求；文件名即内容哈希，可长期缓存"""
+    if media_cache is None:
+        abort(404)
+    path = media_cache.path_for(name)
+    if path is None:
+        abort(404)
+    response = send_file(path, conditional=True, etag=name.split('.')[0], max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+# 运行指标端点
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """以 Prometheus 文本格式输出运行指标"""
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 # 健康检查端点
 @app.route('/health')
 def health_check():
     """健康检查端点"""
-    return jsonify({"status": "healthy", "timestamp": time.time()}), 200
+    return jsonify({
+        "status": "healthy",
+        "timestamp": time.time(),
+        "storage": store.stats(),
+        "access_token": token_manager.stats(),
+        "download_url_cache": download_url_cache.stats(),
+        "media_cache": media_cache.stats() if media_cache else None,
+        "query_cache": query_cache.stats(),
+        "ingest_queue": ingest_queue.stats(),
+        "batch_writer": batch_writer.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "address_rate_limiter": address_rate_limiter.stats(),
+        "replay_cache": replay_cache.stats(),
+        "recent_msg_ids": len(recent_msg_ids),
+        "streams": {"open": open_streams.count, "max": max_streams()},
+        "retention": retention_worker.stats() if retention_worker else None
+    }), 200
+
+
+def start_change_watcher(interval: float):
+    """多进程部署时，其他进程写入的消息不会触发本进程的通知；定期检查最大消息 id，
+    变化时使查询缓存失效并唤醒推送连接"""
+
+    def watch():
+        last_id = None
+        while True:
+            try:
+                max_id = store.max_message_id()
+                if last_id is not None and max_id != last_id:
+                    query_cache.invalidate()
+                    message_notifier.notify()
+                last_id = max_id
+            except Exception as e:
+                logging.error(f"检查新消息时出错: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=watch, name="ChangeWatcher", daemon=True).start()
+    logging.info(f"已启动跨进程新消息检查，间隔 {interval} 秒")
+
+
+def start_background_services(retention: bool = True, watch_changes: bool = False):
+    """启动后台线程：消息处理队列、access_token 刷新、（可选）消息保留任务和（多进程时）跨进程新消息检查"""
+    if retention:
+        start_retention_worker()
+    if watch_changes:
+        start_change_watcher(server_config["change_watch_interval"])
+    ingest_queue.start()
+    token_manager.start_background_refresh(robots.keys(), token_config["refresh_interval"])
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=20000, debug=True, threaded=True)
\ No newline at end of file
+    # 开发服务器，生产环境请使用 python wsgi.py
+    init_database()
+    start_background_services()
+    app.run(host=server_config["host"], port=server_config["port"], debug=True, threaded=True)
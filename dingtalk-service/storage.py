@@ -0,0 +1,386 @@
+# 消息存储后端
+# MySQLStore 使用连接池访问 MySQL，SQLiteStore 使用 WAL 模式的本地文件，由 serve.py 的 storage_config 选择
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+import schema
+from db_pool import ConnectionPool
+
+INSERT_COLUMNS = "(robot_name, conversationTitle, sender_name, message_content, msg_id)"
+SELECT_COLUMNS = "id, robot_name, conversationTitle, sender_name, message_content, timestamp"
+
+
+def build_message_query(agent_id, sender_names, conversation_titles, since_id=None,
+                        placeholder="%s", window_condition="timestamp >= DATE_SUB(NOW(), INTERVAL 7 DAY)"):
+    """根据过滤条件构建消息查询 SQL 及参数"""
+    conditions = []
+    params = []
+
+    # 基础条件：近7天的消息
+    conditions.append(window_condition)
+
+    # 如果指定了agent_id，则添加robot_name过滤条件
+    if agent_id:
+        conditions.append(f"robot_name = {placeholder}")
+        params.append(agent_id)
+        logging.debug(f"添加Agent ID过滤条件: {agent_id}")
+
+    # 处理发送者过滤条件
+    if sender_names:
+        sender_list = sender_names.split(',')
+        # 使用IN子句进行多值匹配
+        placeholders = ','.join([placeholder] * len(sender_list))
+        conditions.append(f"sender_name IN ({placeholders})")
+        params.extend(sender_list)
+        logging.debug(f"添加发送者过滤条件: {sender_list}")
+
+    # 处理群聊标题过滤条件
+    if conversation_titles:
+        title_list = conversation_titles.split(',')
+        # 使用IN子句进行多值匹配
+        placeholders = ','.join([placeholder] * len(title_list))
+        conditions.append(f"conversationTitle IN ({placeholders})")
+        params.extend(title_list)
+        logging.debug(f"添加群聊标题过滤条件: {title_list}")
+
+    # 处理增量同步条件
+    if since_id is not None:
+        conditions.append(f"id > {placeholder}")
+        params.append(since_id)
+
+    # 构建完整的SQL查询
+    where_clause = " AND ".join(conditions) if conditions else "1=1"
+    sql = f"""
+        SELECT {SELECT_COLUMNS}
+        FROM messages
+        WHERE {where_clause}
+        ORDER BY timestamp DESC
+    """
+    return sql, params
+
+
+def sample_queries(build) -> list:
+    """启动自检使用的典型查询，返回 (名称, sql, 参数) 列表"""
+    return [
+        ("agent_id", *build("robot", None, None)),
+        ("agent_id+sender_names", *build("robot", "a,b", None)),
+        ("agent_id+conversation_titles", *build("robot", None, "a,b")),
+        ("agent_id+since_id", *build("robot", None, None, 0)),
+    ]
+
+
+class MessageStore:
+    """消息存储接口"""
+
+    name = ""
+    supports_partitioning = False
+
+    def init(self, migrate: bool = True, explain_check: bool = True):
+        """创建或升级表结构，并检查查询计划"""
+        raise NotImplementedError
+
+    def insert_messages(self, rows: list) -> int:
+        """写入多条消息，rows 中每项为 (robot_name, conversationTitle, sender_name, message_content, msg_id)
+
+        msg_id 已存在的消息被跳过，返回实际写入的条数
+        """
+        raise NotImplementedError
+
+    def message_exists(self, msg_id: str) -> bool:
+        """钉钉消息 id 是否已写入"""
+        raise NotImplementedError
+
+    def query_messages(self, agent_id, sender_names, conversation_titles, since_id=None) -> list:
+        """按过滤条件查询近7天的消息，since_id 不为 None 时只返回 id 更大的消息"""
+        raise NotImplementedError
+
+    def max_message_id(self) -> int:
+        """当前最大消息 id（主键索引，开销很小），表为空时返回 0"""
+        raise NotImplementedError
+
+    def is_busy(self, max_threads_running: int) -> bool:
+        """数据库是否繁忙，繁忙时后台维护任务暂停"""
+        return False
+
+    def ensure_archive_table(self):
+        """创建归档表"""
+        raise NotImplementedError
+
+    def delete_expired(self, retention_days: int, batch_size: int, archive: bool) -> tuple:
+        """删除一批超出保留期的消息，返回 (删除条数, 归档条数)"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+    def close(self):
+        pass
+
+
+class MySQLStore(MessageStore):
+    """MySQL 存储，通过连接池复用连接"""
+
+    name = "mysql"
+    supports_partitioning = True
+
+    def __init__(self, db_config: dict, pool_config: dict):
+        import pymysql
+
+        def connect():
+            return pymysql.connect(
+                host=db_config["host"],
+                user=db_config["user"],
+                password=db_config["password"],
+                database=db_config["database"],
+                cursorclass=pymysql.cursors.DictCursor,
+                autocommit=True,
+                connect_timeout=pool_config["connect_timeout"],
+                read_timeout=pool_config["read_timeout"]
+            )
+
+        self.pool = ConnectionPool(
+            connect,
+            max_size=pool_config["max_size"],
+            acquire_timeout=pool_config["acquire_timeout"],
+            ping_interval=pool_config["ping_interval"],
+            max_lifetime=pool_config["max_lifetime"]
+        )
+
+    def init(self, migrate: bool = True, explain_check: bool = True):
+        with self.pool.connection() as connection:
+            if migrate:
+                schema.migrate(connection)
+            if explain_check:
+                schema.check_query_plans(connection, sample_queries(build_message_query))
+
+    def insert_messages(self, rows: list) -> int:
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                # pymysql 会把 executemany 的 INSERT ... VALUES 改写为单条多行 INSERT；
+                # msg_id 重复时不做修改，受影响行数为 0，只统计实际写入的行
+                sql = (f"INSERT INTO messages {INSERT_COLUMNS} VALUES (%s, %s, %s, %s, %s) "
+                       f"ON DUPLICATE KEY UPDATE msg_id = msg_id")
+                inserted = cursor.executemany(sql, rows)
+            connection.commit()
+        return inserted
+
+    def message_exists(self, msg_id: str) -> bool:
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM messages WHERE msg_id = %s LIMIT 1", (msg_id,))
+                return cursor.fetchone() is not None
+
+    def max_message_id(self) -> int:
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT MAX(id) AS max_id FROM messages")
+                return cursor.fetchone()["max_id"] or 0
+
+    def query_messages(self, agent_id, sender_names, conversation_titles, since_id=None) -> list:
+        sql, params = build_message_query(agent_id, sender_names, conversation_titles, since_id)
+        logging.debug(f"执行SQL查询: {sql}")
+        logging.debug(f"查询参数: {params}")
+
+        try:
+            connection = self.pool.acquire()
+        except Exception as e:
+            logging.error(f"数据库连接错误: {e}")
+            raise ConnectionError("数据库连接失败") from e
+
+        broken = False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                return cursor.fetchall()
+        except Exception:
+            # 出错的连接不再放回池中
+            broken = True
+            raise
+        finally:
+            self.pool.release(connection, broken)
+
+    def is_busy(self, max_threads_running: int) -> bool:
+        if self.pool.stats()["waiting"] > 0:
+            return True
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+                row = cursor.fetchone()
+        threads_running = int(row["Value"]) if row else 0
+        return threads_running > max_threads_running
+
+    def ensure_archive_table(self):
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f"CREATE TABLE IF NOT EXISTS `{schema.ARCHIVE_TABLE}` LIKE `messages`")
+
+    def delete_expired(self, retention_days: int, batch_size: int, archive: bool) -> tuple:
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT id FROM messages WHERE timestamp < DATE_SUB(NOW(), INTERVAL %s DAY) "
+                    "ORDER BY id LIMIT %s",
+                    (retention_days, batch_size)
+                )
+                ids = [row["id"] for row in cursor.fetchall()]
+                if not ids:
+                    return 0, 0
+
+                placeholders = ','.join(['%s'] * len(ids))
+                archived = 0
+                connection.begin()
+                if archive:
+                    cursor.execute(
+                        f"INSERT IGNORE INTO `{schema.ARCHIVE_TABLE}` ({schema.ARCHIVE_COLUMNS}) "
+                        f"SELECT {schema.ARCHIVE_COLUMNS} FROM messages WHERE id IN ({placeholders})",
+                        ids
+                    )
+                    archived = cursor.rowcount
+                cursor.execute(f"DELETE FROM messages WHERE id IN ({placeholders})", ids)
+                deleted = cursor.rowcount
+                connection.commit()
+        return deleted, archived
+
+    def stats(self) -> dict:
+        return {"backend": self.name, **self.pool.stats()}
+
+    def close(self):
+        self.pool.close_all()
+
+
+class SQLiteStore(MessageStore):
+    """SQLite 存储，适合消息量较小、不想单独部署 MySQL 的场景
+
+    使用 WAL 模式，读写互不阻塞；每个线程持有一个连接，写入由 SQLite 自身加锁串行化。
+    """
+
+    name = "sqlite"
+    WINDOW_CONDITION = "timestamp >= datetime('now', 'localtime', '-7 days')"
+
+    def __init__(self, path: str, busy_timeout: float = 5):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _build_query(self, agent_id, sender_names, conversation_titles, since_id=None):
+        return build_message_query(agent_id, sender_names, conversation_titles, since_id,
+                                   placeholder="?", window_condition=self.WINDOW_CONDITION)
+
+    def init(self, migrate: bool = True, explain_check: bool = True):
+        connection = self._connection()
+        if migrate:
+            schema.migrate_sqlite(connection)
+        if explain_check:
+            schema.check_sqlite_query_plans(connection, sample_queries(self._build_query))
+
+    def insert_messages(self, rows: list) -> int:
+        connection = self._connection()
+        try:
+            cursor = connection.executemany(
+                f"INSERT INTO messages {INSERT_COLUMNS} VALUES (?, ?, ?, ?, ?) ON CONFLICT (msg_id) DO NOTHING", rows
+            )
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        return cursor.rowcount
+
+    def message_exists(self, msg_id: str) -> bool:
+        row = self._connection().execute("SELECT 1 FROM messages WHERE msg_id = ? LIMIT 1", (msg_id,)).fetchone()
+        return row is not None
+
+    def max_message_id(self) -> int:
+        return self._connection().execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        message = dict(row)
+        # 与 MySQL 后端保持一致，时间戳以 datetime 返回
+        timestamp = message.get("timestamp")
+        if isinstance(timestamp, str):
+            try:
+                message["timestamp"] = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                pass
+        return message
+
+    def query_messages(self, agent_id, sender_names, conversation_titles, since_id=None) -> list:
+        sql, params = self._build_query(agent_id, sender_names, conversation_titles, since_id)
+        logging.debug(f"执行SQL查询: {sql}")
+        logging.debug(f"查询参数: {params}")
+        cursor = self._connection().execute(sql, params)
+        return [self._to_dict(row) for row in cursor.fetchall()]
+
+    def ensure_archive_table(self):
+        connection = self._connection()
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {schema.ARCHIVE_TABLE} AS SELECT {schema.ARCHIVE_COLUMNS} FROM messages WHERE 0"
+        )
+        connection.commit()
+
+    def delete_expired(self, retention_days: int, batch_size: int, archive: bool) -> tuple:
+        connection = self._connection()
+        expired = ("SELECT id FROM messages WHERE timestamp < datetime('now', 'localtime', ?) "
+                   "ORDER BY id LIMIT ?")
+        params = (f"-{int(retention_days)} days", batch_size)
+        try:
+            archived = 0
+            if archive:
+                cursor = connection.execute(
+                    f"INSERT INTO {schema.ARCHIVE_TABLE} ({schema.ARCHIVE_COLUMNS}) "
+                    f"SELECT {schema.ARCHIVE_COLUMNS} FROM messages WHERE id IN ({expired})",
+                    params
+                )
+                archived = cursor.rowcount
+            cursor = connection.execute(f"DELETE FROM messages WHERE id IN ({expired})", params)
+            deleted = cursor.rowcount
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        return deleted, archived
+
+    def stats(self) -> dict:
+        with self._lock:
+            connections = len(self._connections)
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return {"backend": self.name, "path": self.path, "connections": connections, "file_size": size}
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()  # 之后各线程重新建立连接
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+def create_store(storage_config: dict, db_config: dict, pool_config: dict) -> MessageStore:
+    """根据配置创建存储后端"""
+    backend = storage_config.get("backend", "mysql")
+    if backend == "sqlite":
+        return SQLiteStore(storage_config["sqlite_path"], busy_timeout=storage_config.get("sqlite_busy_timeout", 5))
+    if backend == "mysql":
+        return MySQLStore(db_config, pool_config)
+    raise ValueError(f"不支持的存储后端: {backend}")
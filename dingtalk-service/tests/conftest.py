@@ -0,0 +1,5 @@
+# 服务端模块以脚本方式相互导入（import storage、import schema），测试时把 dingtalk-service 目录加入导入路径
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
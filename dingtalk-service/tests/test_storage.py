@@ -0,0 +1,102 @@
+# SQLiteStore 离线测试：使用临时文件，不需要 MySQL
+# 用法: cd dingtalk-service && python -m pytest tests
+import pytest
+
+from storage import SQLiteStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteStore(str(tmp_path / "messages.db"))
+    store.init(explain_check=False)
+    yield store
+    store.close()
+
+
+def make_row(content, msg_id=None, robot="robot", title="高三1班", sender="老师1"):
+    return (robot, title, sender, content, msg_id)
+
+
+def set_age(store, message_id, days):
+    """把消息的时间戳改为若干天前，模拟历史消息"""
+    connection = store._connection()
+    connection.execute("UPDATE messages SET timestamp = datetime('now', 'localtime', ?) WHERE id = ?",
+                       (f"-{days} days", message_id))
+    connection.commit()
+
+
+def test_insert_skips_duplicate_msg_id(store):
+    assert store.insert_messages([make_row("第一条", "msg-1"), make_row("第二条", "msg-2")]) == 2
+    assert store.insert_messages([make_row("重复投递", "msg-1")]) == 0
+    assert store.message_exists("msg-1")
+    assert not store.message_exists("msg-3")
+
+    contents = [row["message_content"] for row in store.query_messages("robot", None, None)]
+    assert sorted(contents) == ["第一条", "第二条"]
+
+
+def test_insert_without_msg_id_is_not_deduplicated(store):
+    assert store.insert_messages([make_row("无 msgId"), make_row("无 msgId")]) == 2
+
+
+def test_since_id_returns_only_newer_messages(store):
+    assert store.max_message_id() == 0
+    store.insert_messages([make_row(f"消息{i}", f"msg-{i}") for i in range(3)])
+    first_max = store.max_message_id()
+
+    store.insert_messages([make_row("新消息", "msg-new")])
+    rows = store.query_messages("robot", None, None, since_id=first_max)
+    assert [row["message_content"] for row in rows] == ["新消息"]
+    assert rows[0]["id"] == store.max_message_id()
+    assert store.query_messages("robot", None, None, since_id=store.max_message_id()) == []
+
+
+def test_filters_by_agent_sender_and_conversation(store):
+    store.insert_messages([
+        make_row("a", "1", robot="robot", title="管理组", sender="张老师"),
+        make_row("b", "2", robot="robot", title="高三1班", sender="李老师"),
+        make_row("c", "3", robot="robot", title="高三2班", sender="王老师"),
+        make_row("d", "4", robot="other", title="管理组", sender="张老师"),
+    ])
+
+    def contents(*args):
+        return sorted(row["message_content"] for row in store.query_messages(*args))
+
+    assert contents("robot", None, None) == ["a", "b", "c"]
+    assert contents("robot", "张老师,李老师", None) == ["a", "b"]
+    assert contents("robot", None, "高三1班,高三2班") == ["b", "c"]
+    assert contents("robot", "张老师", "高三1班") == []
+    assert contents(None, "张老师", None) == ["a", "d"]
+
+
+def test_query_excludes_messages_older_than_seven_days(store):
+    store.insert_messages([make_row("旧消息", "old"), make_row("新消息", "new")])
+    old_id = min(row["id"] for row in store.query_messages("robot", None, None))
+    set_age(store, old_id, 8)
+
+    rows = store.query_messages("robot", None, None)
+    assert [row["message_content"] for row in rows] == ["新消息"]
+
+
+def test_delete_expired_in_batches(store):
+    store.insert_messages([make_row(f"消息{i}", f"msg-{i}") for i in range(5)])
+    ids = sorted(row["id"] for row in store.query_messages("robot", None, None))
+    for message_id in ids[:3]:
+        set_age(store, message_id, 40)
+
+    assert store.delete_expired(30, batch_size=2, archive=False) == (2, 0)
+    assert store.delete_expired(30, batch_size=2, archive=False) == (1, 0)
+    assert store.delete_expired(30, batch_size=2, archive=False) == (0, 0)
+    assert sorted(row["id"] for row in store.query_messages("robot", None, None)) == ids[3:]
+
+
+def test_delete_expired_archives_before_deleting(store):
+    store.insert_messages([make_row("过期消息", "expired"), make_row("保留消息", "kept")])
+    expired_id = min(row["id"] for row in store.query_messages("robot", None, None))
+    set_age(store, expired_id, 40)
+
+    store.ensure_archive_table()
+    assert store.delete_expired(30, batch_size=100, archive=True) == (1, 1)
+    assert not store.message_exists("expired")
+    archived = store._connection().execute("SELECT msg_id, message_content FROM messages_archive").fetchall()
+    assert [tuple(row) for row in archived] == [("expired", "过期消息")]
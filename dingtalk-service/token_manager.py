@@ -0,0 +1,158 @@
+# access_token 管理
+# 每个机器人一把锁，同一时间只有一个线程向钉钉请求新 token；后台线程在过期前主动刷新，并可持久化到磁盘
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+
+class TokenManager:
+    """线程安全的 access_token 缓存"""
+
+    def __init__(self, fetch: Callable[[str], Tuple[str, int]], refresh_margin: float = 300,
+                 min_valid: float = 60, cache_path: str = None):
+        """fetch(robot_code) 返回 (token, 有效期秒数)，失败时抛出异常"""
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin  # 后台线程在过期前多久开始刷新
+        self.min_valid = min_valid  # 剩余有效期低于该值的 token 不再使用
+        self.cache_path = cache_path
+
+        self._tokens: Dict[str, dict] = {}  # robot_code -> {"token": token, "expire_time": 过期时间戳(秒)}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._refresher = None
+        self._stop_event = threading.Event()
+
+        # 统计信息
+        self.hits_total = 0
+        self.refresh_total = 0
+        self.refresh_failed_total = 0
+        self.background_refresh_total = 0
+
+        self._load_cache()
+
+    def _lock_for(self, robot_code: str) -> threading.Lock:
+        with self._locks_guard:
+            lock = self._locks.get(robot_code)
+            if lock is None:
+                lock = self._locks[robot_code] = threading.Lock()
+            return lock
+
+    def _valid_token(self, robot_code: str, min_valid: float):
+        cached = self._tokens.get(robot_code)
+        if cached and cached["expire_time"] > time.time() + min_valid:
+            return cached["token"]
+        return None
+
+    def get(self, robot_code: str) -> str:
+        """返回有效的 access_token，必要时同步刷新；失败返回空字符串"""
+        token = self._valid_token(robot_code, self.min_valid)
+        if token:
+            self.hits_total += 1
+            return token
+
+        with self._lock_for(robot_code):
+            # 等锁期间其他线程可能已经刷新完成
+            token = self._valid_token(robot_code, self.min_valid)
+            if token:
+                self.hits_total += 1
+                return token
+            return self._refresh(robot_code)
+
+    def _refresh(self, robot_code: str) -> str:
+        """请求新 token，调用方需持有该机器人的锁"""
+        try:
+            token, expires_in = self.fetch(robot_code)
+        except Exception as e:
+            self.refresh_failed_total += 1
+            logging.error(f"获取 access_token 失败 for {robot_code}: {e}")
+            return ""
+
+        expire_time = time.time() + expires_in
+        self._tokens[robot_code] = {"token": token, "expire_time": expire_time}
+        self.refresh_total += 1
+        logging.info(f"成功获取新的 access_token for {robot_code}, 有效期至: {int(expire_time * 1000)}")
+        self._save_cache()
+        return token
+
+    def refresh_expiring(self, robot_codes):
+        """刷新即将过期的 token，已有其他线程在刷新时跳过"""
+        for robot_code in robot_codes:
+            if self._valid_token(robot_code, self.refresh_margin):
+                continue
+            lock = self._lock_for(robot_code)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                if not self._valid_token(robot_code, self.refresh_margin):
+                    if self._refresh(robot_code):
+                        self.background_refresh_total += 1
+            finally:
+                lock.release()
+
+    def _refresh_loop(self, robot_codes, interval: float):
+        while not self._stop_event.is_set():
+            try:
+                self.refresh_expiring(robot_codes)
+            except Exception as e:
+                logging.error(f"后台刷新 access_token 失败: {e}", exc_info=True)
+            self._stop_event.wait(interval)
+
+    def start_background_refresh(self, robot_codes, interval: float = 60):
+        """启动后台刷新线程（可重复调用）"""
+        robot_codes = [code for code in robot_codes if code]
+        with self._locks_guard:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, args=(robot_codes, interval),
+                                               name="TokenRefresher", daemon=True)
+            self._refresher.start()
+        logging.info(f"access_token 后台刷新已启动，机器人数: {len(robot_codes)}")
+
+    def stop(self):
+        self._stop_event.set()
+
+    # ==================== 磁盘缓存 ====================
+
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            now = time.time()
+            for robot_code, cached in data.items():
+                if cached.get("expire_time", 0) > now + self.min_valid:
+                    self._tokens[robot_code] = {"token": cached["token"], "expire_time": cached["expire_time"]}
+            logging.info(f"从磁盘加载 {len(self._tokens)} 个有效 access_token")
+        except Exception as e:
+            logging.warning(f"加载 access_token 缓存失败: {e}")
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        with self._file_lock:
+            try:
+                directory = os.path.dirname(os.path.abspath(self.cache_path))
+                os.makedirs(directory, exist_ok=True)
+                tmp_path = f"{self.cache_path}.tmp"
+                # token 属于敏感信息，仅所有者可读写
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(dict(self._tokens), f)
+                os.replace(tmp_path, self.cache_path)
+            except Exception as e:
+                logging.warning(f"保存 access_token 缓存失败: {e}")
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            "tokens": {code: round(cached["expire_time"] - now) for code, cached in list(self._tokens.items())},
+            "hits_total": self.hits_total,
+            "refresh_total": self.refresh_total,
+            "refresh_failed_total": self.refresh_failed_total,
+            "background_refresh_total": self.background_refresh_total
+        }
@@ -0,0 +1,128 @@
+# 生产环境入口
+# 用法:
+#   python wsgi.py                 Linux 下使用 gunicorn（多进程 + 多线程），Windows 或未安装 gunicorn 时使用 waitress（单进程多线程）
+#   python wsgi.py --waitress      强制使用 waitress
+#   gunicorn -c wsgi.py wsgi:app   直接使用 gunicorn 命令行，本文件同时作为 gunicorn 配置文件
+# 进程数、线程数、keep-alive 和超时时间在 serve.py 的 server_config 中配置
+import argparse
+import logging
+import os
+
+import serve
+from serve import app, server_config
+
+LEADER_LOCK_PATH = "./data/wsgi_leader.lock"
+
+_leader_lock = None
+
+# ==================== gunicorn 配置 ====================
+# gunicorn -c wsgi.py 时读取以下模块级变量
+
+bind = f"{server_config['host']}:{server_config['port']}"
+workers = server_config["workers"]
+threads = server_config["threads"]
+worker_class = "gthread"
+keepalive = server_config["keepalive"]
+timeout = server_config["timeout"]
+graceful_timeout = server_config["graceful_timeout"]
+max_requests = server_config["max_requests"]
+max_requests_jitter = max(server_config["max_requests"] // 10, 0)
+backlog = server_config["backlog"]
+
+
+def acquire_leader_lock() -> bool:
+    """多个工作进程中只有拿到文件锁的一个运行消息保留任务，该进程退出后锁自动释放"""
+    global _leader_lock
+    try:
+        import fcntl
+    except ImportError:
+        return True
+    os.makedirs(os.path.dirname(os.path.abspath(LEADER_LOCK_PATH)), exist_ok=True)
+    lock_file = open(LEADER_LOCK_PATH, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _leader_lock = lock_file
+    return True
+
+
+def on_starting(server):
+    """主进程启动时执行一次表结构迁移，随后关闭连接，避免 fork 后多个进程共用同一连接"""
+    serve.init_database()
+    serve.store.close()
+
+
+def post_fork(server, worker):
+    """每个工作进程启动自己的后台线程；多个进程时各自检查其他进程写入的新消息"""
+    leader = acquire_leader_lock()
+    serve.start_background_services(retention=leader, watch_changes=server.num_workers > 1)
+    logging.info(f"工作进程 {worker.pid} 已启动{'，负责消息保留任务' if leader else ''}")
+
+
+# ==================== 启动 ====================
+
+def run_gunicorn():
+    from gunicorn.app.base import BaseApplication
+
+    class StandaloneApplication(BaseApplication):
+        def load_config(self):
+            settings = {
+                "bind": bind,
+                "workers": workers,
+                "threads": threads,
+                "worker_class": worker_class,
+                "keepalive": keepalive,
+                "timeout": timeout,
+                "graceful_timeout": graceful_timeout,
+                "max_requests": max_requests,
+                "max_requests_jitter": max_requests_jitter,
+                "backlog": backlog,
+                "on_starting": on_starting,
+                "post_fork": post_fork
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    StandaloneApplication().run()
+
+
+def run_waitress():
+    from waitress import serve as waitress_serve
+
+    serve.init_database()
+    serve.start_background_services()
+    logging.info(f"使用 waitress 启动，监听 {bind}，线程数 {server_config['threads']}")
+    waitress_serve(
+        app,
+        host=server_config["host"],
+        port=server_config["port"],
+        threads=server_config["threads"],
+        connection_limit=server_config["connection_limit"],
+        channel_timeout=server_config["timeout"],
+        backlog=server_config["backlog"]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以生产模式启动 dingtalk-service")
+    parser.add_argument("--waitress", action="store_true", help="使用 waitress 代替 gunicorn")
+    args = parser.parse_args()
+
+    if not args.waitress and os.name != 'nt':
+        try:
+            import gunicorn  # noqa: F401
+        except ImportError:
+            logging.warning("未安装 gunicorn，改用 waitress")
+        else:
+            run_gunicorn()
+            return
+    run_waitress()
+
+
+if __name__ == '__main__':
+    main()